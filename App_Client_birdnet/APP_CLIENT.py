@@ -9,6 +9,7 @@ from threading import Thread
 import threading
 import os
 import subprocess
+import tempfile
 import pandas as pd
 import sys
 import pytz
@@ -179,6 +180,17 @@ def reset_esp(esp_ip):
     except requests.exceptions.RequestException as e:
         messagebox.showerror("Error", f"Request failed: {e}")
 
+def daemon_running(socket_path):
+    # A socket left behind by a crashed daemon refuses connections
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
 def run_analysis_thread():
     # Fungsi untuk menjalankan proses analisis dalam thread terpisah
     input_path = input_file_path.get()
@@ -195,8 +207,15 @@ def run_analysis_thread():
 
     # Construct the command with the correct path to analyze.py
     birdnet_analyzer_path = os.path.join("Birdnet-Analyzer", "analyze.py")
-    command = [
-        "python", birdnet_analyzer_path,
+    command = ["python", birdnet_analyzer_path]
+
+    # Submit to the running analysis daemon if there is one (daemon.py serve)
+    daemon_socket = os.path.join(tempfile.gettempdir(), "birdnet_analyzer.sock")
+
+    if daemon_running(daemon_socket):
+        command = ["python", os.path.join("Birdnet-Analyzer", "daemon.py"), "submit", "--socket", daemon_socket]
+
+    command += [
         "--i", input_path,
         "--o", output_path,
         "--rtype", "csv",
@@ -2,10 +2,12 @@
 """
 
 import argparse
+import contextlib
 import datetime
+import itertools
 import json
+import math
 import multiprocessing
-import operator
 import os
 import sys
 from multiprocessing import Pool, freeze_support
@@ -21,6 +23,9 @@ import utils
 #                    0       1      2           3             4              5               6                7           8             9           10         11
 RTABLE_HEADER = "Selection\tView\tChannel\tBegin Time (s)\tEnd Time (s)\tLow Freq (Hz)\tHigh Freq (Hz)\tCommon Name\tSpecies Code\tConfidence\tBegin Path\tFile Offset (s)\n"
 
+# Parameters and audio durations of the analysis runs in a result folder
+RUN_METADATA_FILE = "BirdNET_run.json"
+
 
 def loadCodes():
     """Loads the eBird codes.
@@ -34,11 +39,68 @@ def loadCodes():
     return codes
 
 
+class LabelTable:
+    """Label metadata with integer ids.
+
+    Holds everything the result writers need for a label, so that
+    detections can be serialized without searching the label lists.
+
+    Attributes:
+        labels: The labels, the index is the label id.
+        ids: Dictionary of {label: label id}.
+        translated: The translated labels.
+        scientific_names: Scientific name of each label.
+        common_names: Translated common name of each label.
+        codes: eBird code of each label, or the label itself if there is none.
+        species_mask: Boolean array, True for labels on the species list.
+    """
+
+    def __init__(self, labels: list[str], translated_labels: list[str], codes: dict[str, str], species_list: list[str]):
+        self.labels = labels
+        self.ids = {label: i for i, label in enumerate(labels)}
+        self.translated = translated_labels
+        self.scientific_names = [label.split("_", 1)[0] for label in translated_labels]
+        self.common_names = [label.split("_", 1)[-1] for label in translated_labels]
+        self.codes = [codes.get(label, label) for label in labels]
+
+        if species_list:
+            species = set(species_list)
+            self.species_mask = np.array([label in species for label in labels], dtype=bool)
+        else:
+            self.species_mask = np.ones(len(labels), dtype=bool)
+
+
+LABEL_TABLE: tuple = (None, None)
+
+
+def getLabelTable():
+    """Returns the label table for the current config.
+
+    The table is only rebuilt if labels, translations, codes or the species list change.
+    Unchanged values are recognized by identity, values of a restored config by comparison.
+
+    Returns:
+        A LabelTable.
+    """
+    global LABEL_TABLE
+
+    sources = (cfg.LABELS, cfg.TRANSLATED_LABELS, cfg.CODES, cfg.SPECIES_LIST)
+    cached, table = LABEL_TABLE
+
+    if cached == None or any(a is not b for a, b in zip(cached, sources)):
+        if cached == None or any(a != b for a, b in zip(cached, sources)):
+            table = LabelTable(*sources)
+
+        LABEL_TABLE = (sources, table)
+
+    return table
+
+
 def saveResultFile(r: dict[str, list], path: str, afile_path: str):
     """Saves the results to the hard drive.
 
     Args:
-        r: The dictionary with {segment: scores}.
+        r: The dictionary with {segment: [(label id, score), ...]}.
         path: The path where the result should be saved.
         afile_path: The path to audio file.
     """
@@ -46,15 +108,23 @@ def saveResultFile(r: dict[str, list], path: str, afile_path: str):
     if os.path.dirname(path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
 
+    # Columnar output
+    if cfg.RESULT_TYPE in ["parquet", "arrow"]:
+        return saveColumnarResultFile(r, path, afile_path)
+
+    table = getLabelTable()
+
+    def detections(timestamp):
+        return (c for c in r[timestamp] if c[1] > cfg.MIN_CONFIDENCE and table.species_mask[c[0]])
+
     # Selection table
-    out_string = ""
+    out_string = []
 
     if cfg.RESULT_TYPE == "table":
         selection_id = 0
-        filename = os.path.basename(afile_path)
 
         # Write header
-        out_string += RTABLE_HEADER
+        out_string.append(RTABLE_HEADER)
 
         # Read native sample rate
         high_freq = audio.get_sample_rate(afile_path) / 2
@@ -67,271 +137,1205 @@ def saveResultFile(r: dict[str, list], path: str, afile_path: str):
 
         # Extract valid predictions for every timestamp
         for timestamp in getSortedTimestamps(r):
-            rstring = ""
             start, end = timestamp.split("-", 1)
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    selection_id += 1
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    code = cfg.CODES[c[0]] if c[0] in cfg.CODES else c[0]
-                    rstring += f"{selection_id}\tSpectrogram 1\t1\t{start}\t{end}\t{low_freq}\t{high_freq}\t{label.split('_', 1)[-1]}\t{code}\t{c[1]:.4f}\t{afile_path}\t{start}\n"
+            for c in detections(timestamp):
+                selection_id += 1
+                out_string.append(
+                    f"{selection_id}\tSpectrogram 1\t1\t{start}\t{end}\t{low_freq}\t{high_freq}\t{table.common_names[c[0]]}\t{table.codes[c[0]]}\t{c[1]:.4f}\t{afile_path}\t{start}\n"
+                )
+
+        # If we don't have any valid predictions, we still need to add a line to the selection table in case we want to combine results
+        # TODO: That's a weird way to do it, but it works for now. It would be better to keep track of file durations during the analysis.
+        if selection_id == 0 and cfg.OUTPUT_PATH is not None:
+            selection_id += 1
+            out_string.append(f"{selection_id}\tSpectrogram 1\t1\t0\t3\t{low_freq}\t{high_freq}\tnocall\tnocall\t1.0\t{afile_path}\t0\n")
+
+    elif cfg.RESULT_TYPE == "audacity":
+        # Audacity timeline labels
+        for timestamp in getSortedTimestamps(r):
+            ts = timestamp.replace("-", "\t")
+
+            for c in detections(timestamp):
+                lbl = table.translated[c[0]].replace("_", ", ")
+                out_string.append(f"{ts}\t{lbl}\t{c[1]:.4f}\n")
+
+    elif cfg.RESULT_TYPE == "r":
+        # Output format for R
+        header = "filepath,start,end,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity,min_conf,species_list,model"
+        out_string.append(header)
+
+        # Run parameters are the same for every line
+        params = "{:.4f},{:.4f},{},{},{},{},{},{}".format(
+            cfg.LATITUDE,
+            cfg.LONGITUDE,
+            cfg.WEEK,
+            cfg.SIG_OVERLAP,
+            (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+            cfg.MIN_CONFIDENCE,
+            cfg.SPECIES_LIST_FILE,
+            os.path.basename(cfg.MODEL_PATH),
+        )
+
+        for timestamp in getSortedTimestamps(r):
+            start, end = timestamp.split("-", 1)
+
+            for c in detections(timestamp):
+                out_string.append(
+                    "\n{},{},{},{},{},{:.4f},{}".format(
+                        afile_path,
+                        start,
+                        end,
+                        table.scientific_names[c[0]],
+                        table.common_names[c[0]],
+                        c[1],
+                        params,
+                    )
+                )
+
+    elif cfg.RESULT_TYPE == "kaleidoscope":
+        # Output format for kaleidoscope
+        header = "INDIR,FOLDER,IN FILE,OFFSET,DURATION,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity"
+        out_string.append(header)
+
+        folder_path, filename = os.path.split(afile_path)
+        parent_folder, folder_name = os.path.split(folder_path)
+
+        # Run parameters are the same for every line
+        params = "{:.4f},{:.4f},{},{},{}".format(
+            cfg.LATITUDE,
+            cfg.LONGITUDE,
+            cfg.WEEK,
+            cfg.SIG_OVERLAP,
+            (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+        )
+
+        for timestamp in getSortedTimestamps(r):
+            start, end = timestamp.split("-", 1)
+
+            for c in detections(timestamp):
+                out_string.append(
+                    "\n{},{},{},{},{},{},{},{:.4f},{}".format(
+                        parent_folder.rstrip("/"),
+                        folder_name,
+                        filename,
+                        start,
+                        float(end) - float(start),
+                        table.scientific_names[c[0]],
+                        table.common_names[c[0]],
+                        c[1],
+                        params,
+                    )
+                )
+
+    else:
+        # CSV output file
+        header = "Start (s),End (s),Scientific name,Common name,Confidence\n"
+
+        # Write header
+        out_string.append(header)
+
+        for timestamp in getSortedTimestamps(r):
+            start, end = timestamp.split("-", 1)
+
+            for c in detections(timestamp):
+                out_string.append(
+                    "{},{},{},{},{:.4f}\n".format(start, end, table.scientific_names[c[0]], table.common_names[c[0]], c[1])
+                )
+
+    # Save as file
+    with open(path, "w", encoding="utf-8") as rfile:
+        rfile.write("".join(out_string))
+
+
+def getRunParameters():
+    """Returns the analysis parameters of the current run.
+
+    Returns:
+        A dictionary with the parameters that apply to all results.
+    """
+    return {
+        "model": os.path.basename(cfg.CUSTOM_CLASSIFIER if cfg.CUSTOM_CLASSIFIER else cfg.MODEL_PATH),
+        "labels_file": cfg.LABELS_FILE,
+        "lat": cfg.LATITUDE,
+        "lon": cfg.LONGITUDE,
+        "week": cfg.WEEK,
+        "overlap": cfg.SIG_OVERLAP,
+        "sensitivity": (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+        "min_conf": cfg.MIN_CONFIDENCE,
+        "species_list": cfg.SPECIES_LIST_FILE,
+        "sample_rate": cfg.SAMPLE_RATE,
+        "sig_length": cfg.SIG_LENGTH,
+        "fmin": cfg.BANDPASS_FMIN,
+        "fmax": cfg.BANDPASS_FMAX,
+    }
+
+
+def getResultSchema(metadata: dict = None):
+    """Returns the schema of columnar result files.
+
+    Args:
+        metadata: Optional dictionary that is stored as JSON in the schema metadata.
+
+    Returns:
+        A pyarrow schema.
+    """
+    import pyarrow as pa
+
+    schema = pa.schema(
+        [
+            ("file_id", pa.int32()),
+            ("start", pa.float64()),
+            ("end", pa.float64()),
+            ("label_id", pa.int32()),
+            ("confidence", pa.float32()),
+        ]
+    )
+
+    return schema.with_metadata({"birdnet": json.dumps(metadata)}) if metadata else schema
+
+
+def saveColumnarResultFile(r: dict[str, list], path: str, afile_path: str):
+    """Saves the results as Parquet or Arrow IPC file.
+
+    Every detection is a row with typed columns, the run parameters are stored once in the schema metadata.
+
+    Args:
+        r: The dictionary with {segment: [(label id, score), ...]}.
+        path: The path where the result should be saved.
+        afile_path: The path to audio file.
+    """
+    import pyarrow as pa
+
+    table = getLabelTable()
+    starts, ends, label_ids, scores = [], [], [], []
+
+    for timestamp in getSortedTimestamps(r):
+        start, end = timestamp.split("-", 1)
+
+        for c in r[timestamp]:
+            if c[1] > cfg.MIN_CONFIDENCE and table.species_mask[c[0]]:
+                starts.append(float(start))
+                ends.append(float(end))
+                label_ids.append(c[0])
+                scores.append(c[1])
+
+    # File ids refer to the position in the file list of the run
+    try:
+        file_id = cfg.FILE_LIST.index(afile_path)
+    except ValueError:
+        file_id = -1
+
+    schema = getResultSchema({**getRunParameters(), "file_id": file_id, "file_path": afile_path})
+    columns = pa.table(
+        [
+            pa.array(np.full(len(starts), file_id, dtype="int32")),
+            pa.array(starts, type=pa.float64()),
+            pa.array(ends, type=pa.float64()),
+            pa.array(label_ids, type=pa.int32()),
+            pa.array(scores, type=pa.float32()),
+        ],
+        schema=schema,
+    )
+
+    if cfg.RESULT_TYPE == "parquet":
+        import pyarrow.parquet as pq
+
+        pq.write_table(columns, path)
+    else:
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(columns)
+
+
+def combineColumnarResults(folder: str, output_file: str):
+    """Combines Parquet or Arrow IPC result files.
+
+    The result files are appended as they are, so nothing has to be parsed.
+    The file list and labels of the run are stored in the metadata of the combined file.
+
+    Args:
+        folder: The folder with the result files.
+        output_file: File name of the combined file.
+    """
+    import pyarrow as pa
+
+    output_path = os.path.join(folder, output_file)
+    files = removeHeadResults(utils.collect_all_files(folder, [cfg.RESULT_TYPE], pattern="BirdNET.results"))
+    schema = getResultSchema({**getRunParameters(), "files": cfg.FILE_LIST, "labels": cfg.LABELS})
+
+    if cfg.RESULT_TYPE == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(output_path, schema)
+        read = pq.read_table
+    else:
+        sink = pa.OSFile(output_path, "wb")
+        writer = pa.ipc.new_file(sink, schema)
+        read = lambda path: pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    try:
+        for rfile in files:
+            if os.path.abspath(rfile) == os.path.abspath(output_path):
+                continue
+
+            try:
+                # Each result file becomes a row group / record batch
+                writer.write_table(read(rfile).replace_schema_metadata(schema.metadata))
+
+            except Exception as ex:
+                print(f"Error: Cannot combine results from {rfile}.\n", flush=True)
+                utils.writeErrorLog(ex)
+    finally:
+        writer.close()
+
+        if cfg.RESULT_TYPE != "parquet":
+            sink.close()
+
+
+def removeHeadResults(files: list[str]):
+    """Removes the result files of classifier heads, they are combined separately.
+
+    Args:
+        files: List of result files.
+
+    Returns:
+        The result files of the main output.
+    """
+    folders = tuple(os.path.join(head["OUTPUT_PATH"], "") for head in cfg.HEADS)
+
+    return [f for f in files if not f.startswith(folders)] if folders else files
+
+
+def saveRunMetadata(folder: str, files: list[str]):
+    """Stores the parameters and audio durations of a run in the result folder.
+
+    Durations are merged with those of earlier runs, so `combineResults`
+    does not have to probe the audio files again.
+
+    Args:
+        folder: The result folder.
+        files: The analyzed audio files.
+    """
+    path = os.path.join(folder, RUN_METADATA_FILE)
+    durations = {}
+
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            durations = json.load(f).get("durations", {})
+
+    for fpath in files:
+        try:
+            durations[fpath] = audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE)
+        except Exception:
+            pass
+
+    os.makedirs(folder, exist_ok=True)
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"params": getRunParameters(), "durations": durations}, f)
+
+
+def parseSelectionTable(rfile: str):
+    """Reads the detections of a selection table for `combineResults`.
+
+    Args:
+        rfile: Path to the selection table.
+
+    Returns:
+        A tuple of (audio file path, rows) with rows of (view and channel, begin time, end time, remaining columns).
+        The audio file path is None if the file is not a selection table or cannot be read.
+    """
+    try:
+        with open(rfile, "r", encoding="utf-8") as rf:
+            header = rf.readline()
+
+            # make sure it's a selection table
+            if not "Selection" in header or not "File Offset" in header:
+                return None, []
+
+            f_name = None
+            rows = []
+
+            for line in rf:
+                # empty line?
+                if not line.strip():
+                    continue
+
+                d = line.split("\t", 5)
+                rest = d[5].split("\t", 6)
+
+                if f_name == None:
+                    f_name = rest[5]
+
+                # Is species code and common name == 'nocall'?
+                # If so, that's a dummy line and we can skip it
+                if rest[2] == "nocall" and rest[3] == "nocall":
+                    continue
+
+                rows.append((d[1] + "\t" + d[2], float(d[3]), float(d[4]), d[5] if d[5].endswith("\n") else d[5] + "\n"))
+
+            return f_name, rows
+
+    except Exception as ex:
+        print(f"Error: Cannot combine results from {rfile}.\n", flush=True)
+        utils.writeErrorLog(ex)
+
+        return None, []
+
+
+def combineResults(folder: str, output_file: str, append: bool = False, threads: int = 1):
+    """Combines selection tables into one table.
+
+    Tables are parsed in parallel in windows of a few files per worker and written in order,
+    so memory does not grow with the number of tables. Time offsets use the durations stored by
+    `saveRunMetadata` and only probe audio files that are missing there.
+
+    Args:
+        folder: The folder with the selection tables.
+        output_file: File name of the combined table.
+        append: Whether to only add tables that are new since the last combine.
+        threads: Number of worker processes.
+    """
+    output_path = os.path.join(folder, output_file)
+    listfilesname = os.path.join(folder, output_file.rsplit(".", 1)[0] + ".list.txt")
+    state_path = output_path + ".state.json"
+
+    # Read all files
+    files = removeHeadResults(utils.collect_all_files(folder, ["txt"], pattern="BirdNET.selection.table"))
+    durations = {}
+
+    if os.path.isfile(os.path.join(folder, RUN_METADATA_FILE)):
+        with open(os.path.join(folder, RUN_METADATA_FILE), "r", encoding="utf-8") as f:
+            durations = json.load(f).get("durations", {})
+
+    # Continue the last combine?
+    state = {"files": [], "selection_id": 1, "time_offset": 0}
+
+    if append and os.path.isfile(state_path) and os.path.isfile(output_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    else:
+        append = False
+
+    done = set(state["files"])
+    files = [f for f in files if not f in done]
+    s_id = state["selection_id"]
+    time_offset = state["time_offset"]
+
+    window = max(1, threads) * 4
+    pool = Pool(threads) if threads > 1 else None
+
+    try:
+        with open(output_path, "a" if append else "w", encoding="utf-8", buffering=1 << 20) as f, open(
+            listfilesname, "a" if append else "w", encoding="utf-8"
+        ) as lf:
+            if not append:
+                f.write(RTABLE_HEADER)
+
+            for w in range(0, len(files), window):
+                batch = files[w : w + window]
+                tables = pool.map(parseSelectionTable, batch) if pool else map(parseSelectionTable, batch)
+
+                for rfile, (f_name, rows) in zip(batch, tables):
+                    # Tables that fail are not recorded, so the next append retries them
+                    if f_name == None:
+                        continue
+
+                    try:
+                        f_duration = durations[f_name] if f_name in durations else audio.getAudioFileLength(f_name, cfg.SAMPLE_RATE)
+
+                    except Exception as ex:
+                        print(f"Error: Cannot combine results from {rfile}.\n", flush=True)
+                        utils.writeErrorLog(ex)
+                        continue
+
+                    # adjust selection id and time
+                    f.write(
+                        "".join(
+                            f"{s_id + i}\t{view}\t{start + time_offset}\t{end + time_offset}\t{rest}"
+                            for i, (view, start, end, rest) in enumerate(rows)
+                        )
+                    )
+                    s_id += len(rows)
+                    lf.write(f_name + "\n")
+                    state["files"].append(rfile)
+
+                    # adjust time offset
+                    time_offset += f_duration
+
+    finally:
+        if pool:
+            pool.close()
+
+    state["selection_id"] = s_id
+    state["time_offset"] = time_offset
+
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+
+
+def getSortedTimestamps(results: dict[str, list]):
+    """Sorts the results based on the segments.
+
+    Args:
+        results: The dictionary with {segment: scores}.
+
+    Returns:
+        Returns the sorted list of segments and their scores.
+    """
+    return sorted(results, key=lambda t: float(t.split("-", 1)[0]))
+
+
+def getRawAudioFromFile(fpath: str, offset, duration):
+    """Reads an audio file.
+
+    Reads the file and splits the signal into chunks.
+
+    Args:
+        fpath: Path to the audio file.
+
+    Returns:
+        The signal split into a frame matrix.
+    """
+    # Open file
+    sig, rate = audio.openAudioFile(fpath, cfg.SAMPLE_RATE, offset, duration, cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX)
+
+    # Split into raw audio chunks
+    chunks = audio.frameSignal(sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
+
+    return chunks
+
+
+def getRawAudioChunks(fpath: str, offset=0, duration=None):
+    """Reads an audio file chunk by chunk.
+
+    In streaming mode, the file is decoded in a single sequential pass.
+    Otherwise, FILE_SPLITTING_DURATION seconds are loaded at a time, a given duration
+    is loaded as a single window, so the framing of a shard does not restart within it.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration of the loaded content, None reads to the end of the file.
+
+    Yields:
+        The raw audio chunks of the file.
+    """
+    if cfg.STREAM_AUDIO and audio.isStreamable(fpath):
+        framer = audio.Framer(cfg.SAMPLE_RATE, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
+
+        for block in audio.openAudioStream(
+            fpath, cfg.SAMPLE_RATE, offset, duration, cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX, cfg.FILE_SPLITTING_DURATION
+        ):
+            yield from framer.push(block)
+
+        yield from framer.flush()
+
+    else:
+        end = audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE) if duration == None else offset + duration
+
+        while offset < end:
+            window = cfg.FILE_SPLITTING_DURATION if duration == None else end - offset
+
+            yield from getRawAudioFromFile(fpath, offset, window)
+
+            offset = offset + window
+
+
+def getBatches(chunks, offset=0):
+    """Groups chunks into batches.
+
+    Args:
+        chunks: Iterable of raw audio chunks.
+        offset: Start time of the first chunk.
+
+    Yields:
+        Tuples of (samples, timestamps) with up to BATCH_SIZE entries.
+    """
+    samples = []
+    timestamps = []
+    start, end = offset, offset + cfg.SIG_LENGTH
+
+    for chunk in chunks:
+        # Add to batch
+        samples.append(chunk)
+        timestamps.append([start, end])
+
+        # Advance start and end
+        start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+        end = start + cfg.SIG_LENGTH
+
+        # Check if batch is full
+        if len(samples) < cfg.BATCH_SIZE:
+            continue
+
+        yield samples, timestamps
+
+        # Clear batch
+        samples = []
+        timestamps = []
+
+    # Last batch
+    if samples:
+        yield samples, timestamps
+
+
+def predictLogits(samples):
+    """Predicts the raw scores for the given samples.
+
+    Args:
+        samples: Samples to be predicted.
+
+    Returns:
+        The raw prediction scores.
+    """
+    # Prepare sample and pass through model, a single copy into the batch
+    data = np.asarray(samples, dtype="float32")
+
+    return model.predict(data)
+
+
+def activate(prediction):
+    """Converts raw scores into the configured output.
+
+    Args:
+        prediction: The raw prediction scores.
+
+    Returns:
+        The sigmoid activations if APPLY_SIGMOID is set, otherwise the raw scores.
+    """
+    # Logits or sigmoid activations?
+    if cfg.APPLY_SIGMOID:
+        prediction = model.flat_sigmoid(np.array(prediction), sensitivity=-cfg.SIGMOID_SENSITIVITY)
+
+    return prediction
+
+
+def predict(samples):
+    """Predicts the classes for the given samples.
+
+    Args:
+        samples: Samples to be predicted.
+
+    Returns:
+        The prediction scores.
+    """
+    return activate(predictLogits(samples))
+
+
+def getDetections(p, threshold: float, top_k: int = 0, label_mask=None):
+    """Finds all scores above threshold in a batch of predictions.
+
+    Args:
+        p: The prediction scores with shape (samples, labels).
+        threshold: Only scores above the threshold are kept.
+        top_k: Maximum number of detections per sample, 0 keeps all.
+        label_mask: Optional boolean array of labels that can be detected.
+
+    Returns:
+        A list with the (label index, score) pairs of each sample, sorted by score.
+    """
+    p = np.asarray(p)
+    mask = p > threshold
+
+    if label_mask is not None:
+        mask &= label_mask
+
+    # Only keep the k highest scores of each sample
+    if 0 < top_k < p.shape[1]:
+        top = np.argpartition(np.where(mask, p, -np.inf), -top_k, axis=1)[:, -top_k:]
+        top_mask = np.zeros_like(mask)
+        np.put_along_axis(top_mask, top, True, axis=1)
+        mask &= top_mask
+
+    rows, cols = np.nonzero(mask)
+    scores = p[rows, cols]
+
+    # Sort by sample, then by descending score
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order].tolist(), scores[order].tolist()
+    bounds = np.searchsorted(rows, np.arange(len(p) + 1)).tolist()
+
+    return [list(zip(cols[bounds[i] : bounds[i + 1]], scores[bounds[i] : bounds[i + 1]])) for i in range(len(p))]
+
+
+def get_result_file_name(fpath: str):
+    # We have to check if output path is a file or directory
+    if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv", "parquet", "arrow"]:
+        rpath = fpath.replace(cfg.INPUT_PATH, "")
+        rpath = rpath[1:] if len(rpath) > 0 and rpath[0] in ["/", "\\"] else rpath
+
+        # Make target directory if it doesn't exist
+        rdir = os.path.join(cfg.OUTPUT_PATH, os.path.dirname(rpath))
+
+        os.makedirs(rdir, exist_ok=True)
+
+        if cfg.RESULT_TYPE == "table":
+            rtype = ".BirdNET.selection.table.txt"
+        elif cfg.RESULT_TYPE == "audacity":
+            rtype = ".BirdNET.results.txt"
+        elif cfg.RESULT_TYPE in ["parquet", "arrow"]:
+            rtype = ".BirdNET.results." + cfg.RESULT_TYPE
+        else:
+            rtype = ".BirdNET.results.csv"
+
+        return os.path.join(cfg.OUTPUT_PATH, rpath.rsplit(".", 1)[0] + rtype)
+
+    return cfg.OUTPUT_PATH
+
+
+def getShardBatches(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Reads a time range of a file in batches.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration to read, None reads to the end of the file.
+        num_chunks: Maximum number of chunks to read, None reads all.
+
+    Returns:
+        An iterator of (samples, timestamps) with up to BATCH_SIZE entries.
+    """
+    chunks = getRawAudioChunks(fpath, offset, duration)
+
+    if num_chunks != None:
+        chunks = itertools.islice(chunks, num_chunks)
+
+    return getBatches(chunks, offset)
+
+
+def getDecodePath(fpath: str):
+    """Names the decoder and resampler that read a file.
+
+    Streamed files are decoded with soundfile and a polyphase resampler, others with librosa,
+    which gives slightly different samples and so different raw model outputs.
+
+    Args:
+        fpath: Path to the audio file.
+
+    Returns:
+        The name of the decode path.
+    """
+    if cfg.STREAM_AUDIO and audio.isStreamable(fpath):
+        return "soundfile-polyphase"
+
+    return "librosa-kaiser_fast"
+
+
+def getPredictionCacheKey(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Builds the prediction cache key of a time range of a file.
+
+    The key covers everything that changes the raw model output,
+    but not the threshold, species list, sensitivity or result type.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration, None reads to the end of the file.
+        num_chunks: Maximum number of chunks, None reads all.
+
+    Returns:
+        The cache key.
+    """
+    model_ids = [utils.fileHash(p) if os.path.isfile(p) else p for p in (cfg.MODEL_PATH, cfg.CUSTOM_CLASSIFIER) if p]
+
+    return utils.getCacheKey(
+        utils.fileHash(fpath),
+        model_ids,
+        getDecodePath(fpath),
+        cfg.SAMPLE_RATE,
+        cfg.SIG_LENGTH,
+        cfg.SIG_OVERLAP,
+        cfg.SIG_MINLEN,
+        cfg.BANDPASS_FMIN,
+        cfg.BANDPASS_FMAX,
+        offset,
+        duration,
+        num_chunks,
+    )
+
+
+def loadCachedPredictions(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Loads the raw predictions of a time range of a file from the prediction cache.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration, None reads to the end of the file.
+        num_chunks: Maximum number of chunks, None reads all.
+
+    Returns:
+        A tuple of (logits, segments) or None if the predictions are not cached.
+    """
+    entry = utils.loadCacheEntry(cfg.PREDICTION_CACHE_DIR, getPredictionCacheKey(fpath, offset, duration, num_chunks))
+
+    if entry == None:
+        return None
+
+    return entry["logits"].astype("float32"), entry["segments"].tolist()
+
+
+def getCachedPredictions(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Returns the raw predictions of a time range of a file, using the prediction cache.
+
+    Missing predictions are computed and stored as float16 logits.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration, None reads to the end of the file.
+        num_chunks: Maximum number of chunks, None reads all.
+
+    Returns:
+        A tuple of (logits, segments).
+    """
+    cached = loadCachedPredictions(fpath, offset, duration, num_chunks)
+
+    if cached != None:
+        return cached
+
+    logits = []
+    segments = []
+
+    if usesEmbeddingCache():
+        logits, segments = classifyEmbeddings(*getCachedEmbeddings(fpath, offset, duration, num_chunks))
+        logits = [logits.astype("float16")]
+    else:
+        for samples, timestamps in getShardBatches(fpath, offset, duration, num_chunks):
+            logits.append(np.asarray(predictLogits(samples), dtype="float16"))
+            segments.extend(str(s_start) + "-" + str(s_end) for s_start, s_end in timestamps)
+
+    logits = np.concatenate(logits) if logits else np.zeros((0, len(cfg.LABELS)), dtype="float16")
+    utils.saveCacheEntry(
+        cfg.PREDICTION_CACHE_DIR,
+        getPredictionCacheKey(fpath, offset, duration, num_chunks),
+        logits=logits,
+        segments=np.array(segments, dtype=str),
+    )
+
+    # Use the stored precision, so the first run and re-runs agree
+    return logits.astype("float32"), segments
+
+
+def getEmbeddingCacheKey(fpath: str, *parts):
+    """Builds the embedding cache key of a file.
+
+    The key only covers the base model, the decode path and the audio parameters,
+    so entries are shared by all custom classifiers and by embeddings.py and train.py.
+
+    Args:
+        fpath: Path to the audio file.
+        parts: Values that identify the frames of the file, e.g. the time range.
+
+    Returns:
+        The cache key.
+    """
+    model_id = utils.fileHash(cfg.MODEL_PATH) if os.path.isfile(cfg.MODEL_PATH) else cfg.MODEL_PATH
+
+    return utils.getCacheKey(
+        utils.fileHash(fpath),
+        model_id,
+        "embeddings",
+        getDecodePath(fpath),
+        cfg.SAMPLE_RATE,
+        cfg.SIG_LENGTH,
+        cfg.SIG_OVERLAP,
+        cfg.SIG_MINLEN,
+        cfg.BANDPASS_FMIN,
+        cfg.BANDPASS_FMAX,
+        *parts,
+    )
+
+
+def loadCachedEmbeddings(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Loads the embeddings of a time range of a file from the embedding cache.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration, None reads to the end of the file.
+        num_chunks: Maximum number of chunks, None reads all.
+
+    Returns:
+        A tuple of (embeddings, segments) or None if the embeddings are not cached.
+    """
+    entry = utils.loadCacheEntry(cfg.EMBEDDING_CACHE_DIR, getEmbeddingCacheKey(fpath, offset, duration, num_chunks))
+
+    if entry == None:
+        return None
+
+    return entry["embeddings"].astype("float32"), entry["segments"].tolist()
+
+
+def getCachedEmbeddings(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Returns the embeddings of a time range of a file, using the embedding cache.
+
+    Missing embeddings are computed and stored as float16.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration, None reads to the end of the file.
+        num_chunks: Maximum number of chunks, None reads all.
+
+    Returns:
+        A tuple of (embeddings, segments).
+    """
+    cached = loadCachedEmbeddings(fpath, offset, duration, num_chunks)
+
+    if cached != None:
+        return cached
+
+    e = []
+    segments = []
+
+    for samples, timestamps in getShardBatches(fpath, offset, duration, num_chunks):
+        e.append(np.asarray(model.embeddings(np.asarray(samples, dtype="float32")), dtype="float16"))
+        segments.extend(str(s_start) + "-" + str(s_end) for s_start, s_end in timestamps)
+
+    e = np.concatenate(e) if e else np.zeros((0, 0), dtype="float16")
+    utils.saveCacheEntry(
+        cfg.EMBEDDING_CACHE_DIR,
+        getEmbeddingCacheKey(fpath, offset, duration, num_chunks),
+        embeddings=e,
+        segments=np.array(segments, dtype=str),
+    )
+
+    # Use the stored precision, so the first run and re-runs agree
+    return e.astype("float32"), segments
+
+
+def usesEmbeddingCache():
+    """Checks if predictions are made from cached embeddings.
+
+    Returns:
+        True if the embedding cache is enabled and the custom classifier predicts from embeddings.
+    """
+    return bool(cfg.EMBEDDING_CACHE_DIR) and model.classifierUsesEmbeddings()
+
+
+def classifyEmbeddings(e, segments: list[str]):
+    """Predicts the raw scores of the custom classifier from embeddings.
+
+    Args:
+        e: The embeddings.
+        segments: The segment of each embedding.
+
+    Returns:
+        A tuple of (logits, segments).
+    """
+    if len(e) == 0:
+        return np.zeros((0, len(cfg.LABELS)), dtype="float32"), segments
+
+    return np.asarray(model.classifyEmbeddings(e), dtype="float32"), segments
+
+
+def getCachedResults(logits, segments: list[str]):
+    """Turns raw predictions into detections.
+
+    Args:
+        logits: The raw predictions.
+        segments: The segment of each prediction.
+
+    Returns:
+        The dictionary with {segment: [(label id, score), ...]}.
+    """
+    label_table = getLabelTable()
+    detections = getDetections(activate(logits), cfg.MIN_CONFIDENCE, cfg.TOP_K, label_table.species_mask)
 
-            # Write result string to file
-            out_string += rstring
+    return dict(zip(segments, detections))
 
-        # If we don't have any valid predictions, we still need to add a line to the selection table in case we want to combine results
-        # TODO: That's a weird way to do it, but it works for now. It would be better to keep track of file durations during the analysis.
-        if len(out_string) == len(RTABLE_HEADER) and cfg.OUTPUT_PATH is not None:
-            selection_id += 1
-            out_string += f"{selection_id}\tSpectrogram 1\t1\t0\t3\t{low_freq}\t{high_freq}\tnocall\tnocall\t1.0\t{afile_path}\t0\n"
 
-    elif cfg.RESULT_TYPE == "audacity":
-        # Audacity timeline labels
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
+def getResults(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Predicts the detections for a file.
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    ts = timestamp.replace("-", "\t")
-                    lbl = label.replace("_", ", ")
-                    rstring += f"{ts}\t{lbl}\t{c[1]:.4f}\n"
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration to analyze, None analyzes to the end of the file.
+        num_chunks: Maximum number of chunks to analyze, None analyzes all.
 
-            # Write result string to file
-            out_string += rstring
+    Returns:
+        The dictionary with {segment: [(label id, score), ...]}.
+    """
+    results = {}
 
-    elif cfg.RESULT_TYPE == "r":
-        # Output format for R
-        header = "filepath,start,end,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity,min_conf,species_list,model"
-        out_string += header
+    if cfg.PREDICTION_CACHE_DIR or usesEmbeddingCache():
+        # Cache whole files in shards, so entries are shared with sharded runs
+        if offset == 0 and duration == None and num_chunks == None:
+            shards = getFileShards(fpath)
+        else:
+            shards = [(offset, duration, num_chunks)]
 
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
+        for shard in shards:
+            if cfg.PREDICTION_CACHE_DIR:
+                results.update(getCachedResults(*getCachedPredictions(fpath, *shard)))
+            else:
+                results.update(getCachedResults(*classifyEmbeddings(*getCachedEmbeddings(fpath, *shard))))
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "\n{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{},{},{},{}".format(
-                        afile_path,
-                        start,
-                        end,
-                        label.split("_", 1)[0],
-                        label.split("_", 1)[-1],
-                        c[1],
-                        cfg.LATITUDE,
-                        cfg.LONGITUDE,
-                        cfg.WEEK,
-                        cfg.SIG_OVERLAP,
-                        (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
-                        cfg.MIN_CONFIDENCE,
-                        cfg.SPECIES_LIST_FILE,
-                        os.path.basename(cfg.MODEL_PATH),
-                    )
+        return results
 
-            # Write result string to file
-            out_string += rstring
+    label_table = getLabelTable()
 
-    elif cfg.RESULT_TYPE == "kaleidoscope":
-        # Output format for kaleidoscope
-        header = "INDIR,FOLDER,IN FILE,OFFSET,DURATION,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity"
-        out_string += header
+    # Process each batch
+    for samples, timestamps in getShardBatches(fpath, offset, duration, num_chunks):
+        # Predict
+        p = predict(samples)
 
-        folder_path, filename = os.path.split(afile_path)
-        parent_folder, folder_name = os.path.split(folder_path)
+        # Get scores above threshold for species on the list
+        detections = getDetections(p, cfg.MIN_CONFIDENCE, cfg.TOP_K, label_table.species_mask)
 
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
+        # Add to results
+        for i in range(len(samples)):
+            # Get timestamp
+            s_start, s_end = timestamps[i]
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "\n{},{},{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{}".format(
-                        parent_folder.rstrip("/"),
-                        folder_name,
-                        filename,
-                        start,
-                        float(end) - float(start),
-                        label.split("_", 1)[0],
-                        label.split("_", 1)[-1],
-                        c[1],
-                        cfg.LATITUDE,
-                        cfg.LONGITUDE,
-                        cfg.WEEK,
-                        cfg.SIG_OVERLAP,
-                        (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
-                    )
+            # Store label ids and scores
+            results[str(s_start) + "-" + str(s_end)] = detections[i]
 
-            # Write result string to file
-            out_string += rstring
+    return results
 
-    else:
-        # CSV output file
-        header = "Start (s),End (s),Scientific name,Common name,Confidence\n"
 
-        # Write header
-        out_string += header
+def getHeadConfig(classifier: str):
+    """Builds the config values of a custom classifier head.
 
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
+    The results of a head are saved in a sub-folder named after the classifier,
+    or next to the result file with the classifier name before the extension.
 
-            for c in r[timestamp]:
-                start, end = timestamp.split("-", 1)
+    Args:
+        classifier: Path to the TFLite classifier, trained on the embeddings of the main model.
 
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "{},{},{},{},{:.4f}\n".format(
-                        start, end, label.split("_", 1)[0], label.split("_", 1)[-1], c[1]
-                    )
+    Returns:
+        A dictionary with the config values that differ from the main output.
+    """
+    if not classifier.endswith(".tflite"):
+        raise ValueError(f"Classifier heads need to be TFLite models: {classifier}")
 
-            # Write result string to file
-            out_string += rstring
+    name = os.path.basename(classifier).rsplit(".", 1)[0]
+    labels = utils.readLines(classifier.replace(".tflite", "_Labels.txt"))
 
-    # Save as file
-    with open(path, "w", encoding="utf-8") as rfile:
-        rfile.write(out_string)
+    # Output file or folder?
+    if cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv", "parquet", "arrow"]:
+        root, ext = cfg.OUTPUT_PATH.rsplit(".", 1)
+        output_path = f"{root}.{name}.{ext}"
+    else:
+        output_path = os.path.join(cfg.OUTPUT_PATH, name)
 
+    return {
+        "CUSTOM_CLASSIFIER": classifier,
+        "LABELS_FILE": classifier.replace(".tflite", "_Labels.txt"),
+        "LABELS": labels,
+        "TRANSLATED_LABELS": labels,
+        # Like a run with --classifier, only a species list file applies to a head
+        "SPECIES_LIST": cfg.SPECIES_LIST if cfg.SPECIES_LIST_FILE else [],
+        "OUTPUT_PATH": output_path,
+        "HEADS": [],
+    }
 
-def combineResults(folder: str, output_file: str):
 
-    # Read all files
-    files = utils.collect_all_files(folder, ["txt"], pattern="BirdNET.selection.table")
+@contextlib.contextmanager
+def headConfig(head: dict):
+    """Temporarily switches the config to a classifier head.
 
-    # Combine all files
-    s_id = 1
-    time_offset = 0
-    audiofiles = []
+    Args:
+        head: The config values of the head, an empty dictionary keeps the main output.
+    """
+    config = cfg.getConfig()
+    cfg.setConfig({**config, **head})
 
-    with open(os.path.join(folder, output_file), "w", encoding="utf-8") as f:
-        f.write(RTABLE_HEADER)
+    try:
+        yield
+    finally:
+        cfg.setConfig(config)
 
-        for rfile in files:
-            with open(rfile, "r", encoding="utf-8") as rf:
 
-                try:
-                    lines = rf.readlines()
+def getCachedHeadPredictions(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Returns the raw predictions of the main output and all classifier heads, using the caches.
 
-                    # make sure it's a selection table
-                    if not "Selection" in lines[0] or not "File Offset" in lines[0]:
-                        continue
+    Entries are shared with runs of the single classifiers. Missing outputs are computed
+    from cached embeddings, or in one pass that also fills the embedding cache.
 
-                    # skip header and add to file
-                    f_name = lines[1].split("\t")[10]
-                    f_duration = audio.getAudioFileLength(f_name, cfg.SAMPLE_RATE)
+    Args:
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration, None reads to the end of the file.
+        num_chunks: Maximum number of chunks, None reads all.
 
-                    audiofiles.append(f_name)
+    Returns:
+        A tuple of (logits of each output, segments).
+    """
+    heads = [{}] + cfg.HEADS
+    logits = [None] * len(heads)
+    segments = []
 
-                    for line in lines[1:]:
+    if cfg.PREDICTION_CACHE_DIR:
+        for i, head in enumerate(heads):
+            with headConfig(head):
+                cached = loadCachedPredictions(fpath, offset, duration, num_chunks)
 
-                        # empty line?
-                        if not line.strip():
-                            continue
+            if cached != None:
+                logits[i], segments = cached
 
-                        # Is species code and common name == 'nocall'?
-                        # If so, that's a dummy line and we can skip it
-                        if line.split("\t")[7] == "nocall" and line.split("\t")[8] == "nocall":
-                            continue
+    missing = [i for i, l in enumerate(logits) if l is None]
 
-                        # adjust selection id
-                        line = line.split("\t")
-                        line[0] = str(s_id)
-                        s_id += 1
+    if not missing:
+        return logits, segments
 
-                        # adjust time
-                        line[3] = str(float(line[3]) + time_offset)
-                        line[4] = str(float(line[4]) + time_offset)
+    # Heads always predict from embeddings, the main output only with an embedding based classifier
+    from_embeddings = [i for i in missing if i > 0 or usesEmbeddingCache()]
+    cached = loadCachedEmbeddings(fpath, offset, duration, num_chunks) if cfg.EMBEDDING_CACHE_DIR else None
 
-                        # write line
-                        f.write("\t".join(line))
+    if cached != None and missing == from_embeddings:
+        e, segments = cached
+    else:
+        # One pass for the main output and the embeddings
+        p, e, segments = [], [], []
+
+        for samples, timestamps in getShardBatches(fpath, offset, duration, num_chunks):
+            batch_p, batch_e = model.predictWithEmbeddings(np.asarray(samples, dtype="float32"))
+            p.append(np.asarray(batch_p, dtype="float32"))
+            e.append(np.asarray(batch_e, dtype="float32"))
+            segments.extend(str(s_start) + "-" + str(s_end) for s_start, s_end in timestamps)
+
+        if not 0 in from_embeddings and logits[0] is None:
+            logits[0] = np.concatenate(p) if p else np.zeros((0, len(cfg.LABELS)), dtype="float32")
+
+        e = np.concatenate(e) if e else np.zeros((0, 0), dtype="float32")
+
+        if cfg.EMBEDDING_CACHE_DIR:
+            e = e.astype("float16")
+            utils.saveCacheEntry(
+                cfg.EMBEDDING_CACHE_DIR,
+                getEmbeddingCacheKey(fpath, offset, duration, num_chunks),
+                embeddings=e,
+                segments=np.array(segments, dtype=str),
+            )
+            e = e.astype("float32")
+
+    for i in from_embeddings:
+        if len(e) == 0:
+            logits[i] = np.zeros((0, len(heads[i].get("LABELS", cfg.LABELS))), dtype="float32")
+        else:
+            classifier = heads[i].get("CUSTOM_CLASSIFIER", cfg.CUSTOM_CLASSIFIER)
+            logits[i] = np.asarray(model.classifyEmbeddings(e, classifier), dtype="float32")
 
-                    # adjust time offset
-                    time_offset += f_duration
+    if cfg.PREDICTION_CACHE_DIR:
+        for i in missing:
+            with headConfig(heads[i]):
+                utils.saveCacheEntry(
+                    cfg.PREDICTION_CACHE_DIR,
+                    getPredictionCacheKey(fpath, offset, duration, num_chunks),
+                    logits=logits[i].astype("float16"),
+                    segments=np.array(segments, dtype=str),
+                )
 
-                except Exception as ex:
-                    print(f"Error: Cannot combine results from {rfile}.\n", flush=True)
-                    utils.writeErrorLog(ex)
+            # Use the stored precision, so the first run and re-runs agree
+            logits[i] = logits[i].astype("float16").astype("float32")
 
-    listfilesname = output_file.rsplit(".", 1)[0] + ".list.txt"
+    return logits, segments
 
-    with open(os.path.join(folder, listfilesname), "w", encoding="utf-8") as f:
-        f.writelines((f + "\n" for f in audiofiles))
 
+def getHeadResults(fpath: str, offset=0, duration=None, num_chunks=None):
+    """Predicts the detections of the main output and all classifier heads for a file.
 
-def getSortedTimestamps(results: dict[str, list]):
-    """Sorts the results based on the segments.
+    The embeddings are computed once per batch, together with the scores of the main output,
+    and each head only runs its classifier on them.
 
     Args:
-        results: The dictionary with {segment: scores}.
+        fpath: Path to the audio file.
+        offset: The starting offset.
+        duration: Maximum duration to analyze, None analyzes to the end of the file.
+        num_chunks: Maximum number of chunks to analyze, None analyzes all.
 
     Returns:
-        Returns the sorted list of segments and their scores.
+        A list with the results of the main output, followed by the results of each head.
     """
-    return sorted(results, key=lambda t: float(t.split("-", 1)[0]))
+    if not cfg.HEADS:
+        return [getResults(fpath, offset, duration, num_chunks)]
 
+    heads = [{}] + cfg.HEADS
 
-def getRawAudioFromFile(fpath: str, offset, duration):
-    """Reads an audio file.
+    if cfg.PREDICTION_CACHE_DIR or cfg.EMBEDDING_CACHE_DIR:
+        results = [{} for _ in heads]
 
-    Reads the file and splits the signal into chunks.
+        # Cache whole files in shards, so entries are shared with sharded runs
+        if offset == 0 and duration == None and num_chunks == None:
+            shards = getFileShards(fpath)
+        else:
+            shards = [(offset, duration, num_chunks)]
 
-    Args:
-        fpath: Path to the audio file.
+        for shard in shards:
+            logits, segments = getCachedHeadPredictions(fpath, *shard)
 
-    Returns:
-        The signal split into a list of chunks.
-    """
-    # Open file
-    sig, rate = audio.openAudioFile(fpath, cfg.SAMPLE_RATE, offset, duration, cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX)
+            for head, r, l in zip(heads, results, logits):
+                with headConfig(head):
+                    r.update(getCachedResults(l, segments))
 
-    # Split into raw audio chunks
-    chunks = audio.splitSignal(sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
+        return results
 
-    return chunks
+    masks = [getLabelTable().species_mask]
+    masks.extend(LabelTable(h["LABELS"], h["TRANSLATED_LABELS"], {}, h["SPECIES_LIST"]).species_mask for h in cfg.HEADS)
+    results = [{} for _ in masks]
 
+    # Process each batch
+    for samples, timestamps in getShardBatches(fpath, offset, duration, num_chunks):
+        logits, e = model.predictWithEmbeddings(np.asarray(samples, dtype="float32"))
+        outputs = [logits] + [model.classifyEmbeddings(e, h["CUSTOM_CLASSIFIER"]) for h in cfg.HEADS]
+        segments = [str(s_start) + "-" + str(s_end) for s_start, s_end in timestamps]
 
-def predict(samples):
-    """Predicts the classes for the given samples.
+        # Get scores above threshold for each output
+        for r, p, mask in zip(results, outputs, masks):
+            r.update(zip(segments, getDetections(activate(p), cfg.MIN_CONFIDENCE, cfg.TOP_K, mask)))
+
+    return results
+
+
+def saveHeadResults(results: list[dict], fpath: str, start_time: datetime.datetime):
+    """Saves the results of the main output and all classifier heads for a file.
 
     Args:
-        samples: Samples to be predicted.
+        results: The results of the main output, followed by the results of each head.
+        fpath: Path to the audio file.
+        start_time: Time when the analysis of the file started.
 
     Returns:
-        The prediction scores.
+        The `True` if all results were saved successfully.
     """
-    # Prepare sample and pass through model
-    data = np.array(samples, dtype="float32")
-    prediction = model.predict(data)
+    success = True
 
-    # Logits or sigmoid activations?
-    if cfg.APPLY_SIGMOID:
-        prediction = model.flat_sigmoid(np.array(prediction), sensitivity=-cfg.SIGMOID_SENSITIVITY)
+    for head, r in zip([{}] + cfg.HEADS, results):
+        with headConfig(head):
+            success = saveResults(r, fpath, start_time) and success
 
-    return prediction
+    return success
 
 
-def get_result_file_name(fpath: str):
-    # We have to check if output path is a file or directory
-    if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
-        rpath = fpath.replace(cfg.INPUT_PATH, "")
-        rpath = rpath[1:] if len(rpath) > 0 and rpath[0] in ["/", "\\"] else rpath
+def saveResults(results: dict[str, list], fpath: str, start_time: datetime.datetime):
+    """Saves the results of a file and reports the analysis time.
 
-        # Make target directory if it doesn't exist
-        rdir = os.path.join(cfg.OUTPUT_PATH, os.path.dirname(rpath))
+    Args:
+        results: The dictionary with {segment: [(label id, score), ...]}.
+        fpath: Path to the audio file.
+        start_time: Time when the analysis of the file started.
 
-        os.makedirs(rdir, exist_ok=True)
+    Returns:
+        The `True` if the results were saved successfully.
+    """
+    # Save as selection table
+    try:
+        saveResultFile(results, get_result_file_name(fpath), fpath)
 
-        if cfg.RESULT_TYPE == "table":
-            rtype = ".BirdNET.selection.table.txt"
-        elif cfg.RESULT_TYPE == "audacity":
-            rtype = ".BirdNET.results.txt"
-        else:
-            rtype = ".BirdNET.results.csv"
+    except Exception as ex:
+        # Write error log
+        print(f"Error: Cannot save result for {fpath}.\n", flush=True)
+        utils.writeErrorLog(ex)
 
-        return os.path.join(cfg.OUTPUT_PATH, rpath.rsplit(".", 1)[0] + rtype)
+        return False
 
-    return cfg.OUTPUT_PATH
+    delta_time = (datetime.datetime.now() - start_time).total_seconds()
+    print(f"Finished {fpath} in {delta_time:.2f} seconds", flush=True)
+
+    return True
 
 
 def analyzeFile(item):
@@ -351,11 +1355,6 @@ def analyzeFile(item):
 
     # Start time
     start_time = datetime.datetime.now()
-    offset = 0
-    duration = cfg.FILE_SPLITTING_DURATION
-    start, end = 0, cfg.SIG_LENGTH
-    fileLengthSeconds = audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE)
-    results = {}
     result_file_name = get_result_file_name(fpath)
 
     if cfg.SKIP_EXISTING_RESULTS and os.path.exists(result_file_name):
@@ -365,80 +1364,173 @@ def analyzeFile(item):
     # Status
     print(f"Analyzing {fpath}", flush=True)
 
-    # Process each chunk
     try:
-        while offset < fileLengthSeconds:
-            chunks = getRawAudioFromFile(fpath, offset, duration)
-            samples = []
-            timestamps = []
-
-            for chunk_index, chunk in enumerate(chunks):
-                # Add to batch
-                samples.append(chunk)
-                timestamps.append([start, end])
-
-                # Advance start and end
-                start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
-                end = start + cfg.SIG_LENGTH
-
-                # Check if batch is full or last chunk
-                if len(samples) < cfg.BATCH_SIZE and chunk_index < len(chunks) - 1:
-                    continue
+        results = getHeadResults(fpath)
+
+    except Exception as ex:
+        # Write error log
+        print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
+        utils.writeErrorLog(ex)
 
-                # Predict
-                p = predict(samples)
+        return False
 
-                # Add to results
-                for i in range(len(samples)):
-                    # Get timestamp
-                    s_start, s_end = timestamps[i]
+    return saveHeadResults(results, fpath, start_time)
 
-                    # Get prediction
-                    pred = p[i]
 
-                    # Assign scores to labels
-                    p_labels = zip(cfg.LABELS, pred)
+def getFileShards(fpath: str):
+    """Splits a file into time ranges that can be analyzed independently.
 
-                    # Sort by score
-                    p_sorted = sorted(p_labels, key=operator.itemgetter(1), reverse=True)
+    Each shard covers the chunks that start within FILE_SPLITTING_DURATION seconds.
+    The duration is taken from the file header, the last shard always reads to the end of the file.
 
-                    # Store top 5 results and advance indices
-                    results[str(s_start) + "-" + str(s_end)] = p_sorted
+    Args:
+        fpath: Path to the audio file.
 
-                # Clear batch
-                samples = []
-                timestamps = []
-            offset = offset + duration
+    Returns:
+        A list of (offset, duration, number of chunks), duration and number of chunks are None for the last shard.
+    """
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+    step_samples = int(step * cfg.SAMPLE_RATE)
+    chunks_per_shard = max(1, int(cfg.FILE_SPLITTING_DURATION / step))
+    shard_length = chunks_per_shard * step_samples / cfg.SAMPLE_RATE
+    num_shards = max(1, math.ceil(audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE) / shard_length))
 
-    except Exception as ex:
-        # Write error log
-        print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
-        utils.writeErrorLog(ex)
+    # Keep the first offset an int, so timestamps match a sequential run
+    offsets = [0] + [i * shard_length for i in range(1, num_shards)]
+    shards = [(o, (chunks_per_shard - 1) * step + cfg.SIG_LENGTH, chunks_per_shard) for o in offsets[:-1]]
+    shards.append((offsets[-1], None, None))
 
-        return False
+    return shards
+
+
+def planShards(files: list[str]):
+    """Splits files into shards.
+
+    Files with existing results are skipped if SKIP_EXISTING_RESULTS is set.
+    With a cache, each file is hashed once here, so the workers do not read it again for every shard.
+
+    Args:
+        files: List of audio files.
+
+    Returns:
+        A tuple of ({file path: shards}, {file path: status}, {file path: hash}), the status is set for files
+        that are not analyzed, hashes are None without a cache.
+    """
+    shards = {}
+    status = {}
+    hashes = {}
+
+    for fpath in files:
+        if cfg.SKIP_EXISTING_RESULTS and os.path.exists(get_result_file_name(fpath)):
+            print(f"Skipping {fpath} as it has already been analyzed", flush=True)
+            status[fpath] = True
+            continue
+
+        try:
+            shards[fpath] = getFileShards(fpath)
+            hashes[fpath] = utils.fileHash(fpath) if cfg.PREDICTION_CACHE_DIR or cfg.EMBEDDING_CACHE_DIR else None
+
+        except Exception as ex:
+            print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
+            utils.writeErrorLog(ex)
+            status[fpath] = False
+
+    return shards, status, hashes
+
+
+def analyzeShard(item):
+    """Analyzes a time range of a file.
+
+    Args:
+        item: Tuple containing (file path, (offset, duration, number of chunks), config, file hash or None)
+
+    Returns:
+        A tuple of (file path, offset, results of each output, start time), results are None if the analysis failed.
+    """
+    # Get file path and restore cfg
+    fpath: str = item[0]
+    offset, duration, num_chunks = item[1]
+    cfg.setConfig(item[2])
+
+    if item[3] != None:
+        utils.setFileHash(fpath, item[3])
+
+    # Start time
+    start_time = datetime.datetime.now()
+
+    # Status
+    if offset == 0:
+        print(f"Analyzing {fpath}", flush=True)
 
-    # Save as selection table
     try:
-        saveResultFile(results, result_file_name, fpath)
+        return fpath, offset, getHeadResults(fpath, offset, duration, num_chunks), start_time
 
     except Exception as ex:
         # Write error log
-        print(f"Error: Cannot save result for {fpath}.\n", flush=True)
+        print(f"Error: Cannot analyze audio file {fpath} at {offset:.1f}s.\n", flush=True)
         utils.writeErrorLog(ex)
 
-        return False
+        return fpath, offset, None, start_time
 
-    delta_time = (datetime.datetime.now() - start_time).total_seconds()
-    print(f"Finished {fpath} in {delta_time:.2f} seconds", flush=True)
 
-    return True
+def analyzeFilesSharded(files: list[str], threads: int, pool=None):
+    """Analyzes files with a pool of workers.
 
+    Files are split into time range shards that go through the shared task queue of the pool,
+    so an idle worker always picks up the next shard, no matter which file it belongs to.
+    The results of a file are saved as soon as all of its shards are done.
 
-if __name__ == "__main__":
-    # Freeze support for executable
-    freeze_support()
+    Args:
+        files: List of audio files.
+        threads: Number of worker processes.
+        pool: A process pool to use instead of a new one with `threads` workers.
 
-    # Parse arguments
+    Returns:
+        A dictionary with {file path: `True` if the file was analyzed successfully}.
+    """
+    config = cfg.getConfig()
+    shards, status, hashes = planShards(files)
+    outputs = 1 + len(cfg.HEADS)
+    pending = {
+        fpath: {"shards": len(s), "results": [{} for _ in range(outputs)], "failed": False, "start": None} for fpath, s in shards.items()
+    }
+    tasks = [(fpath, shard, config, hashes[fpath]) for fpath, s in shards.items() for shard in s]
+
+    p = pool if pool != None else Pool(threads)
+
+    try:
+        for fpath, offset, results, start_time in p.imap_unordered(analyzeShard, tasks):
+            entry = pending[fpath]
+            entry["shards"] -= 1
+
+            # The analysis time of a file starts with its first shard
+            if entry["start"] == None or start_time < entry["start"]:
+                entry["start"] = start_time
+
+            if results == None:
+                entry["failed"] = True
+            else:
+                for r, shard_results in zip(entry["results"], results):
+                    r.update(shard_results)
+
+            # All shards done?
+            if entry["shards"] == 0:
+                del pending[fpath]
+                status[fpath] = not entry["failed"] and saveHeadResults(entry["results"], fpath, entry["start"])
+
+    finally:
+        if pool == None:
+            p.terminate()
+
+    return status
+
+
+def getArgumentParser():
+    """Creates the command line parser of the analysis.
+
+    Returns:
+        The argument parser.
+    """
     parser = argparse.ArgumentParser(description="Analyze audio files with BirdNET")
     parser.add_argument(
         "--i", default="example/", help="Path to input file or folder. If this is a file, --o needs to be a file too."
@@ -477,15 +1569,21 @@ if __name__ == "__main__":
         default=0.0,
         help="Overlap of prediction segments. Values in [0.0, 2.9]. Defaults to 0.0.",
     )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=0,
+        help="Maximum number of detections per segment above the confidence threshold. Set 0 to keep all. Defaults to 0.",
+    )
     parser.add_argument(
         "--rtype",
         default="table",
-        help="Specifies output format. Values in ['table', 'audacity', 'r',  'kaleidoscope', 'csv']. Defaults to 'table' (Raven selection table).",
+        help="Specifies output format. Values in ['table', 'audacity', 'r',  'kaleidoscope', 'csv', 'parquet', 'arrow']. Defaults to 'table' (Raven selection table). 'parquet' and 'arrow' require pyarrow.",
     )
     parser.add_argument(
         "--output_file",
         default=None,
-        help="Path to combined Raven selection table. If set and rtype is 'table', all results will be combined into this file. Defaults to None.",
+        help="Path to combined result file. If set and rtype is 'table', 'parquet' or 'arrow', all results will be combined into this file. Defaults to None.",
     )
     parser.add_argument(
         "--threads", type=int, default=min(8, max(1, multiprocessing.cpu_count() // 2)), help="Number of CPU threads."
@@ -509,6 +1607,12 @@ if __name__ == "__main__":
         default=None,
         help="Path to custom trained classifier. Defaults to None. If set, --lat, --lon and --locale are ignored.",
     )
+    parser.add_argument(
+        "--heads",
+        nargs="+",
+        default=None,
+        help="Paths to additional custom classifiers (.tflite) that run on the embeddings of the same pass. Results of each head are saved in a sub-folder named after the classifier. Defaults to None.",
+    )
     parser.add_argument(
         "--fmin",
         type=int,
@@ -526,11 +1630,64 @@ if __name__ == "__main__":
         action="store_true",
         help="Skip files that have already been analyzed. Defaults to False.",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Decode WAV, FLAC, OGG and AIFF files in a single sequential pass. Defaults to False.",
+    )
+    parser.add_argument(
+        "--append_output",
+        action="store_true",
+        help="Only add selection tables that are new since the last combine to --output_file. Defaults to False.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory for cached raw predictions. Re-runs on the same files skip the model. Pipeline runs read the cache but do not fill it. Defaults to None (no cache).",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        default=None,
+        help="Directory for cached feature embeddings, shared with embeddings.py and train.py. With a custom classifier, only the classifier runs on cached files. Defaults to None (no cache).",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Decode and predict in separate processes. --threads is split between the inference processes. Prediction and embedding caches are read, but not filled. Defaults to False.",
+    )
+    parser.add_argument(
+        "--decoders",
+        type=int,
+        default=cfg.DECODE_PROCESSES,
+        help=f"Number of decoder processes in pipeline mode. Defaults to {cfg.DECODE_PROCESSES}.",
+    )
+    parser.add_argument(
+        "--inference_workers",
+        type=int,
+        default=cfg.INFERENCE_PROCESSES,
+        help=f"Number of inference processes in pipeline mode. Defaults to {cfg.INFERENCE_PROCESSES}.",
+    )
+    parser.add_argument(
+        "--queue_depth",
+        type=int,
+        default=cfg.PIPELINE_DEPTH,
+        help=f"Number of decoded batches that can wait for inference in pipeline mode. Defaults to {cfg.PIPELINE_DEPTH}.",
+    )
+
 
-    args = parser.parse_args()
+    return parser
 
+
+def setConfigFromArgs(args, script_dir: str):
+    """Sets the config of a run from parsed command line arguments.
+
+    Loads the labels, translations, eBird codes and species list.
+
+    Args:
+        args: The parsed arguments.
+        script_dir: Directory that model, label and code paths are relative to.
+    """
     # Set paths relative to script path (requested in #3)
-    script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
     cfg.MODEL_PATH = os.path.join(script_dir, cfg.MODEL_PATH)
     cfg.LABELS_FILE = os.path.join(script_dir, cfg.LABELS_FILE)
     cfg.TRANSLATED_LABELS_PATH = os.path.join(script_dir, cfg.TRANSLATED_LABELS_PATH)
@@ -543,6 +1700,9 @@ if __name__ == "__main__":
     cfg.LABELS = utils.readLines(cfg.LABELS_FILE)
 
     cfg.SKIP_EXISTING_RESULTS = args.skip_existing_results
+    cfg.STREAM_AUDIO = args.stream
+    cfg.PREDICTION_CACHE_DIR = args.cache_dir
+    cfg.EMBEDDING_CACHE_DIR = args.embedding_cache_dir
 
     # Set custom classifier?
     if args.classifier is not None:
@@ -595,6 +1755,9 @@ if __name__ == "__main__":
     else:
         print(f"Species list contains {len(cfg.SPECIES_LIST)} species")
 
+    # Build label table once, forked workers inherit it
+    getLabelTable()
+
     # Set input and output path
     cfg.INPUT_PATH = args.i
     cfg.OUTPUT_PATH = args.o
@@ -609,6 +1772,9 @@ if __name__ == "__main__":
     # Set confidence threshold
     cfg.MIN_CONFIDENCE = max(0.01, min(0.99, float(args.min_conf)))
 
+    # Set maximum number of detections per segment
+    cfg.TOP_K = max(0, int(args.top_k))
+
     # Set sensitivity
     cfg.SIGMOID_SENSITIVITY = max(0.5, min(1.0 - (float(args.sensitivity) - 1.0), 1.5))
 
@@ -622,11 +1788,11 @@ if __name__ == "__main__":
     # Set result type
     cfg.RESULT_TYPE = args.rtype.lower()
 
-    if not cfg.RESULT_TYPE in ["table", "audacity", "r", "kaleidoscope", "csv"]:
+    if not cfg.RESULT_TYPE in ["table", "audacity", "r", "kaleidoscope", "csv", "parquet", "arrow"]:
         cfg.RESULT_TYPE = "table"
 
     # Set output file
-    if args.output_file is not None and cfg.RESULT_TYPE == "table":
+    if args.output_file is not None and cfg.RESULT_TYPE in ["table", "parquet", "arrow"]:
         cfg.OUTPUT_FILE = args.output_file
     else:
         cfg.OUTPUT_FILE = None
@@ -642,6 +1808,33 @@ if __name__ == "__main__":
     # Set batch size
     cfg.BATCH_SIZE = max(1, int(args.batchsize))
 
+    # Set pipeline mode
+    cfg.PIPELINE = args.pipeline
+
+    if cfg.PIPELINE:
+        cfg.DECODE_PROCESSES = max(1, int(args.decoders))
+        cfg.INFERENCE_PROCESSES = max(1, int(args.inference_workers))
+        cfg.PIPELINE_DEPTH = max(cfg.INFERENCE_PROCESSES, int(args.queue_depth))
+        cfg.TFLITE_THREADS = max(1, int(args.threads) // cfg.INFERENCE_PROCESSES)
+
+    # Set classifier heads
+    cfg.HEADS = [getHeadConfig(head) for head in args.heads or []]
+
+    if cfg.HEADS and cfg.PIPELINE:
+        print("Pipeline mode does not support classifier heads, using worker processes instead.", flush=True)
+        cfg.PIPELINE = False
+
+
+def runAnalysis(append_output: bool = False, pool=None):
+    """Analyzes the files of the current config and combines the results.
+
+    Args:
+        append_output: Whether to only append new selection tables to the combined table.
+        pool: A process pool to reuse for the analysis, a new one is created if None.
+
+    Returns:
+        A dictionary with {file path: `True` if the file was analyzed successfully}.
+    """
     # Add config items to each file list entry.
     # We have to do this for Windows which does not
     # support fork() and thus each process has to
@@ -649,23 +1842,52 @@ if __name__ == "__main__":
     flist = [(f, cfg.getConfig()) for f in cfg.FILE_LIST]
 
     # Analyze files
-    if cfg.CPU_THREADS < 2 or len(flist) < 2:
-        for entry in flist:
-            analyzeFile(entry)
+    if cfg.PIPELINE:
+        import pipeline
+
+        status = pipeline.analyzeFilesPipelined(cfg.FILE_LIST, cfg.DECODE_PROCESSES, cfg.INFERENCE_PROCESSES, cfg.PIPELINE_DEPTH)
+    elif cfg.CPU_THREADS < 2:
+        status = {entry[0]: analyzeFile(entry) for entry in flist}
     else:
-        with Pool(cfg.CPU_THREADS) as p:
-            # Map analyzeFile function to each entry in flist
-            results = p.map_async(analyzeFile, flist)
-            # Wait for all tasks to complete
-            results.wait()
-
-    # Combine results?
-    if not cfg.OUTPUT_FILE is None:
-        print(f"Combining results into {cfg.OUTPUT_FILE}...", end="", flush=True)
-        combineResults(cfg.OUTPUT_PATH, cfg.OUTPUT_FILE)
-        print("done!", flush=True)
+        status = analyzeFilesSharded(cfg.FILE_LIST, cfg.CPU_THREADS, pool)
+
+    for head in [{}] + cfg.HEADS:
+        with headConfig(head):
+            # Store audio durations for combining
+            if os.path.isdir(cfg.INPUT_PATH):
+                saveRunMetadata(cfg.OUTPUT_PATH, cfg.FILE_LIST)
+
+            # Combine results?
+            if not cfg.OUTPUT_FILE is None:
+                print(f"Combining results into {cfg.OUTPUT_FILE}...", end="", flush=True)
+
+                if cfg.RESULT_TYPE == "table":
+                    combineResults(cfg.OUTPUT_PATH, cfg.OUTPUT_FILE, append_output, cfg.CPU_THREADS)
+                else:
+                    combineColumnarResults(cfg.OUTPUT_PATH, cfg.OUTPUT_FILE)
+
+                print("done!", flush=True)
+
+    return status
+
+
+if __name__ == "__main__":
+    # Freeze support for executable
+    freeze_support()
+
+    # Parse arguments
+    args = getArgumentParser().parse_args()
+
+    # Set config
+    setConfigFromArgs(args, os.path.dirname(os.path.abspath(sys.argv[0])))
+
+    # Analyze and combine
+    runAnalysis(args.append_output)
 
     # A few examples to test
     # python3 analyze.py --i example/ --o example/ --slist example/ --min_conf 0.5 --threads 4
     # python3 analyze.py --i example/soundscape.wav --o example/soundscape.BirdNET.selection.table.txt --slist example/species_list.txt --threads 8
     # python3 analyze.py --i example/ --o example/ --lat 42.5 --lon -76.45 --week 4 --sensitivity 1.0 --rtype table --locale de
+    # python3 analyze.py --i example/ --o example/ --rtype parquet --output_file BirdNET_Results.parquet --threads 4
+    # python3 analyze.py --i example/ --o example/ --pipeline --decoders 3 --inference_workers 1 --threads 4
+    # python3 analyze.py --i example/ --o example/ --heads checkpoints/custom/Frogs.tflite checkpoints/custom/Bats.tflite --threads 4
@@ -1,16 +1,26 @@
 """Module containing audio helper functions.
 """
+import functools
+import os
+
 import numpy as np
 
 import config as cfg
 
 RANDOM = np.random.RandomState(cfg.RANDOM_SEED)
 
+# File types that libsndfile can decode block by block
+STREAMABLE_FILETYPES = ["wav", "flac", "ogg", "aiff", "aif"]
+
+# Seconds of audio before a stream offset that run through the bandpass filter, so its state has settled
+BANDPASS_PREROLL = 0.5
+
 
 def openAudioFile(path: str, sample_rate=48000, offset=0.0, duration=None, fmin=None, fmax=None):
     """Open an audio file.
 
     Opens an audio file with librosa and the given settings.
+    PCM and float WAV files at the target sample rate are memory-mapped instead.
 
     Args:
         path: Path to the audio file.
@@ -21,10 +31,16 @@ def openAudioFile(path: str, sample_rate=48000, offset=0.0, duration=None, fmin=
     Returns:
         Returns the audio time series and the sampling rate.
     """
-    # Open file with librosa (uses ffmpeg or libav)
-    import librosa
+    wav = readWav(path, offset, duration) if path.lower().endswith(".wav") else None
 
-    sig, rate = librosa.load(path, sr=sample_rate, offset=offset, duration=duration, mono=True, res_type="kaiser_fast")
+    # Native rate WAV needs no decoding or resampling
+    if wav != None and wav[1] == sample_rate:
+        sig, rate = wav
+    else:
+        # Open file with librosa (uses ffmpeg or libav)
+        import librosa
+
+        sig, rate = librosa.load(path, sr=sample_rate, offset=offset, duration=duration, mono=True, res_type="kaiser_fast")
 
     # Bandpass filter
     if fmin != None and fmax != None:
@@ -33,16 +49,576 @@ def openAudioFile(path: str, sample_rate=48000, offset=0.0, duration=None, fmin=
 
     return sig, rate
 
-def getAudioFileLength(path, sample_rate=48000):    
-    
-    # Open file with librosa (uses ffmpeg or libav)
+def isStreamable(path: str):
+    """Checks if a file can be read with `openAudioStream`.
+
+    Args:
+        path: Path to the audio file.
+
+    Returns:
+        True if the file type can be decoded block by block.
+    """
+    return path.rsplit(".", 1)[-1].lower() in STREAMABLE_FILETYPES
+
+
+def openAudioStream(path: str, sample_rate=48000, offset=0.0, duration=None, fmin=None, fmax=None, block_duration=600):
+    """Opens an audio file as a stream of blocks.
+
+    Reads the file sequentially with soundfile, so every sample is decoded exactly once.
+    Resampling and bandpass filtering keep their state across blocks.
+
+    Args:
+        path: Path to the audio file.
+        sample_rate: The sample rate at which the file should be processed.
+        offset: The starting offset.
+        duration: Maximum duration of the loaded content.
+        fmin: Lower bandpass frequency.
+        fmax: Upper bandpass frequency.
+        block_duration: Number of seconds to read at a time.
+
+    Yields:
+        Mono float32 blocks of the signal at the given sample rate.
+    """
+    import soundfile as sf
+
+    bp = Bandpass(sample_rate, fmin, fmax) if fmin != None and fmax != None else None
+
+    with sf.SoundFile(path) as f:
+        rate = f.samplerate
+        resampler = Resampler(rate, sample_rate) if rate != sample_rate else None
+        block_len = max(1, int(block_duration * rate))
+        remaining = int(duration * rate) if duration != None else None
+        start = int(offset * rate)
+
+        # Feed the resampler and the filter with the samples before the offset, so they have the same
+        # state as if we read the file from the start; the output of these samples is dropped
+        context = max(resampler.context if resampler else 0, int(BANDPASS_PREROLL * rate) if bp and bp.coefficients != None else 0)
+
+        if resampler:
+            preroll = min(start, context) // resampler.down * resampler.down
+            drop = preroll * resampler.up // resampler.down
+        else:
+            preroll = drop = min(start, context)
+
+        # Read a few samples past the end of the range, so the resampler also has the same context there
+        postroll = resampler.context if resampler and remaining != None else 0
+        limit = -(-remaining * resampler.up // resampler.down) if resampler and remaining != None else None
+
+        if remaining != None:
+            remaining += preroll + postroll
+
+        if start > 0:
+            f.seek(start - preroll)
+
+        while remaining == None or remaining > 0:
+            data = f.read(block_len if remaining == None else min(block_len, remaining), dtype="float32", always_2d=True)
+
+            # End of file?
+            if len(data) == 0:
+                break
+
+            if remaining != None:
+                remaining -= len(data)
+
+            # Downmix to mono
+            block = data.mean(axis=1) if data.shape[1] > 1 else data[:, 0]
+
+            if resampler:
+                block = resampler.process(block)
+
+            if bp:
+                block = bp.process(block)
+
+            if drop > 0:
+                block, drop = block[drop:], max(0, drop - len(block))
+
+            if limit != None:
+                block, limit = block[:limit], max(0, limit - len(block))
+
+            if len(block) > 0:
+                yield block
+
+        # Flush resampler
+        if resampler:
+            block = resampler.process(np.zeros(0, dtype="float32"), final=True)
+
+            if bp:
+                block = bp.process(block)
+
+            if drop > 0:
+                block = block[drop:]
+
+            if limit != None:
+                block = block[:limit]
+
+            if len(block) > 0:
+                yield block
+
+
+class Resampler:
+    """Polyphase resampler that can be fed a signal block by block.
+
+    The output is identical to running scipy's `resample_poly` over the whole
+    signal (librosa's "polyphase" resampling), but only a few samples of context
+    are kept between blocks.
+    """
+
+    def __init__(self, orig_sr: int, target_sr: int):
+        from math import gcd
+
+        g = gcd(int(orig_sr), int(target_sr))
+        self.up = int(target_sr) // g
+        self.down = int(orig_sr) // g
+
+        # resample_poly uses a filter with a half length of 10 * max(up, down) upsampled samples;
+        # the context is rounded to full input periods so that blocks stay phase aligned
+        context = 10 * max(self.up, self.down) // self.up + 1
+        self.context = -(-context // self.down) * self.down
+
+        self.buffer = np.zeros(self.context, dtype="float32")
+        self.total_in = 0
+        self.total_out = 0
+
+    def process(self, block, final=False):
+        """Resamples the next block.
+
+        Args:
+            block: The next block of the input signal.
+            final: Flushes the remaining samples if True.
+
+        Returns:
+            The resampled samples that are ready.
+        """
+        from scipy.signal import resample_poly
+
+        self.buffer = np.concatenate((self.buffer, block.astype("float32", copy=False)))
+        self.total_in += len(block)
+
+        if final:
+            # Pad with zeros, just like resample_poly does at the end of a signal
+            n = len(self.buffer) - self.context
+            n_padded = -(-n // self.down) * self.down
+            sig = np.concatenate((self.buffer, np.zeros(n_padded - n + self.context, dtype="float32")))
+        else:
+            # Only resample what has enough context on both sides
+            n = n_padded = (len(self.buffer) - 2 * self.context) // self.down * self.down
+
+            if n <= 0:
+                return np.zeros(0, dtype="float32")
+
+            sig = self.buffer[: n + 2 * self.context]
+
+        first = self.context * self.up // self.down
+        out = resample_poly(sig, self.up, self.down)[first : first + n_padded * self.up // self.down]
+
+        if final:
+            out = out[: -(-self.total_in * self.up // self.down) - self.total_out]
+            self.buffer = np.zeros(self.context, dtype="float32")
+        else:
+            self.buffer = self.buffer[n:]
+
+        self.total_out += len(out)
+
+        return out.astype("float32")
+
+
+class Bandpass:
+    """Bandpass filter that keeps its state across blocks.
+
+    Filtering a signal block by block gives the same result as `bandpass` on the whole signal.
+    """
+
+    def __init__(self, rate, fmin, fmax, order=5):
+        self.coefficients = getBandpassCoefficients(rate, fmin, fmax, order)
+        self.state = None
+
+    def process(self, sig):
+        """Filters the next block.
+
+        Args:
+            sig: The next block of the signal.
+
+        Returns:
+            The filtered block.
+        """
+        if self.coefficients == None:
+            return sig
+
+        from scipy.signal import lfilter
+
+        b, a = self.coefficients
+
+        if self.state is None:
+            self.state = np.zeros(max(len(a), len(b)) - 1)
+
+        sig, self.state = lfilter(b, a, sig, zi=self.state)
+
+        return sig.astype("float32")
+
+
+class Framer:
+    """Splits a signal that arrives block by block into chunks.
+
+    Chunks are the same as `splitSignal` would return for the whole signal.
+    """
+
+    def __init__(self, rate, seconds, overlap, minlen):
+        self.rate = rate
+        self.seconds = seconds
+        self.overlap = overlap
+        self.minlen_seconds = minlen
+        self.length = int(seconds * rate)
+        self.step = int((seconds - overlap) * rate)
+        self.minlen = int(minlen * rate)
+        self.buffer = np.zeros(0, dtype="float32")
+        self.count = 0
+
+    def push(self, block):
+        """Adds a block to the signal.
+
+        Args:
+            block: The next block of the signal.
+
+        Returns:
+            An array of all chunks that are complete, as views of the buffered signal.
+        """
+        self.buffer = np.concatenate((self.buffer, block))
+
+        if len(self.buffer) < self.length:
+            return np.zeros((0, self.length), dtype=self.buffer.dtype)
+
+        chunks = np.lib.stride_tricks.sliding_window_view(self.buffer, self.length)[:: self.step]
+        self.buffer = self.buffer[len(chunks) * self.step :]
+        self.count += len(chunks)
+
+        return chunks
+
+    def flush(self):
+        """Ends the signal.
+
+        Returns:
+            An array of the remaining, padded chunks.
+        """
+        # Only the first chunk may be shorter than minlen
+        if self.count > 0 and len(self.buffer) < max(1, self.minlen):
+            chunks = np.zeros((0, self.length), dtype=self.buffer.dtype)
+        else:
+            chunks = frameSignal(self.buffer, self.rate, self.seconds, self.overlap, self.minlen_seconds)
+
+        self.buffer = np.zeros(0, dtype="float32")
+        self.count += len(chunks)
+
+        return chunks
+
+
+# Sample formats of the WAV fast path by (format tag, bits per sample)
+WAV_SAMPLE_FORMATS = {(1, 16): "<i2", (1, 32): "<i4", (3, 32): "<f4"}
+
+
+def readWavHeader(path: str, size: int):
+    """Reads the format and location of the samples of a WAV file from its header.
+
+    The data chunk size is clamped to the file size, so recordings with
+    a missing or wrong size in the header get the length that is on disk.
+
+    Args:
+        path: Path to the WAV file.
+        size: Size of the file in bytes.
+
+    Returns:
+        A tuple of (sample rate, channels, sample dtype, data offset, number of frames) or None if the header
+        cannot be parsed. The dtype is None for sample formats that are not in WAV_SAMPLE_FORMATS.
+    """
+    with open(path, "rb") as f:
+        return parseWavHeader(f, size)
+
+
+def parseWavHeader(f, size: int):
+    """Parses the header of a WAV file from a binary file object.
+
+    Args:
+        f: Seekable binary file object, positioned at the start of the file.
+        size: Size of the file in bytes.
+
+    Returns:
+        Same as `readWavHeader`.
+    """
+    import struct
+
+    riff = f.read(12)
+
+    if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+
+    while True:
+        chunk = f.read(8)
+
+        if len(chunk) < 8:
+            return None
+
+        chunk_id, chunk_size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+
+        if chunk_id == b"fmt ":
+            fmt = f.read(chunk_size)
+            f.seek(chunk_size % 2, 1)
+        elif chunk_id == b"data":
+            break
+        else:
+            # Chunks are padded to an even size
+            f.seek(chunk_size + chunk_size % 2, 1)
+
+    if fmt == None or len(fmt) < 16:
+        return None
+
+    tag, channels, rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+    data_offset = f.tell()
+    remaining = size - data_offset
+
+    if chunk_size == 0 or chunk_size > remaining:
+        chunk_size = remaining
+
+    if not rate or not block_align:
+        return None
+
+    # WAVE_FORMAT_EXTENSIBLE stores the actual format tag in the sub format
+    if tag == 0xFFFE and len(fmt) >= 26:
+        tag = struct.unpack("<H", fmt[24:26])[0]
+
+    dtype = WAV_SAMPLE_FORMATS.get((tag, bits))
+
+    if dtype != None and block_align != channels * bits // 8:
+        dtype = None
+
+    return rate, channels, dtype, data_offset, chunk_size // block_align
+
+
+def readWav(path: str, offset=0.0, duration=None):
+    """Reads PCM or float WAV samples through a memory map.
+
+    Args:
+        path: Path to the WAV file.
+        offset: The starting offset.
+        duration: Maximum duration of the loaded content.
+
+    Returns:
+        A tuple of the float32 mono signal and the sample rate, or None if the sample format is not supported.
+    """
+    header = readWavHeader(path, os.path.getsize(path))
+
+    if header == None or header[2] == None:
+        return None
+
+    rate, channels, dtype, data_offset, frames = header
+    start = min(round(offset * rate), frames)
+    end = frames if duration == None else min(frames, start + round(duration * rate))
+
+    if end <= start:
+        return np.zeros(0, dtype="float32"), rate
+
+    itemsize = np.dtype(dtype).itemsize
+    data = np.memmap(path, dtype=dtype, mode="r", offset=data_offset + start * channels * itemsize, shape=(end - start, channels))
+    sig = toMono(data)
+
+    del data
+
+    return sig, rate
+
+
+def toMono(data):
+    """Converts interleaved PCM or float samples into a float32 mono signal.
+
+    Args:
+        data: Samples with shape (frames, channels).
+
+    Returns:
+        The float32 mono signal.
+    """
+    # Scale integers to [-1, 1), same as libsndfile
+    if data.dtype.kind == "f":
+        sig = np.array(data, dtype="float32")
+    else:
+        sig = data.astype("float32")
+        sig *= np.float32(1.0 / 2 ** (data.dtype.itemsize * 8 - 1))
+
+    # Downmix
+    if sig.shape[1] > 1:
+        return sig.mean(axis=1, dtype="float32")
+
+    return sig.reshape(-1)
+
+
+class StreamDecoder:
+    """Decodes a WAV or raw PCM byte stream that arrives in pieces.
+
+    The output blocks are mono, resampled and bandpass filtered like `openAudioStream`.
+    """
+
+    # Maximum size of a WAV header
+    MAX_HEADER_SIZE = 1 << 20
+
+    def __init__(self, sample_rate=48000, fmin=None, fmax=None, rate=None, channels=1, dtype="<i2"):
+        """Creates the decoder.
+
+        Args:
+            sample_rate: The sample rate at which the signal should be processed.
+            fmin: Lower bandpass frequency.
+            fmax: Upper bandpass frequency.
+            rate: Sample rate of raw PCM data, None expects a WAV header.
+            channels: Number of channels of raw PCM data.
+            dtype: Sample dtype of raw PCM data.
+        """
+        self.sample_rate = sample_rate
+        self.bp = Bandpass(sample_rate, fmin, fmax) if fmin != None and fmax != None else None
+        self.buffer = b""
+        self.format = None
+        self.remaining = None
+
+        if rate != None:
+            self.setFormat(rate, channels, dtype)
+
+    def setFormat(self, rate, channels, dtype):
+        self.format = (np.dtype(dtype), channels)
+        self.resampler = Resampler(rate, self.sample_rate) if rate != self.sample_rate else None
+
+    def parseHeader(self):
+        import io
+        import sys
+
+        header = parseWavHeader(io.BytesIO(self.buffer), sys.maxsize)
+
+        if header == None:
+            if len(self.buffer) > self.MAX_HEADER_SIZE:
+                raise ValueError("Cannot parse WAV header.")
+
+            return
+
+        rate, channels, dtype, data_offset, frames = header
+
+        if dtype == None:
+            raise ValueError("WAV sample format not supported.")
+
+        # Only data that is already buffered can be dropped
+        if data_offset > len(self.buffer):
+            return
+
+        self.setFormat(rate, channels, dtype)
+        self.buffer = self.buffer[data_offset:]
+        self.remaining = frames * channels * self.format[0].itemsize
+
+    def push(self, data: bytes, final=False):
+        """Decodes the next piece of the stream.
+
+        Args:
+            data: The next bytes of the stream.
+            final: Ends the stream and flushes the resampler if True.
+
+        Returns:
+            The decoded samples that are ready.
+        """
+        self.buffer += data
+
+        if self.format == None:
+            self.parseHeader()
+
+            if self.format == None:
+                if final:
+                    raise ValueError("Cannot parse WAV header.")
+
+                return np.zeros(0, dtype="float32")
+
+        # Ignore chunks after the data chunk
+        if self.remaining != None:
+            self.buffer = self.buffer[: self.remaining]
+
+        dtype, channels = self.format
+        n = len(self.buffer) // (channels * dtype.itemsize) * channels * dtype.itemsize
+
+        if self.remaining != None:
+            self.remaining -= n
+
+        block = toMono(np.frombuffer(self.buffer[:n], dtype=dtype).reshape(-1, channels))
+        self.buffer = self.buffer[n:]
+
+        if self.resampler:
+            block = self.resampler.process(block, final=final)
+
+        if self.bp:
+            block = self.bp.process(block)
+
+        return block
+
+
+
+@functools.lru_cache(maxsize=16384)
+def _probeAudioFile(path: str, size: int, mtime: int):
+    filetype = path.rsplit(".", 1)[-1].lower()
+
+    if filetype == "wav":
+        header = readWavHeader(path, size)
+
+        if header != None:
+            return header[4] / header[0], header[0], header[1]
+
+    if filetype in STREAMABLE_FILETYPES:
+        import soundfile as sf
+
+        try:
+            info = sf.info(path)
+
+            return info.frames / info.samplerate, info.samplerate, info.channels
+
+        except RuntimeError:
+            pass
+
+    # Other formats with librosa (uses ffmpeg or libav)
     import librosa
 
-    return int(librosa.get_duration(filename=path, sr=sample_rate))
+    return librosa.get_duration(filename=path), librosa.get_samplerate(path), None
+
+
+def getAudioInfo(path: str):
+    """Reads the duration, sample rate and number of channels of an audio file.
+
+    WAV headers are parsed directly, FLAC, OGG and AIFF headers are read with soundfile,
+    so the audio data is not decoded. Other formats fall back to librosa.
+    Results are memoized by path, size and modification time.
+
+    Args:
+        path: Path to the audio file.
+
+    Returns:
+        A tuple of (duration in seconds, sample rate, channels), channels are None if unknown.
+    """
+    stat = os.stat(path)
+
+    return _probeAudioFile(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def getAudioFileLength(path, sample_rate=48000):
+    """Returns the duration of an audio file in whole seconds.
+
+    Args:
+        path: Path to the audio file.
+        sample_rate: Unused, the duration does not depend on it.
+
+    Returns:
+        The duration in seconds, rounded down.
+    """
+    return int(getAudioInfo(path)[0])
+
 
 def get_sample_rate(path: str):
-    import librosa
-    return librosa.get_samplerate(path)
+    """Returns the native sample rate of an audio file.
+
+    Args:
+        path: Path to the audio file.
+
+    Returns:
+        The sample rate in Hz.
+    """
+    return getAudioInfo(path)[1]
 
 
 def saveSignal(sig, fname: str):
@@ -57,6 +633,26 @@ def saveSignal(sig, fname: str):
     sf.write(fname, sig, 48000, "PCM_16")
 
 
+def encodeSignal(sig, filetype: str = "wav"):
+    """Encodes a signal in the format of `saveSignal`.
+
+    Args:
+        sig: The signal to be encoded.
+        filetype: The audio format, "wav" or "flac".
+
+    Returns:
+        The encoded file as bytes.
+    """
+    import io
+
+    import soundfile as sf
+
+    buffer = io.BytesIO()
+    sf.write(buffer, sig, 48000, "PCM_16", format=filetype.upper())
+
+    return buffer.getvalue()
+
+
 def pad(sig, seconds, srate, amount=None):
     """Creates noise.
 
@@ -94,8 +690,12 @@ def pad(sig, seconds, srate, amount=None):
     return sig
 
 
-def splitSignal(sig, rate, seconds, overlap, minlen):
-    """Split signal with overlap.
+def frameSignal(sig, rate, seconds, overlap, minlen):
+    """Split signal with overlap into a frame matrix.
+
+    Frames that fit into the signal are strided views of it, so overlapping
+    frames share memory. If the last frames have to be padded, the signal is
+    copied once into a padded buffer instead.
 
     Args:
         sig: The original signal to be split.
@@ -103,24 +703,49 @@ def splitSignal(sig, rate, seconds, overlap, minlen):
         seconds: The duration of a segment.
         overlap: The overlapping seconds of segments.
         minlen: Minimum length of a split.
-    
+
     Returns:
-        A list of splits.
+        An array of shape (number of frames, frame length) with the same frames as `splitSignal`.
     """
-    sig_splits = []
+    length = int(seconds * rate)
+    step = int((seconds - overlap) * rate)
+    minlen = max(1, int(minlen * rate))
+
+    # Frames start at multiples of step, short frames are only kept as first frame
+    if len(sig) >= minlen:
+        num_frames = (len(sig) - minlen) // step + 1
+    else:
+        num_frames = min(1, len(sig))
 
-    for i in range(0, len(sig), int((seconds - overlap) * rate)):
-        split = sig[i : i + int(seconds * rate)]
+    if num_frames == 0:
+        return np.zeros((0, length), dtype=sig.dtype)
 
-        # End of signal?
-        if len(split) < int(minlen * rate) and len(sig_splits) > 0:
-            break
+    total = (num_frames - 1) * step + length
+
+    if total > len(sig):
+        # With noise, every padded frame gets its own noise
+        if cfg.USE_NOISE:
+            return np.array([pad(sig[i * step : i * step + length], seconds, rate, 0.5) for i in range(num_frames)])
 
-        split = pad(split, seconds, rate, 0.5)
+        sig = np.concatenate((sig, np.zeros(total - len(sig), dtype=sig.dtype)))
 
-        sig_splits.append(split)
+    return np.lib.stride_tricks.sliding_window_view(sig[:total], length)[::step]
 
-    return sig_splits
+
+def splitSignal(sig, rate, seconds, overlap, minlen):
+    """Split signal with overlap.
+
+    Args:
+        sig: The original signal to be split.
+        rate: The sampling rate.
+        seconds: The duration of a segment.
+        overlap: The overlapping seconds of segments.
+        minlen: Minimum length of a split.
+    
+    Returns:
+        A list of splits.
+    """
+    return list(frameSignal(sig, rate, seconds, overlap, minlen))
 
 
 def cropCenter(sig, rate, seconds):
@@ -142,36 +767,58 @@ def cropCenter(sig, rate, seconds):
 
     return sig
 
-def bandpass(sig, rate, fmin, fmax, order=5):
+def getBandpassCoefficients(rate, fmin, fmax, order=5):
+    """Designs the butterworth filter used by `bandpass`.
+
+    Args:
+        rate: The sampling rate.
+        fmin: Lower cutoff frequency.
+        fmax: Upper cutoff frequency.
+        order: The filter order.
 
+    Returns:
+        The filter coefficients (b, a) or None if no filtering is needed.
+    """
     # Check if we have to bandpass at all
     if fmin == cfg.SIG_FMIN and fmax == cfg.SIG_FMAX or fmin > fmax:
-        return sig
+        return None
 
-    from scipy.signal import butter, lfilter
+    from scipy.signal import butter
     nyquist = 0.5 * rate
 
     # Highpass?
     if fmin > cfg.SIG_FMIN and fmax == cfg.SIG_FMAX:  
         
         low = fmin / nyquist
-        b, a = butter(order, low, btype="high")
-        sig = lfilter(b, a, sig)
+        return butter(order, low, btype="high")
 
     # Lowpass?
     elif fmin == cfg.SIG_FMIN and fmax < cfg.SIG_FMAX:
 
         high = fmax / nyquist
-        b, a = butter(order, high, btype="low")
-        sig = lfilter(b, a, sig)
+        return butter(order, high, btype="low")
 
     # Bandpass?
     elif fmin > cfg.SIG_FMIN and fmax < cfg.SIG_FMAX:
 
         low = fmin / nyquist
         high = fmax / nyquist
-        b, a = butter(order, [low, high], btype="band")
-        sig = lfilter(b, a, sig)
+        return butter(order, [low, high], btype="band")
+
+    return None
+
+def bandpass(sig, rate, fmin, fmax, order=5):
+
+    coefficients = getBandpassCoefficients(rate, fmin, fmax, order)
+
+    # Check if we have to bandpass at all
+    if coefficients == None:
+        return sig
+
+    from scipy.signal import lfilter
+
+    b, a = coefficients
+    sig = lfilter(b, a, sig)
 
     return sig.astype("float32")
 
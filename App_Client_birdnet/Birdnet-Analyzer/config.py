@@ -92,6 +92,10 @@ SIGMOID_SENSITIVITY: float = 1.0
 # probabilities and needs to be adjusted)
 MIN_CONFIDENCE: float = 0.1
 
+# Maximum number of detections per segment above MIN_CONFIDENCE
+# Set 0 to keep all detections
+TOP_K: int = 0
+
 # Number of samples to process at the same time. Higher values can increase
 # processing speed, but will also increase memory usage.
 # Might only be useful for GPU inference.
@@ -103,6 +107,46 @@ BATCH_SIZE: int = 1
 # Lowering this value results in lower memory usage
 FILE_SPLITTING_DURATION: int = 600
 
+# Whether to read WAV, FLAC, OGG and AIFF files in a single sequential pass
+# Blocks of FILE_SPLITTING_DURATION seconds are decoded and resampled one after another,
+# other file types are always loaded with librosa
+STREAM_AUDIO: bool = False
+
+# Directory for cached raw predictions, None disables the cache
+# Re-runs with a different threshold, species list, sensitivity or result type
+# read the predictions from the cache instead of running the model again
+PREDICTION_CACHE_DIR: str = None
+
+# Directory for cached feature embeddings, None disables the cache
+# Entries are shared by analyze.py, embeddings.py and train.py, so trying other
+# custom classifiers on the same files only runs the classifier on the cached embeddings
+EMBEDDING_CACHE_DIR: str = None
+
+# Additional custom classifier heads that run on the embeddings of the same pass as the main output
+# Each entry holds the config values of one head, e.g. CUSTOM_CLASSIFIER, LABELS and OUTPUT_PATH
+HEADS: list[dict] = []
+
+# Audio format of extracted segments, 'wav' or 'flac'
+SEGMENT_FORMAT: str = "wav"
+
+# Number of threads per process that encode and write extracted segments
+SEGMENT_WRITER_THREADS: int = 4
+
+# Output format of embeddings, 'txt' writes one text file per audio file,
+# 'npy' writes all vectors into one memory-mappable array with an index of (file id, start, end)
+EMBEDDINGS_FORMAT: str = "txt"
+
+# Data type of the vectors in the 'npy' embeddings format, 'float16' or 'float32'
+EMBEDDINGS_DTYPE: str = "float32"
+
+# Whether to decode and predict in separate processes
+# Decoder processes hand batches to inference processes through a shared memory ring buffer
+# with PIPELINE_DEPTH slots, the TFLite threads are split between the inference processes
+PIPELINE: bool = False
+DECODE_PROCESSES: int = 2
+INFERENCE_PROCESSES: int = 1
+PIPELINE_DEPTH: int = 8
+
 # Whether to use noise to pad the signal
 # If set to False, the signal will be padded with zeros
 USE_NOISE: bool = False
@@ -140,6 +184,10 @@ TRAIN_EPOCHS: int = 50
 # Batch size for training
 TRAIN_BATCH_SIZE: int = 32
 
+# Number of training samples per embedding batch while loading the training data
+# Samples of several files are batched together
+TRAIN_EMBEDDING_BATCH_SIZE: int = 16
+
 # Validation split (percentage)
 TRAIN_VAL_SPLIT: float = 0.2
 
@@ -235,6 +283,7 @@ def getConfig():
         'APPLY_SIGMOID': APPLY_SIGMOID,
         'SIGMOID_SENSITIVITY': SIGMOID_SENSITIVITY,
         'MIN_CONFIDENCE': MIN_CONFIDENCE,
+        'TOP_K': TOP_K,
         'BATCH_SIZE': BATCH_SIZE,
         'RESULT_TYPE': RESULT_TYPE,
         'OUTPUT_FILENAME': OUTPUT_FILENAME,
@@ -246,6 +295,7 @@ def getConfig():
         'TRAIN_EPOCHS': TRAIN_EPOCHS,
         'TRAIN_VAL_SPLIT': TRAIN_VAL_SPLIT,
         'TRAIN_BATCH_SIZE': TRAIN_BATCH_SIZE,
+        'TRAIN_EMBEDDING_BATCH_SIZE': TRAIN_EMBEDDING_BATCH_SIZE,
         'TRAIN_LEARNING_RATE': TRAIN_LEARNING_RATE,
         'TRAIN_HIDDEN_UNITS': TRAIN_HIDDEN_UNITS,
         'TRAIN_DROPOUT': TRAIN_DROPOUT,
@@ -263,7 +313,19 @@ def getConfig():
         'FILE_LIST': FILE_LIST,
         'FILE_STORAGE_PATH': FILE_STORAGE_PATH,
         'SKIP_EXISTING_RESULTS': SKIP_EXISTING_RESULTS,
-        'USE_NOISE': USE_NOISE
+        'USE_NOISE': USE_NOISE,
+        'STREAM_AUDIO': STREAM_AUDIO,
+        'PIPELINE': PIPELINE,
+        'DECODE_PROCESSES': DECODE_PROCESSES,
+        'INFERENCE_PROCESSES': INFERENCE_PROCESSES,
+        'PIPELINE_DEPTH': PIPELINE_DEPTH,
+        'PREDICTION_CACHE_DIR': PREDICTION_CACHE_DIR,
+        'EMBEDDING_CACHE_DIR': EMBEDDING_CACHE_DIR,
+        'HEADS': HEADS,
+        'SEGMENT_FORMAT': SEGMENT_FORMAT,
+        'SEGMENT_WRITER_THREADS': SEGMENT_WRITER_THREADS,
+        'EMBEDDINGS_FORMAT': EMBEDDINGS_FORMAT,
+        'EMBEDDINGS_DTYPE': EMBEDDINGS_DTYPE
     }
 
 
@@ -299,6 +361,7 @@ def setConfig(c):
     global APPLY_SIGMOID
     global SIGMOID_SENSITIVITY
     global MIN_CONFIDENCE
+    global TOP_K
     global BATCH_SIZE
     global RESULT_TYPE
     global OUTPUT_FILENAME
@@ -310,6 +373,7 @@ def setConfig(c):
     global TRAIN_EPOCHS
     global TRAIN_VAL_SPLIT
     global TRAIN_BATCH_SIZE
+    global TRAIN_EMBEDDING_BATCH_SIZE
     global TRAIN_LEARNING_RATE
     global TRAIN_HIDDEN_UNITS
     global TRAIN_DROPOUT
@@ -328,6 +392,18 @@ def setConfig(c):
     global FILE_STORAGE_PATH
     global SKIP_EXISTING_RESULTS
     global USE_NOISE
+    global STREAM_AUDIO
+    global PIPELINE
+    global DECODE_PROCESSES
+    global INFERENCE_PROCESSES
+    global PIPELINE_DEPTH
+    global PREDICTION_CACHE_DIR
+    global EMBEDDING_CACHE_DIR
+    global HEADS
+    global SEGMENT_FORMAT
+    global SEGMENT_WRITER_THREADS
+    global EMBEDDINGS_FORMAT
+    global EMBEDDINGS_DTYPE
 
     RANDOM_SEED = c['RANDOM_SEED']
     MODEL_VERSION = c['MODEL_VERSION']
@@ -359,6 +435,7 @@ def setConfig(c):
     APPLY_SIGMOID = c['APPLY_SIGMOID']
     SIGMOID_SENSITIVITY = c['SIGMOID_SENSITIVITY']
     MIN_CONFIDENCE = c['MIN_CONFIDENCE']
+    TOP_K = c['TOP_K']
     BATCH_SIZE = c['BATCH_SIZE']
     RESULT_TYPE = c['RESULT_TYPE']
     OUTPUT_FILENAME = c['OUTPUT_FILENAME']
@@ -370,6 +447,7 @@ def setConfig(c):
     TRAIN_EPOCHS = c['TRAIN_EPOCHS']
     TRAIN_VAL_SPLIT = c['TRAIN_VAL_SPLIT']
     TRAIN_BATCH_SIZE = c['TRAIN_BATCH_SIZE']
+    TRAIN_EMBEDDING_BATCH_SIZE = c['TRAIN_EMBEDDING_BATCH_SIZE']
     TRAIN_LEARNING_RATE = c['TRAIN_LEARNING_RATE']
     TRAIN_HIDDEN_UNITS = c['TRAIN_HIDDEN_UNITS']
     TRAIN_DROPOUT = c['TRAIN_DROPOUT']
@@ -388,3 +466,15 @@ def setConfig(c):
     FILE_STORAGE_PATH = c['FILE_STORAGE_PATH']
     SKIP_EXISTING_RESULTS = c['SKIP_EXISTING_RESULTS']
     USE_NOISE = c['USE_NOISE']
+    STREAM_AUDIO = c['STREAM_AUDIO']
+    PIPELINE = c['PIPELINE']
+    DECODE_PROCESSES = c['DECODE_PROCESSES']
+    INFERENCE_PROCESSES = c['INFERENCE_PROCESSES']
+    PIPELINE_DEPTH = c['PIPELINE_DEPTH']
+    PREDICTION_CACHE_DIR = c['PREDICTION_CACHE_DIR']
+    EMBEDDING_CACHE_DIR = c['EMBEDDING_CACHE_DIR']
+    HEADS = c['HEADS']
+    SEGMENT_FORMAT = c['SEGMENT_FORMAT']
+    SEGMENT_WRITER_THREADS = c['SEGMENT_WRITER_THREADS']
+    EMBEDDINGS_FORMAT = c['EMBEDDINGS_FORMAT']
+    EMBEDDINGS_DTYPE = c['EMBEDDINGS_DTYPE']
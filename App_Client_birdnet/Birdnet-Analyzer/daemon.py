@@ -0,0 +1,274 @@
+"""Module to keep a warm analyzer in the background.
+
+The daemon loads the model, labels and codes once, keeps a pool of warm
+worker processes and accepts analysis jobs on a Unix socket. Jobs use the
+same arguments as analyze.py and are run one after another. Everything the
+daemon and its workers print during a job is sent back to the client.
+
+    python3 daemon.py serve --workers 4
+    python3 daemon.py submit --i example/soundscape.wav --o example/soundscape.BirdNET.results.csv --rtype csv
+"""
+
+import argparse
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "birdnet_analyzer.sock")
+
+# Arguments of a job that are paths, relative paths are resolved against the working directory of the client
+PATH_ARGS = ["i", "o", "slist", "classifier", "heads", "output_file", "cache_dir", "embedding_cache_dir"]
+
+
+class OutputWriter(io.TextIOBase):
+    """Text stream that puts everything written to it into a queue.
+
+    Text is sent line by line, so lines of different processes do not mix.
+    """
+
+    def __init__(self, output):
+        """Creates the stream.
+
+        Args:
+            output: Queue for the written text, shared with the daemon.
+        """
+        self.output = output
+        self.buffer = ""
+
+    def write(self, text: str):
+        self.buffer += text
+
+        if "\n" in self.buffer:
+            lines, self.buffer = self.buffer.rsplit("\n", 1)
+            self.output.put(lines + "\n")
+
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            self.output.put(self.buffer)
+            self.buffer = ""
+
+
+def forwardOutput(output):
+    """Sends everything a worker process prints to the daemon.
+
+    Args:
+        output: Queue for the printed text.
+    """
+    sys.stdout = OutputWriter(output)
+
+
+def warmup(config):
+    """Loads the model in a process by predicting one silent sample.
+
+    Args:
+        config: The config to use.
+    """
+    import numpy as np
+
+    import analyze
+    import config as cfg
+
+    cfg.setConfig(config)
+    analyze.predictLogits(np.zeros((1, int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE)), dtype="float32"))
+
+
+def makePathsAbsolute(args, cwd: str):
+    """Resolves the relative paths of a job.
+
+    The daemon keeps its own working directory, so jobs of different clients do not interfere.
+
+    Args:
+        args: The parsed arguments of the job.
+        cwd: Working directory of the client.
+    """
+    for name in PATH_ARGS:
+        value = getattr(args, name, None)
+
+        if isinstance(value, list):
+            setattr(args, name, [os.path.join(cwd, v) for v in value])
+        elif value:
+            setattr(args, name, os.path.join(cwd, value))
+
+
+def serve(socket_path: str, threads: int):
+    """Runs the daemon until a stop request is received.
+
+    Args:
+        socket_path: Path of the Unix socket.
+        threads: Number of worker processes.
+    """
+    import contextlib
+    import datetime
+    import socketserver
+    import threading
+    from multiprocessing import Pool, SimpleQueue
+
+    import analyze
+    import config as cfg
+    import utils
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    defaults = cfg.getConfig()
+    parser = analyze.getArgumentParser()
+
+    # Load labels and codes with the default arguments
+    analyze.setConfigFromArgs(parser.parse_args([]), script_dir)
+    config = cfg.getConfig()
+
+    # Printed text of the daemon and its workers, a None marks the end of a job
+    output = SimpleQueue()
+    sink = {"log": sys.stdout}
+    flushed = threading.Event()
+
+    def collectOutput():
+        while True:
+            text = output.get()
+
+            if text == None:
+                flushed.set()
+            else:
+                sink["log"].write(text)
+
+    threading.Thread(target=collectOutput, daemon=True).start()
+
+    # Start workers before the model is loaded here, forked processes must not share interpreters
+    pool = Pool(threads, initializer=forwardOutput, initargs=(output,))
+    pool.map(warmup, [config] * threads)
+    warmup(config)
+
+    print(f"BirdNET daemon listening on {socket_path} with {threads} workers", flush=True)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+
+            # Connections without a request only check that the daemon is running
+            if not line:
+                return
+
+            request = json.loads(line)
+
+            if request.get("command") == "stop":
+                self.wfile.write(json.dumps({"ok": True}).encode("utf-8") + b"\n")
+                self.server.running = False
+                return
+
+            start_time = datetime.datetime.now()
+            log = io.StringIO()
+            response = {"ok": True}
+
+            writer = OutputWriter(output)
+            sink["log"] = log
+
+            try:
+                # Prints go through the queue as well, so they stay in order with the prints of the workers
+                with contextlib.redirect_stdout(writer):
+                    # Every job starts from the defaults, labels and codes are re-read from disk
+                    cfg.setConfig(defaults)
+                    args = parser.parse_args(request.get("argv", []))
+                    makePathsAbsolute(args, request.get("cwd", script_dir))
+                    analyze.setConfigFromArgs(args, script_dir)
+                    response["status"] = analyze.runAnalysis(args.append_output, pool)
+
+            except SystemExit:
+                response = {"ok": False, "error": "Invalid arguments."}
+
+            except Exception as ex:
+                utils.writeErrorLog(ex)
+                response = {"ok": False, "error": str(ex)}
+
+            # Wait until all text of the job is collected, puts are done once the workers return
+            writer.flush()
+            flushed.clear()
+            output.put(None)
+            flushed.wait()
+            sink["log"] = sys.stdout
+
+            response["log"] = log.getvalue()
+            response["time"] = (datetime.datetime.now() - start_time).total_seconds()
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socketserver.UnixStreamServer(socket_path, Handler)
+    server.running = True
+
+    try:
+        while server.running:
+            server.handle_request()
+
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        pool.terminate()
+
+
+def request(socket_path: str, message: dict):
+    """Sends a request to the daemon and waits for the response.
+
+    Args:
+        socket_path: Path of the Unix socket.
+        message: The request.
+
+    Returns:
+        The response of the daemon.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def submit(socket_path: str, argv: list[str]):
+    """Submits an analysis job to the daemon.
+
+    Args:
+        socket_path: Path of the Unix socket.
+        argv: Arguments of the job, same as for analyze.py.
+
+    Returns:
+        The `True` if all files were analyzed successfully.
+    """
+    response = request(socket_path, {"argv": argv, "cwd": os.getcwd()})
+
+    print(response.get("log", ""), end="", flush=True)
+
+    if not response["ok"]:
+        print(f"Error: {response['error']}", flush=True)
+        return False
+
+    failed = [f for f, ok in response["status"].items() if not ok]
+
+    print(f"Analyzed {len(response['status'])} files in {response['time']:.2f} seconds, {len(failed)} failed.", flush=True)
+
+    return not failed
+
+
+if __name__ == "__main__":
+    # Parse arguments, all unknown arguments of submit are passed to the analysis
+    parser = argparse.ArgumentParser(description="Keep a warm BirdNET analyzer in the background.", allow_abbrev=False)
+    parser.add_argument("command", choices=["serve", "submit", "stop"], help="Start the daemon, submit a job or stop the daemon.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"Path of the Unix socket. Defaults to '{DEFAULT_SOCKET}'.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes of the daemon. Defaults to 4.")
+
+    args, job_args = parser.parse_known_args()
+
+    if args.command == "serve":
+        serve(args.socket, max(1, args.workers))
+    elif args.command == "stop":
+        request(args.socket, {"command": "stop"})
+    else:
+        sys.exit(0 if submit(args.socket, job_args) else 1)
+
+    # A few examples to test
+    # python3 daemon.py serve --workers 4
+    # python3 daemon.py submit --i example/ --o example/ --slist example/ --min_conf 0.5 --threads 4
+    # python3 daemon.py stop
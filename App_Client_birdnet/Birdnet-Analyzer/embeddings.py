@@ -2,7 +2,10 @@
 """
 import argparse
 import datetime
+import glob
+import json
 import os
+import shutil
 import sys
 from multiprocessing import Pool
 
@@ -32,20 +35,162 @@ def saveAsEmbeddingsFile(results: dict[str], fpath: str):
             f.write(timestamp.replace("-", "\t") + "\t" + ",".join(map(str, results[timestamp])) + "\n")
 
 
+# Record of the index of the binary embeddings store
+INDEX_DTYPE = np.dtype([("file_id", "<u4"), ("start", "<f8"), ("end", "<f8")])
+
+
+def getStorePrefix(output_path: str):
+    """Returns the common path prefix of the files of the binary embeddings store.
+
+    Args:
+        output_path: Output folder or path of the vectors file.
+
+    Returns:
+        The prefix for the vectors (.npy), index (.index.npy), manifest (.json) and shards (.shards/).
+    """
+    if output_path.lower().endswith(".npy"):
+        return output_path[:-4]
+
+    return os.path.join(output_path, "BirdNET_embeddings")
+
+
+def appendToShard(shard_dir: str, file_id: int, embeddings, timestamps: list):
+    """Appends the embeddings of a file to the shard of this process.
+
+    Every process writes its own shard, so no locking is needed.
+
+    Args:
+        shard_dir: Folder of the shards.
+        file_id: Index of the audio file in the file list.
+        embeddings: Array of the embeddings.
+        timestamps: List of [start, end] for each embedding.
+    """
+    index = np.zeros(len(timestamps), dtype=INDEX_DTYPE)
+    index["file_id"] = file_id
+    index["start"], index["end"] = np.array(timestamps, dtype="float64").reshape(-1, 2).T
+
+    shard = os.path.join(shard_dir, str(os.getpid()))
+
+    # Vectors first, so the index never points past the end of the vectors
+    with open(shard + ".bin", "ab") as f:
+        f.write(np.ascontiguousarray(embeddings, dtype=cfg.EMBEDDINGS_DTYPE).tobytes())
+
+    with open(shard + ".idx", "ab") as f:
+        f.write(index.tobytes())
+
+
+def mergeShards(prefix: str, files: list[str]):
+    """Merges the shards into the binary embeddings store.
+
+    Args:
+        prefix: Path prefix of the store.
+        files: List of audio file paths, the position is the file id.
+    """
+    dtype = np.dtype(cfg.EMBEDDINGS_DTYPE)
+    shards = [s[:-4] for s in sorted(glob.glob(os.path.join(prefix + ".shards", "*.idx")))]
+    indices = [np.fromfile(s + ".idx", dtype=INDEX_DTYPE) for s in shards]
+    count = sum(len(i) for i in indices)
+    dim = next((os.path.getsize(s + ".bin") // dtype.itemsize // len(i) for s, i in zip(shards, indices) if len(i)), 0)
+
+    # Copy all shards into one array, block by block
+    if count > 0:
+        vectors = np.lib.format.open_memmap(prefix + ".npy", mode="w+", dtype=dtype, shape=(count, dim))
+        row = 0
+
+        for s, i in zip(shards, indices):
+            data = np.memmap(s + ".bin", dtype=dtype, mode="r", shape=(len(i), dim)) if len(i) else []
+
+            for start in range(0, len(i), 65536):
+                block = data[start : start + 65536]
+                vectors[row : row + len(block)] = block
+                row += len(block)
+
+            del data
+
+        vectors.flush()
+        del vectors
+    else:
+        np.save(prefix + ".npy", np.zeros((0, dim), dtype=dtype))
+
+    np.save(prefix + ".index.npy", np.concatenate(indices) if indices else np.zeros(0, dtype=INDEX_DTYPE))
+
+    manifest = {
+        "vectors": os.path.basename(prefix) + ".npy",
+        "index": os.path.basename(prefix) + ".index.npy",
+        "dtype": dtype.name,
+        "dim": dim,
+        "count": count,
+        "files": files,
+        "params": {"overlap": cfg.SIG_OVERLAP, "fmin": cfg.BANDPASS_FMIN, "fmax": cfg.BANDPASS_FMAX},
+    }
+
+    with open(prefix + ".json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(prefix + ".shards")
+
+
+def loadEmbeddingsStore(path: str):
+    """Opens a binary embeddings store without reading the vectors.
+
+    Args:
+        path: Path to the manifest (.json) or the output folder of the extraction.
+
+    Returns:
+        A tuple of (vectors, index, files). The vectors are memory-mapped with shape (count, dim),
+        the index holds (file_id, start, end) for each vector and file ids are positions in files.
+    """
+    if not path.lower().endswith(".json"):
+        path = getStorePrefix(path) + ".json"
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    folder = os.path.dirname(path)
+    vectors = np.load(os.path.join(folder, manifest["vectors"]), mmap_mode="r" if manifest["count"] else None)
+    index = np.load(os.path.join(folder, manifest["index"]))
+
+    return vectors, index, manifest["files"]
+
+
+def getFileBatches(fpath: str):
+    """Reads a file in batches with the timestamps of the embeddings.
+
+    Without streaming, framing restarts at every FILE_SPLITTING_DURATION window,
+    so the timestamps of each window start at its offset.
+
+    Args:
+        fpath: Path to the audio file.
+
+    Yields:
+        Tuples of (samples, timestamps) with up to BATCH_SIZE entries.
+    """
+    if cfg.STREAM_AUDIO and audio.isStreamable(fpath):
+        yield from analyze.getBatches(analyze.getRawAudioChunks(fpath))
+        return
+
+    offset = 0
+    end = audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE)
+
+    while offset < end:
+        yield from analyze.getBatches(analyze.getRawAudioFromFile(fpath, offset, cfg.FILE_SPLITTING_DURATION), offset)
+
+        offset = offset + cfg.FILE_SPLITTING_DURATION
+
+
 def analyzeFile(item):
     """Extracts the embeddings for a file.
 
     Args:
-        item: (filepath, config)
+        item: (filepath, config, file id)
     """
     # Get file path and restore cfg
     fpath: str = item[0]
     cfg.setConfig(item[1])
 
-    offset = 0
-    duration = cfg.FILE_SPLITTING_DURATION
-    fileLengthSeconds = audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE)
     results = {}
+    vectors = []
+    vector_timestamps = []
 
     # Start time
     start_time = datetime.datetime.now()
@@ -53,31 +198,31 @@ def analyzeFile(item):
     # Status
     print(f"Analyzing {fpath}", flush=True)
 
-    # Process each chunk
+    # Process each batch
     try:
-        while offset < fileLengthSeconds:
-            chunks = analyze.getRawAudioFromFile(fpath, offset, duration)
-            start, end = offset, cfg.SIG_LENGTH + offset
-            samples = []
-            timestamps = []
-
-            for c in range(len(chunks)):
-                # Add to batch
-                samples.append(chunks[c])
-                timestamps.append([start, end])
-
-                # Advance start and end
-                start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
-                end = start + cfg.SIG_LENGTH
-
-                # Check if batch is full or last chunk
-                if len(samples) < cfg.BATCH_SIZE and c < len(chunks) - 1:
-                    continue
+        # Read the shards of the file from the shared cache
+        if cfg.EMBEDDING_CACHE_DIR:
+            for shard in analyze.getFileShards(fpath):
+                e, segments = analyze.getCachedEmbeddings(fpath, *shard)
+
+                if cfg.EMBEDDINGS_FORMAT == "npy":
+                    vectors.append(e)
+                    vector_timestamps.extend([float(t) for t in s.split("-")] for s in segments)
+                else:
+                    results.update(zip(segments, e))
 
+        else:
+            for samples, timestamps in getFileBatches(fpath):
                 # Prepare sample and pass through model
                 data = np.array(samples, dtype="float32")
                 e = model.embeddings(data)
 
+                # Keep the batch for the binary store
+                if cfg.EMBEDDINGS_FORMAT == "npy":
+                    vectors.append(e)
+                    vector_timestamps.extend(timestamps)
+                    continue
+
                 # Add to results
                 for i in range(len(samples)):
                     # Get timestamp
@@ -89,12 +234,6 @@ def analyzeFile(item):
                     # Store embeddings
                     results[f"{s_start}-{s_end}"] = embeddings
 
-                # Reset batch
-                samples = []
-                timestamps = []
-            
-            offset = offset + duration
-
     except Exception as ex:
         # Write error log
         print(f"Error: Cannot analyze audio file {fpath}.", flush=True)
@@ -104,8 +243,11 @@ def analyzeFile(item):
 
     # Save as embeddings file
     try:
-        # We have to check if output path is a file or directory
-        if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
+        # Binary store or text files? For text files, we have to check if output path is a file or directory
+        if cfg.EMBEDDINGS_FORMAT == "npy":
+            shard_dir = getStorePrefix(cfg.OUTPUT_PATH) + ".shards"
+            appendToShard(shard_dir, item[2], np.concatenate(vectors) if vectors else [], vector_timestamps)
+        elif not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
             fpath = fpath.replace(cfg.INPUT_PATH, "")
             fpath = fpath[1:] if fpath[0] in ["/", "\\"] else fpath
 
@@ -156,6 +298,28 @@ if __name__ == "__main__":
         default=cfg.SIG_FMAX, 
         help="Maximum frequency for bandpass filter in Hz. Defaults to {} Hz.".format(cfg.SIG_FMAX)
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Decode WAV, FLAC, OGG and AIFF files in a single sequential pass. Defaults to False.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory for cached feature embeddings, shared with analyze.py and train.py. Defaults to None (no cache).",
+    )
+    parser.add_argument(
+        "--format",
+        default="txt",
+        choices=["txt", "npy"],
+        help="Output format. 'txt' writes one text file per audio file, 'npy' writes one memory-mappable array of all embeddings with an index. Defaults to 'txt'.",
+    )
+    parser.add_argument(
+        "--dtype",
+        default="float32",
+        choices=["float16", "float32"],
+        help="Data type of the embeddings in the 'npy' format. Defaults to 'float32'.",
+    )
 
     args = parser.parse_args()
 
@@ -175,6 +339,9 @@ if __name__ == "__main__":
     else:
         cfg.FILE_LIST = [cfg.INPUT_PATH]
 
+    # Set streaming mode
+    cfg.STREAM_AUDIO = args.stream
+
     # Set overlap
     cfg.SIG_OVERLAP = max(0.0, min(2.9, float(args.overlap)))
 
@@ -193,11 +360,25 @@ if __name__ == "__main__":
     # Set batch size
     cfg.BATCH_SIZE = max(1, int(args.batchsize))
 
+    # Set embedding cache
+    cfg.EMBEDDING_CACHE_DIR = args.cache_dir
+
+    # Set output format
+    cfg.EMBEDDINGS_FORMAT = args.format
+    cfg.EMBEDDINGS_DTYPE = args.dtype
+
+    if cfg.EMBEDDINGS_FORMAT == "npy":
+        shard_dir = getStorePrefix(cfg.OUTPUT_PATH) + ".shards"
+
+        # Remove shards of an interrupted run
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.makedirs(shard_dir)
+
     # Add config items to each file list entry.
     # We have to do this for Windows which does not
     # support fork() and thus each process has to
     # have its own config. USE LINUX!
-    flist = [(f, cfg.getConfig()) for f in cfg.FILE_LIST]
+    flist = [(f, cfg.getConfig(), i) for i, f in enumerate(cfg.FILE_LIST)]
 
     # Analyze files
     if cfg.CPU_THREADS < 2:
@@ -207,6 +388,12 @@ if __name__ == "__main__":
         with Pool(cfg.CPU_THREADS) as p:
             p.map(analyzeFile, flist)
 
+    # Merge the shards of all processes
+    if cfg.EMBEDDINGS_FORMAT == "npy":
+        files = [os.path.relpath(f, cfg.INPUT_PATH) if os.path.isdir(cfg.INPUT_PATH) else f for f in cfg.FILE_LIST]
+        mergeShards(getStorePrefix(cfg.OUTPUT_PATH), files)
+
     # A few examples to test
     # python3 embeddings.py --i example/ --o example/ --threads 4
     # python3 embeddings.py --i example/soundscape.wav --o example/soundscape.birdnet.embeddings.txt --threads 4
+    # python3 embeddings.py --i example/ --o example/ --threads 4 --format npy --dtype float16
@@ -1,6 +1,7 @@
 """Contains functions to use the BirdNET models.
 """
 import os
+import threading
 import warnings
 
 import numpy as np
@@ -30,6 +31,13 @@ M_INTERPRETER: tflite.Interpreter = None
 PBMODEL = None
 C_PBMODEL = None
 
+# Path of the loaded custom classifier, the classifier is reloaded when the config points to another one
+C_CLASSIFIER: str = None
+
+# Interpreters with a fixed input shape, keyed by (model path, sample shape, batch size)
+INTERPRETER_POOL: dict[tuple, tflite.Interpreter] = {}
+INTERPRETER_POOL_LOCK = threading.Lock()
+
 
 def loadModel(class_output=True):
     """Initializes the BirdNET Model.
@@ -75,6 +83,12 @@ def loadCustomClassifier():
     global C_OUTPUT_LAYER_INDEX
     global C_INPUT_SIZE
     global C_PBMODEL
+    global C_CLASSIFIER
+
+    # Drop the previous classifier
+    C_INTERPRETER = None
+    C_PBMODEL = None
+    C_CLASSIFIER = cfg.CUSTOM_CLASSIFIER
 
     if cfg.CUSTOM_CLASSIFIER.endswith(".tflite"):
         # Load TFLite model and allocate tensors.
@@ -100,6 +114,76 @@ def loadCustomClassifier():
         C_PBMODEL = tf.saved_model.load(cfg.CUSTOM_CLASSIFIER)
 
 
+def getInterpreter(model_path: str, sample_shape: tuple, batch_size: int):
+    """Returns an interpreter for a batch shape.
+
+    Interpreters are cached by their input shape, so tensors are only allocated once per shape.
+    The smallest cached interpreter that fits the batch is used, new interpreters
+    are created for at least BATCH_SIZE samples.
+
+    Args:
+        model_path: Path to the TFLite model.
+        sample_shape: Shape of a single sample.
+        batch_size: Number of samples in the batch.
+
+    Returns:
+        A TFLite interpreter with allocated tensors.
+    """
+    # Threads of the same process share the pool
+    with INTERPRETER_POOL_LOCK:
+        # Smallest cached batch size that fits
+        sizes = [k[2] for k in INTERPRETER_POOL if k[0] == model_path and k[1] == sample_shape and k[2] >= batch_size]
+
+        if sizes:
+            return INTERPRETER_POOL[(model_path, sample_shape, min(sizes))]
+
+        batch_size = max(batch_size, cfg.BATCH_SIZE)
+
+        # Load TFLite model and allocate tensors with a fixed batch size
+        interpreter = tflite.Interpreter(model_path=model_path, num_threads=cfg.TFLITE_THREADS)
+        interpreter.resize_tensor_input(interpreter.get_input_details()[0]["index"], [batch_size, *sample_shape])
+        interpreter.allocate_tensors()
+
+        INTERPRETER_POOL[(model_path, sample_shape, batch_size)] = interpreter
+
+    return interpreter
+
+
+def runInterpreter(model_path: str, sample, output_offset=0):
+    """Passes a batch through a pooled interpreter.
+
+    Batches that are smaller than the interpreter input are padded with zeros.
+
+    Args:
+        model_path: Path to the TFLite model.
+        sample: Batch of samples.
+        output_offset: Offset of the output tensor index, 1 returns the feature embeddings.
+            A tuple of offsets returns several outputs of the same pass.
+
+    Returns:
+        The output for each sample of the batch, or a tuple of outputs.
+    """
+    sample = np.asarray(sample, dtype="float32")
+    num_samples = len(sample)
+    interpreter = getInterpreter(model_path, sample.shape[1:], num_samples)
+    input_details = interpreter.get_input_details()[0]
+    batch_size = input_details["shape"][0]
+
+    # Pad short batch
+    if batch_size > num_samples:
+        sample = np.concatenate((sample, np.zeros((batch_size - num_samples, *sample.shape[1:]), dtype="float32")))
+
+    interpreter.set_tensor(input_details["index"], sample)
+    interpreter.invoke()
+
+    output_index = interpreter.get_output_details()[0]["index"]
+
+    if isinstance(output_offset, tuple):
+        return tuple(interpreter.get_tensor(output_index - offset)[:num_samples] for offset in output_offset)
+
+    return interpreter.get_tensor(output_index - output_offset)[:num_samples]
+
+
 def loadMetaModel():
     """Loads the model for species prediction.
 
@@ -465,6 +549,19 @@ def predictFilter(lat, lon, week):
     return M_INTERPRETER.get_tensor(M_OUTPUT_LAYER_INDEX)[0]
 
 
+def predictFilterBatch(samples):
+    """Predicts the probability for each species at many locations at once.
+
+    Args:
+        samples: List of (lat, lon, week).
+
+    Returns:
+        An array with the probabilities for all species at each location.
+    """
+    # Run inference in a pooled interpreter that is resized to the number of locations
+    return runInterpreter(cfg.MDATA_MODEL_PATH, np.array(samples, dtype="float32").reshape(-1, 3))
+
+
 def explore(lat: float, lon: float, week: int):
     """Predicts the species list.
 
@@ -536,25 +633,17 @@ def predict(sample):
     if cfg.CUSTOM_CLASSIFIER != None:
         return predictWithCustomClassifier(sample)
 
-    global INTERPRETER
-
-    # Does interpreter or keras model exist?
-    if INTERPRETER == None and PBMODEL == None:
-        loadModel()
-
-    if PBMODEL == None:
-        # Reshape input tensor
-        INTERPRETER.resize_tensor_input(INPUT_LAYER_INDEX, [len(sample), *sample[0].shape])
-        INTERPRETER.allocate_tensors()
+    global PBMODEL
 
+    if cfg.MODEL_PATH.endswith(".tflite"):
         # Make a prediction (Audio only for now)
-        INTERPRETER.set_tensor(INPUT_LAYER_INDEX, np.array(sample, dtype="float32"))
-        INTERPRETER.invoke()
-        prediction = INTERPRETER.get_tensor(OUTPUT_LAYER_INDEX)
-
-        return prediction
+        return runInterpreter(cfg.MODEL_PATH, sample)
 
     else:
+        # Does keras model exist?
+        if PBMODEL == None:
+            loadModel()
+
         # Make a prediction (Audio only for now)
         prediction = PBMODEL.basic(sample)["scores"]
 
@@ -574,29 +663,56 @@ def predictWithCustomClassifier(sample):
     global C_INPUT_SIZE
     global C_PBMODEL
 
-    # Does interpreter exist?
-    if C_INTERPRETER == None and C_PBMODEL == None:
+    # Is the configured classifier loaded?
+    if C_CLASSIFIER != cfg.CUSTOM_CLASSIFIER:
         loadCustomClassifier()
 
     if C_PBMODEL == None:
-        vector = embeddings(sample) if C_INPUT_SIZE != 144000 else sample
-
-        # Reshape input tensor
-        C_INTERPRETER.resize_tensor_input(C_INPUT_LAYER_INDEX, [len(vector), *vector[0].shape])
-        C_INTERPRETER.allocate_tensors()
+        if C_INPUT_SIZE != 144000:
+            return classifyEmbeddings(embeddings(sample))
 
         # Make a prediction
-        C_INTERPRETER.set_tensor(C_INPUT_LAYER_INDEX, np.array(vector, dtype="float32"))
-        C_INTERPRETER.invoke()
-        prediction = C_INTERPRETER.get_tensor(C_OUTPUT_LAYER_INDEX)
-
-        return prediction
+        return runInterpreter(cfg.CUSTOM_CLASSIFIER, sample)
     else:
         prediction = C_PBMODEL.basic(sample)["scores"]
 
         return prediction
 
 
+def classifierUsesEmbeddings():
+    """Checks if the custom classifier is a TFLite head on top of the feature embeddings.
+
+    Returns:
+        True if the custom classifier predicts from embeddings instead of audio.
+    """
+    if cfg.CUSTOM_CLASSIFIER == None or not cfg.CUSTOM_CLASSIFIER.endswith(".tflite"):
+        return False
+
+    if C_CLASSIFIER != cfg.CUSTOM_CLASSIFIER:
+        loadCustomClassifier()
+
+    return C_INPUT_SIZE != 144000
+
+
+def classifyEmbeddings(vector, classifier: str = None):
+    """Uses the custom classifier to make a prediction from feature embeddings.
+
+    Args:
+        vector: The embeddings of the samples.
+        classifier: Path to a TFLite classifier head, None uses the custom classifier.
+
+    Returns:
+        The prediction scores for the samples.
+    """
+    if classifier != None:
+        return runInterpreter(classifier, vector)
+
+    if C_CLASSIFIER != cfg.CUSTOM_CLASSIFIER:
+        loadCustomClassifier()
+
+    return runInterpreter(cfg.CUSTOM_CLASSIFIER, vector)
+
+
 def embeddings(sample):
     """Extracts the embeddings for a sample.
 
@@ -606,19 +722,28 @@ def embeddings(sample):
     Returns:
         The embeddings.
     """
-    global INTERPRETER
+    # Extract feature embeddings
+    return runInterpreter(cfg.MODEL_PATH, sample, output_offset=1)
 
-    # Does interpreter exist?
-    if INTERPRETER == None:
-        loadModel(False)
 
-    # Reshape input tensor
-    INTERPRETER.resize_tensor_input(INPUT_LAYER_INDEX, [len(sample), *sample[0].shape])
-    INTERPRETER.allocate_tensors()
+def predictWithEmbeddings(sample):
+    """Predicts a sample and extracts its embeddings.
 
-    # Extract feature embeddings
-    INTERPRETER.set_tensor(INPUT_LAYER_INDEX, np.array(sample, dtype="float32"))
-    INTERPRETER.invoke()
-    features = INTERPRETER.get_tensor(OUTPUT_LAYER_INDEX)
+    With the TFLite model, scores and embeddings are read from the same pass through the net.
+
+    Args:
+        sample: Audio samples.
+
+    Returns:
+        A tuple of (prediction scores, embeddings).
+    """
+    if cfg.CUSTOM_CLASSIFIER == None and cfg.MODEL_PATH.endswith(".tflite"):
+        return runInterpreter(cfg.MODEL_PATH, sample, output_offset=(0, 1))
+
+    e = embeddings(sample)
+
+    # Embedding based classifiers only need the embeddings
+    if classifierUsesEmbeddings():
+        return classifyEmbeddings(e), e
 
-    return features
+    return predict(sample), e
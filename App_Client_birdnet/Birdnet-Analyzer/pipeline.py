@@ -0,0 +1,354 @@
+"""Module to run the analysis as a decode/inference pipeline.
+
+Decoder processes read, resample, bandpass and split the audio and write the
+batches into the slots of a shared memory ring buffer. Inference processes
+predict the batches from the ring buffer and send the detections back to the
+parent, which saves the results of a file once all of its batches are done.
+"""
+
+import datetime
+import queue
+import time
+from multiprocessing import Process, Queue
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import analyze
+import config as cfg
+import utils
+
+
+class RingBuffer:
+    """Fixed number of equally sized float32 batch slots in shared memory.
+
+    The slots are handed out through a queue of free slot indices,
+    so each slot is owned by exactly one process at a time.
+    """
+
+    def __init__(self, slots: int, batch_size: int, sample_length: int, name: str = None):
+        """Creates or attaches to the ring buffer.
+
+        Args:
+            slots: Number of slots.
+            batch_size: Maximum number of samples per slot.
+            sample_length: Number of audio samples per sample.
+            name: Name of an existing ring buffer to attach to, None creates a new one.
+        """
+        self.shape = (slots, batch_size, sample_length)
+        size = int(np.prod(self.shape)) * np.dtype(np.float32).itemsize
+
+        if name == None:
+            self.shm = SharedMemory(create=True, size=size)
+        else:
+            self.shm = SharedMemory(name=name)
+
+        self.name = self.shm.name
+        self.slots = np.ndarray(self.shape, dtype=np.float32, buffer=self.shm.buf)
+
+    def write(self, slot: int, samples):
+        """Copies a batch into a slot.
+
+        Args:
+            slot: Slot index.
+            samples: List of samples.
+        """
+        self.slots[slot, : len(samples)] = samples
+
+    def read(self, slot: int, count: int):
+        """Returns a view of the first samples of a slot.
+
+        Args:
+            slot: Slot index.
+            count: Number of samples.
+
+        Returns:
+            The samples, valid until the slot is released.
+        """
+        return self.slots[slot, :count]
+
+    def close(self, unlink: bool = False):
+        """Detaches from the ring buffer.
+
+        Args:
+            unlink: Whether to also free the shared memory.
+        """
+        self.slots = None
+        self.shm.close()
+
+        if unlink:
+            self.shm.unlink()
+
+
+def decodeWorker(config, ring_args, tasks: Queue, free: Queue, ready: Queue, results: Queue):
+    """Decodes shards into the ring buffer.
+
+    The parent is sent a ("shard", file path, number of batches, success, start time) message per shard.
+
+    Args:
+        config: The config of the parent.
+        ring_args: Arguments to attach to the ring buffer.
+        tasks: Queue of (file path, shard, file hash or None), None stops the worker.
+        free: Queue of free slot indices.
+        ready: Queue of (slot, sample count, file path, timestamps) to predict.
+        results: Queue of messages to the parent.
+    """
+    cfg.setConfig(config)
+    ring = RingBuffer(*ring_args)
+    busy = wait = 0.0
+
+    while True:
+        t = time.perf_counter()
+        task = tasks.get()
+        wait += time.perf_counter() - t
+
+        if task == None:
+            break
+
+        fpath, (offset, duration, num_chunks), digest = task
+        shard_start = datetime.datetime.now()
+
+        if digest != None:
+            utils.setFileHash(fpath, digest)
+        num_batches = 0
+        ok = True
+
+        # Status
+        if offset == 0:
+            print(f"Analyzing {fpath}", flush=True)
+
+        t = time.perf_counter()
+        shard_wait = 0.0
+
+        try:
+            # Cached shards skip the inference stage
+            cached = analyze.loadCachedPredictions(fpath, offset, duration, num_chunks) if cfg.PREDICTION_CACHE_DIR else None
+
+            # Cached embeddings only need the custom classifier
+            if cached == None and analyze.usesEmbeddingCache():
+                e = analyze.loadCachedEmbeddings(fpath, offset, duration, num_chunks)
+                cached = analyze.classifyEmbeddings(*e) if e != None else None
+
+            if cached != None:
+                results.put(("batch", fpath, analyze.getCachedResults(*cached)))
+                num_batches += 1
+            else:
+                for samples, timestamps in analyze.getShardBatches(fpath, offset, duration, num_chunks):
+                    # Wait for a free slot
+                    t_wait = time.perf_counter()
+                    slot = free.get()
+                    shard_wait += time.perf_counter() - t_wait
+
+                    ring.write(slot, samples)
+                    ready.put((slot, len(samples), fpath, timestamps))
+                    num_batches += 1
+
+        except Exception as ex:
+            # Write error log
+            print(f"Error: Cannot analyze audio file {fpath} at {offset:.1f}s.\n", flush=True)
+            utils.writeErrorLog(ex)
+            ok = False
+
+        busy += time.perf_counter() - t - shard_wait
+        wait += shard_wait
+        results.put(("shard", fpath, num_batches, ok, shard_start))
+
+    ring.close()
+    results.put(("stats", "decode", busy, wait))
+
+
+def inferenceWorker(config, ring_args, free: Queue, ready: Queue, results: Queue):
+    """Predicts batches from the ring buffer.
+
+    Args:
+        config: The config of the parent.
+        ring_args: Arguments to attach to the ring buffer.
+        free: Queue of free slot indices.
+        ready: Queue of (slot, sample count, file path, timestamps) to predict, None stops the worker.
+        results: Queue of messages to the parent.
+    """
+    cfg.setConfig(config)
+    ring = RingBuffer(*ring_args)
+    label_table = analyze.getLabelTable()
+    busy = wait = 0.0
+
+    while True:
+        t = time.perf_counter()
+        item = ready.get()
+        wait += time.perf_counter() - t
+
+        if item == None:
+            break
+
+        slot, count, fpath, timestamps = item
+        t = time.perf_counter()
+
+        # Every batch gets a message, even if it fails, otherwise the parent waits for it forever
+        try:
+            p = analyze.predict(ring.read(slot, count))
+            detections = analyze.getDetections(p, cfg.MIN_CONFIDENCE, cfg.TOP_K, label_table.species_mask)
+            detections = {str(s_start) + "-" + str(s_end): d for (s_start, s_end), d in zip(timestamps, detections)}
+
+        except Exception as ex:
+            # Write error log
+            print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
+            utils.writeErrorLog(ex)
+            detections = None
+
+        finally:
+            free.put(slot)
+
+        busy += time.perf_counter() - t
+        results.put(("batch", fpath, detections))
+
+    ring.close()
+    results.put(("stats", "inference", busy, wait))
+
+
+def printUtilisation(stats: dict[str, list]):
+    """Prints the share of time each stage spent working instead of waiting.
+
+    Args:
+        stats: Dictionary with {stage: [(busy, wait), ...]}.
+    """
+    for stage, values in stats.items():
+        busy = sum(v[0] for v in values)
+        total = busy + sum(v[1] for v in values)
+        utilisation = 100 * busy / total if total > 0 else 0
+
+        print(f"{stage.capitalize()} stage: {len(values)} workers, {utilisation:.1f}% utilisation, {busy:.2f}s busy", flush=True)
+
+
+def getDeadWorkers(workers: list[Process]):
+    """Returns the workers that exited with an error.
+
+    Args:
+        workers: The worker processes.
+
+    Returns:
+        A list of the workers with a non-zero exit code.
+    """
+    return [w for w in workers if w.exitcode not in [None, 0]]
+
+
+def analyzeFilesPipelined(files: list[str], decoders: int, inference_workers: int, depth: int):
+    """Analyzes files with separate decoder and inference processes.
+
+    If a worker dies, the files that are not done yet are marked as failed and the run is stopped.
+
+    Args:
+        files: List of audio files.
+        decoders: Number of decoder processes.
+        inference_workers: Number of inference processes.
+        depth: Number of batches that can be decoded ahead of the inference.
+
+    Returns:
+        A dictionary with {file path: `True` if the file was analyzed successfully}.
+    """
+    shards, status, hashes = analyze.planShards(files)
+
+    if not shards:
+        return status
+
+    config = cfg.getConfig()
+    pending = {
+        fpath: {"shards": len(s), "batches": 0, "done": 0, "results": {}, "failed": False, "start": None}
+        for fpath, s in shards.items()
+    }
+    stats = {"decode": [], "inference": []}
+
+    ring = RingBuffer(depth, cfg.BATCH_SIZE, int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE))
+    ring_args = (*ring.shape, ring.name)
+    tasks, free, ready, results = Queue(), Queue(), Queue(), Queue()
+
+    for slot in range(depth):
+        free.put(slot)
+
+    for fpath, s in shards.items():
+        for shard in s:
+            tasks.put((fpath, shard, hashes[fpath]))
+
+    for _ in range(decoders):
+        tasks.put(None)
+
+    workers = [Process(target=decodeWorker, args=(config, ring_args, tasks, free, ready, results)) for _ in range(decoders)]
+    workers += [Process(target=inferenceWorker, args=(config, ring_args, free, ready, results)) for _ in range(inference_workers)]
+
+    for w in workers:
+        w.start()
+
+    try:
+        while pending:
+            try:
+                message = results.get(timeout=1)
+
+            except queue.Empty:
+                # A dead worker never reports its shards or batches, so the remaining files could wait forever
+                if getDeadWorkers(workers) or not any(w.is_alive() for w in workers):
+                    print("Error: A pipeline worker exited before the analysis was done.", flush=True)
+
+                    for fpath in pending:
+                        status[fpath] = False
+
+                    return status
+
+                continue
+
+            if message[0] == "stats":
+                stats[message[1]].append(message[2:])
+                continue
+
+            fpath = message[1]
+            entry = pending[fpath]
+
+            if message[0] == "shard":
+                entry["shards"] -= 1
+                entry["batches"] += message[2]
+                entry["failed"] |= not message[3]
+
+                # The file starts with its first decoded shard
+                if entry["start"] == None or message[4] < entry["start"]:
+                    entry["start"] = message[4]
+            else:
+                entry["done"] += 1
+
+                if message[2] == None:
+                    entry["failed"] = True
+                else:
+                    entry["results"].update(message[2])
+
+            # All shards decoded and all batches predicted?
+            if entry["shards"] == 0 and entry["done"] == entry["batches"]:
+                del pending[fpath]
+                status[fpath] = not entry["failed"] and analyze.saveResults(entry["results"], fpath, entry["start"])
+
+        # Stop inference workers
+        for _ in range(inference_workers):
+            ready.put(None)
+
+        while len(stats["decode"]) + len(stats["inference"]) < len(workers):
+            try:
+                message = results.get(timeout=1)
+
+            except queue.Empty:
+                # Workers that died do not send their stats
+                if getDeadWorkers(workers) or not any(w.is_alive() for w in workers):
+                    break
+
+                continue
+
+            stats[message[1]].append(message[2:])
+
+        for w in workers:
+            w.join(timeout=1)
+
+        printUtilisation(stats)
+
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+
+        ring.close(unlink=True)
+
+    return status
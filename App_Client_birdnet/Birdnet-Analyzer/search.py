@@ -0,0 +1,335 @@
+"""Module to search for similar segments in the embeddings of an archive.
+
+Builds an inverted file index (IVF) over the binary embeddings store written by
+`embeddings.py --format npy`. Vectors are clustered with spherical k-means,
+a query only compares the vectors in the lists of its closest centroids.
+
+    python3 search.py build --store example/
+    python3 search.py query --store example/ --clip example/soundscape.wav --k 10
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+
+import embeddings
+
+# Maximum number of floats of a block of scores, limits the memory of the index build
+BLOCK_FLOATS = 1 << 25
+
+
+def normalize(v):
+    """Scales vectors to unit length.
+
+    Args:
+        v: Array of vectors with shape (n, dim).
+
+    Returns:
+        The float32 unit vectors, zero vectors stay zero.
+    """
+    v = np.asarray(v, dtype="float32")
+    norm = np.linalg.norm(v, axis=1, keepdims=True)
+
+    return v / np.maximum(norm, 1e-12)
+
+
+def assignLists(vectors, centroids):
+    """Finds the closest centroid of each vector.
+
+    Args:
+        vectors: Array of vectors, can be memory-mapped.
+        centroids: The unit length centroids.
+
+    Returns:
+        The index of the closest centroid of each vector.
+    """
+    assign = np.zeros(len(vectors), dtype="int64")
+    block = max(1, BLOCK_FLOATS // len(centroids))
+
+    for start in range(0, len(vectors), block):
+        assign[start : start + block] = np.argmax(normalize(vectors[start : start + block]) @ centroids.T, axis=1)
+
+    return assign
+
+
+def trainCentroids(vectors, num_lists: int, iterations=10, sample_size=64, seed=42):
+    """Clusters a sample of the vectors with spherical k-means.
+
+    Args:
+        vectors: Array of vectors, can be memory-mapped.
+        num_lists: Number of clusters.
+        iterations: Number of k-means iterations.
+        sample_size: Number of sampled vectors per cluster.
+        seed: Random seed.
+
+    Returns:
+        The unit length centroids with shape (num_lists, dim).
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(vectors), min(len(vectors), num_lists * sample_size), replace=False))
+    sample = normalize(vectors[rows])
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+
+    for _ in range(iterations):
+        assign = assignLists(sample, centroids)
+        counts = np.bincount(assign, minlength=num_lists)
+
+        # Sum the vectors of each cluster
+        order = np.argsort(assign, kind="stable")
+        used = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[used] = np.add.reduceat(sample[order], np.concatenate(([0], np.cumsum(counts)[:-1]))[used])
+
+        # Empty clusters get a random vector of the sample
+        sums[~used] = sample[rng.choice(len(sample), int((~used).sum()))]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+def buildIndex(store_path: str, num_lists: int = None, iterations=10):
+    """Builds the search index of an embeddings store.
+
+    The unit length vectors are copied into the index, ordered by list,
+    so that every list can be scanned as one contiguous block.
+
+    Args:
+        store_path: Path to the manifest or output folder of the embeddings store.
+        num_lists: Number of lists, None uses 4 * sqrt(number of vectors).
+        iterations: Number of k-means iterations.
+
+    Returns:
+        The path prefix of the index files.
+    """
+    vectors, _, _ = embeddings.loadEmbeddingsStore(store_path)
+    prefix = getIndexPrefix(store_path)
+
+    if len(vectors) == 0:
+        raise ValueError("The embeddings store is empty.")
+
+    if num_lists == None:
+        num_lists = int(4 * np.sqrt(len(vectors)))
+
+    num_lists = max(1, min(len(vectors), num_lists))
+
+    centroids = trainCentroids(vectors, num_lists, iterations)
+    assign = assignLists(vectors, centroids)
+
+    # Store rows ordered by list
+    rows = np.argsort(assign, kind="stable")
+    offsets = np.searchsorted(assign[rows], np.arange(num_lists + 1))
+    ordered = np.lib.format.open_memmap(prefix + ".ivf.npy", mode="w+", dtype=vectors.dtype, shape=vectors.shape)
+    block = max(1, BLOCK_FLOATS // vectors.shape[1])
+
+    for start in range(0, len(rows), block):
+        ordered[start : start + block] = normalize(vectors[rows[start : start + block]])
+
+    ordered.flush()
+    del ordered
+
+    np.savez(prefix + ".ivf.npz", centroids=centroids, offsets=offsets, rows=rows)
+
+    return prefix
+
+
+def getIndexPrefix(store_path: str):
+    """Returns the path prefix of the index files of an embeddings store.
+
+    Args:
+        store_path: Path to the manifest or output folder of the embeddings store.
+
+    Returns:
+        The path prefix, same as the prefix of the store.
+    """
+    if store_path.lower().endswith(".json"):
+        return store_path[:-5]
+
+    return embeddings.getStorePrefix(store_path)
+
+
+class SearchIndex:
+    """IVF index over an embeddings store.
+
+    Attributes:
+        vectors: The unit length vectors ordered by list, memory-mapped.
+        centroids: The unit length centroids of the lists.
+        offsets: Start of each list in the ordered vectors.
+        rows: Row in the store of each ordered vector.
+        index: (file_id, start, end) of each row of the store.
+        files: Audio file of each file id.
+        store: The memory-mapped vectors of the store.
+        params: The overlap and bandpass settings the store was extracted with.
+    """
+
+    def __init__(self, store_path: str):
+        """Loads the index, the vectors stay on disk.
+
+        Args:
+            store_path: Path to the manifest or output folder of the embeddings store.
+        """
+        prefix = getIndexPrefix(store_path)
+        data = np.load(prefix + ".ivf.npz")
+
+        self.centroids = data["centroids"]
+        self.offsets = data["offsets"]
+        self.rows = data["rows"]
+        self.vectors = np.load(prefix + ".ivf.npy", mmap_mode="r")
+        self.store, self.index, self.files = embeddings.loadEmbeddingsStore(store_path)
+
+        with open(prefix + ".json") as f:
+            self.params = json.load(f)["params"]
+
+    def search(self, query, k=10, nprobe=8, exclude=None):
+        """Finds the most similar vectors of a query vector.
+
+        Args:
+            query: The query vector.
+            k: Number of results.
+            nprobe: Number of lists that are scanned.
+            exclude: Optional row of the store to leave out, e.g. the query segment.
+
+        Returns:
+            A list of (row, cosine similarity), best first.
+        """
+        query = normalize(np.reshape(query, (1, -1)))[0]
+        lists = np.argsort(self.centroids @ query)[::-1][: max(1, nprobe)]
+        candidates, scores = [], []
+
+        for l in lists:
+            start, end = self.offsets[l], self.offsets[l + 1]
+
+            if end > start:
+                candidates.append(self.rows[start:end])
+                scores.append(np.asarray(self.vectors[start:end], dtype="float32") @ query)
+
+        if not candidates:
+            return []
+
+        candidates, scores = np.concatenate(candidates), np.concatenate(scores)
+
+        if exclude != None:
+            scores[candidates == exclude] = -np.inf
+
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(int(candidates[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def describe(self, results: list[tuple[int, float]]):
+        """Adds the file and time of each result.
+
+        Args:
+            results: List of (row, score).
+
+        Returns:
+            A list of dictionaries with id, file, start, end and score.
+        """
+        return [
+            {
+                "id": row,
+                "file": self.files[self.index["file_id"][row]],
+                "start": float(self.index["start"][row]),
+                "end": float(self.index["end"][row]),
+                "score": round(score, 4),
+            }
+            for row, score in results
+        ]
+
+    def searchSegment(self, row: int, k=10, nprobe=8):
+        """Finds the segments that are most similar to a segment of the store.
+
+        Args:
+            row: Id of the segment, the row in the store.
+            k: Number of results.
+            nprobe: Number of lists that are scanned.
+
+        Returns:
+            A list of dictionaries with id, file, start, end and score.
+        """
+        return self.describe(self.search(self.store[row], k, nprobe, exclude=row))
+
+    def searchEmbeddings(self, e, k=10, nprobe=8):
+        """Finds the segments that are most similar to a clip.
+
+        Args:
+            e: The embeddings of the frames of the clip, their mean direction is the query.
+            k: Number of results.
+            nprobe: Number of lists that are scanned.
+
+        Returns:
+            A list of dictionaries with id, file, start, end and score.
+        """
+        return self.describe(self.search(normalize(e).mean(axis=0), k, nprobe))
+
+
+def getClipEmbeddings(path: str):
+    """Extracts the embeddings of an audio clip with the parameters of the current config.
+
+    Args:
+        path: Path to the audio file.
+
+    Returns:
+        The embeddings of the frames of the clip.
+    """
+    import analyze
+    import model
+
+    e = [model.embeddings(np.array(samples, dtype="float32")) for samples, _ in analyze.getBatches(analyze.getRawAudioChunks(path))]
+
+    return np.concatenate(e)
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Search for similar segments in BirdNET embeddings.")
+    parser.add_argument("command", choices=["build", "query"], help="Build the index of a store or query it.")
+    parser.add_argument(
+        "--store", default="example/", help="Output folder or manifest of 'embeddings.py --format npy'. Defaults to 'example/'."
+    )
+    parser.add_argument("--lists", type=int, help="Number of lists of the index. Defaults to 4 * sqrt(number of segments).")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of k-means iterations. Defaults to 10.")
+    parser.add_argument("--clip", help="Audio file to search for.")
+    parser.add_argument("--id", type=int, help="Id of a segment of the store to search for.")
+    parser.add_argument("--k", type=int, default=10, help="Number of results. Defaults to 10.")
+    parser.add_argument(
+        "--nprobe", type=int, default=8, help="Number of lists to scan, higher values are slower but more accurate. Defaults to 8."
+    )
+    parser.add_argument("--threads", type=int, default=4, help="Number of CPU threads for the clip embeddings. Defaults to 4.")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start_time = datetime.datetime.now()
+        prefix = buildIndex(args.store, args.lists, args.iterations)
+
+        print(f"Built index {prefix}.ivf.npz in {(datetime.datetime.now() - start_time).total_seconds():.2f} seconds", flush=True)
+        sys.exit(0)
+
+    if (args.clip == None) == (args.id == None):
+        parser.error("Query needs either --clip or --id.")
+
+    index = SearchIndex(args.store)
+
+    if args.id != None:
+        results = index.searchSegment(args.id, args.k, args.nprobe)
+    else:
+        import config as cfg
+
+        # Extract the clip embeddings with the parameters of the store
+        cfg.MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), cfg.MODEL_PATH)
+        cfg.SIG_OVERLAP = index.params["overlap"]
+        cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX = index.params["fmin"], index.params["fmax"]
+        cfg.TFLITE_THREADS = max(1, args.threads)
+
+        results = index.searchEmbeddings(getClipEmbeddings(args.clip), args.k, args.nprobe)
+
+    print(json.dumps(results, indent=2))
+
+    # A few examples to test
+    # python3 search.py build --store example/
+    # python3 search.py query --store example/ --id 0 --k 5
+    # python3 search.py query --store example/ --clip example/soundscape.wav --k 10 --nprobe 16
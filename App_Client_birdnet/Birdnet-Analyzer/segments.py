@@ -5,6 +5,7 @@ Can be used to save the segments of the audio files for each detection.
 import argparse
 import multiprocessing
 import os
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 
 import numpy as np
@@ -83,43 +84,62 @@ def parseFiles(flist: list[dict], max_segments=100):
         max_segments: Number of segments per species.
 
     Returns:
-        TODO @kahst
+        A list of (audio file path, segments) with up to max_segments randomly selected segments per species.
     """
-    species_segments: dict[str, list] = {}
+    afiles = []
+    columns = {"file": [], "start": [], "end": [], "species": [], "confidence": []}
 
     for f in flist:
-        # Paths
-        afile = f["audio"]
-        rfile = f["result"]
-
         # Get all segments for result file
-        segments = findSegments(afile, rfile)
+        segments = findSegments(f["audio"], f["result"])
+
+        columns["file"].append(np.full(len(segments["start"]), len(afiles)))
+        afiles.append(f["audio"])
+
+        for key in ["start", "end", "species", "confidence"]:
+            columns[key].append(segments[key])
+
+    if not afiles:
+        print("Found 0 segments in 0 audio files.")
+        return []
 
-        # Parse segments by species
-        for s in segments:
-            if s["species"] not in species_segments:
-                species_segments[s["species"]] = []
+    columns = {key: np.concatenate(values) for key, values in columns.items()}
 
-            species_segments[s["species"]].append(s)
+    # Group segments by species, in order of first appearance
+    species, first, inverse = np.unique(columns["species"], return_index=True, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(species)))[:-1])
 
     # Shuffle segments for each species and limit to max_segments
-    for s in species_segments:
-        np.random.shuffle(species_segments[s])
-        species_segments[s] = species_segments[s][:max_segments]
+    selected = []
 
-    # Make dict of segments per audio file
+    for k in np.argsort(first):
+        group = groups[k]
+        np.random.shuffle(group)
+        selected.append(group[:max_segments])
+
+    selected = np.concatenate(selected) if selected else np.zeros(0, dtype=int)
+
+    # Make dict of segments per audio file, only for the selected segments
     segments: dict[str, list] = {}
-    seg_cnt = 0
 
-    for s in species_segments:
-        for seg in species_segments[s]:
-            if seg["audio"] not in segments:
-                segments[seg["audio"]] = []
+    for i in selected:
+        afile = afiles[columns["file"][i]]
+
+        if afile not in segments:
+            segments[afile] = []
 
-            segments[seg["audio"]].append(seg)
-            seg_cnt += 1
+        segments[afile].append(
+            {
+                "audio": afile,
+                "start": float(columns["start"][i]),
+                "end": float(columns["end"][i]),
+                "species": str(columns["species"][i]),
+                "confidence": float(columns["confidence"][i]),
+            }
+        )
 
-    print(f"Found {seg_cnt} segments in {len(segments)} audio files.")
+    print(f"Found {len(selected)} segments in {len(segments)} audio files.")
 
     # Convert to list
     flist = [tuple(e) for e in segments.items()]
@@ -127,6 +147,16 @@ def parseFiles(flist: list[dict], max_segments=100):
     return flist
 
 
+# Header names of the (start, end, species, confidence) columns of each result type
+# Kaleidoscope stores the duration instead of the end time
+RESULT_COLUMNS = {
+    "table": ("\t", "Begin Time (s)", "End Time (s)", "Species Code", "Confidence"),
+    "r": (",", "start", "end", "common_name", "confidence"),
+    "kaleidoscope": (",", "OFFSET", "DURATION", "scientific_name", "confidence"),
+    "csv": (",", "Start (s)", "End (s)", "Common name", "Confidence"),
+}
+
+
 def findSegments(afile: str, rfile: str):
     """Extracts the segments for an audio file from the results file
 
@@ -135,64 +165,143 @@ def findSegments(afile: str, rfile: str):
         rfile: Path to the result file.
 
     Returns:
-        A list of dicts in the form of
+        A dict of arrays in the form of
         {"audio": afile, "start": start, "end": end, "species": species, "confidence": confidence}
+        with one entry per detection above MIN_CONFIDENCE that is not "nocall".
     """
-    segments: list[dict] = []
-
     # Open and parse result file
     lines = utils.readLines(rfile)
 
     # Auto-detect result type
-    rtype = detectRType(lines[0])
-
-    # Get start and end times based on rtype
-    confidence = 0
-    start = end = 0.0
-    species = ""
-
-    for i, line in enumerate(lines):
-        if rtype == "table" and i > 0:
-            # TODO: Use header columns to get the right indices
-            d = line.split("\t")
-            start = float(d[3])
-            end = float(d[4])
-            species = d[-4]
-            confidence = float(d[-3])
-
-        elif rtype == "audacity":
-            d = line.split("\t")
-            start = float(d[0])
-            end = float(d[1])
-            species = d[2].split(", ")[1]
-            confidence = float(d[-1])
-
-        elif rtype == "r" and i > 0:
-            d = line.split(",")
-            start = float(d[1])
-            end = float(d[2])
-            species = d[4]
-            confidence = float(d[5])
-
-        elif rtype == "kaleidoscope" and i > 0:
-            d = line.split(",")
-            start = float(d[3])
-            end = float(d[4]) + start
-            species = d[5]
-            confidence = float(d[7])
-
-        elif rtype == "csv" and i > 0:
-            d = line.split(",")
-            start = float(d[0])
-            end = float(d[1])
-            species = d[3]
-            confidence = float(d[4])
-
-        # Check if confidence is high enough and label is not "nocall"
-        if confidence >= cfg.MIN_CONFIDENCE and species.lower() != "nocall":
-            segments.append({"audio": afile, "start": start, "end": end, "species": species, "confidence": confidence})
-
-    return segments
+    rtype = detectRType(lines[0]) if lines else "audacity"
+
+    if rtype == "audacity":
+        # No header, label is "scientific name, common name"
+        rows = [line.split("\t") for line in lines if line.strip()]
+        start = [r[0] for r in rows]
+        end = [r[1] for r in rows]
+        species = [r[2].split(", ")[1] for r in rows]
+        confidence = [r[-1] for r in rows]
+    else:
+        delimiter, *names = RESULT_COLUMNS[rtype]
+        header = lines[0].split(delimiter)
+        idx = [header.index(name) for name in names]
+        rows = [line.split(delimiter) for line in lines[1:] if line.strip()]
+        start, end, species, confidence = ([r[i] for r in rows] for i in idx)
+
+    start = np.array(start, dtype=float)
+    end = np.array(end, dtype=float)
+    species = np.array(species, dtype=str)
+    confidence = np.array(confidence, dtype=float)
+
+    if rtype == "kaleidoscope":
+        end = end + start
+
+    # Check if confidence is high enough and label is not "nocall"
+    mask = (confidence >= cfg.MIN_CONFIDENCE) & (np.char.lower(species) != "nocall")
+
+    return {"audio": afile, "start": start[mask], "end": end[mask], "species": species[mask], "confidence": confidence[mask]}
+
+
+def readClip(afile: str, sig, start: int, end: int):
+    """Reads the samples of a clip.
+
+    Args:
+        afile: Path to the audio file.
+        sig: The decoded signal of the file, None reads the clip from the file.
+        start: First sample of the clip at the target sample rate.
+        end: End sample of the clip at the target sample rate, clips end early at the end of the file.
+
+    Returns:
+        The samples of the clip.
+    """
+    if sig is not None:
+        return sig[start:end]
+
+    # Seeks to the clip and only decodes and resamples its range
+    clip, _ = audio.openAudioFile(afile, cfg.SAMPLE_RATE, start / cfg.SAMPLE_RATE, (end - start) / cfg.SAMPLE_RATE)
+
+    return clip
+
+
+def getClips(afile: str, segments: list[dict], seg_length: float):
+    """Reads the clips of all segments of an audio file.
+
+    Args:
+        afile: Path to the audio file.
+        segments: The segments of the file.
+        seg_length: Length of the clips in seconds.
+
+    Yields:
+        Tuples of (species, clip file name, clip samples).
+    """
+    # Formats that can seek are read clip by clip, others are decoded once
+    sig = None
+
+    if not audio.isStreamable(afile):
+        sig, _ = audio.openAudioFile(afile, cfg.SAMPLE_RATE)
+
+    for seg_cnt, seg in enumerate(segments, 1):
+        # Get start and end times
+        start = int(seg["start"] * cfg.SAMPLE_RATE)
+        end = int(seg["end"] * cfg.SAMPLE_RATE)
+        offset = ((seg_length * cfg.SAMPLE_RATE) - (end - start)) // 2
+        start = max(0, start - offset)
+        end = end + offset if sig is None else min(len(sig), end + offset)
+
+        # Make sure segment is long enough
+        if end > start:
+            seg_name = "{:.3f}_{}_{}_{:.1f}s_{:.1f}s.{}".format(
+                seg["confidence"],
+                seg_cnt,
+                seg["audio"].rsplit(os.sep, 1)[-1].rsplit(".", 1)[0],
+                seg["start"],
+                seg["end"],
+                cfg.SEGMENT_FORMAT,
+            )
+
+            yield seg["species"], seg_name, readClip(afile, sig, int(start), int(end))
+
+
+class ClipWriter:
+    """Writes clips into species folders on a thread pool.
+
+    Encoding and writing overlap with reading the next clips,
+    each species folder is only created once.
+    """
+
+    def __init__(self, output_path: str, threads: int):
+        self.output_path = output_path
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.folders = set()
+        self.futures = []
+
+    def write(self, species: str, name: str, sig):
+        """Queues a clip for writing.
+
+        Args:
+            species: Species folder of the clip.
+            name: File name of the clip.
+            sig: The samples of the clip.
+        """
+        outpath = os.path.join(self.output_path, species)
+
+        if not outpath in self.folders:
+            os.makedirs(outpath, exist_ok=True)
+            self.folders.add(outpath)
+
+        self.futures.append(self.executor.submit(audio.saveSignal, sig, os.path.join(outpath, name)))
+
+    def close(self):
+        """Waits until all clips are written.
+
+        Raises:
+            The first exception raised while writing a clip.
+        """
+        self.executor.shutdown(wait=True)
+
+        for f in self.futures:
+            f.result()
 
 
 def extractSegments(item: tuple[tuple[str, list[dict]], float, dict[str]]):
@@ -212,50 +321,114 @@ def extractSegments(item: tuple[tuple[str, list[dict]], float, dict[str]]):
     # Status
     print(f"Extracting segments from {afile}")
 
+    writer = ClipWriter(cfg.OUTPUT_PATH, cfg.SEGMENT_WRITER_THREADS)
+
     try:
-        # Open audio file
-        sig, _ = audio.openAudioFile(afile, cfg.SAMPLE_RATE)
+        for species, seg_name, seg_sig in getClips(afile, segments, seg_length):
+            writer.write(species, seg_name, seg_sig)
+
+        writer.close()
+
     except Exception as ex:
-        print(f"Error: Cannot open audio file {afile}", flush=True)
+        # Write error log
+        print(f"Error: Cannot extract segments from {afile}.", flush=True)
         utils.writeErrorLog(ex)
+        return False
 
-        return
-
-    # Extract segments
-    for seg_cnt, seg in enumerate(segments, 1):
-        try:
-            # Get start and end times
-            start = int(seg["start"] * cfg.SAMPLE_RATE)
-            end = int(seg["end"] * cfg.SAMPLE_RATE)
-            offset = ((seg_length * cfg.SAMPLE_RATE) - (end - start)) // 2
-            start = max(0, start - offset)
-            end = min(len(sig), end + offset)
-
-            # Make sure segment is long enough
-            if end > start:
-                # Get segment raw audio from signal
-                seg_sig = sig[int(start) : int(end)]
-
-                # Make output path
-                outpath = os.path.join(cfg.OUTPUT_PATH, seg["species"])
-                os.makedirs(outpath, exist_ok=True)
-
-                # Save segment
-                seg_name = "{:.3f}_{}_{}_{:.1f}s_{:.1f}s.wav".format(
-                    seg["confidence"], seg_cnt, seg["audio"].rsplit(os.sep, 1)[-1].rsplit(".", 1)[0], seg["start"], seg["end"]
-                )
-                seg_path = os.path.join(outpath, seg_name)
-                audio.saveSignal(seg_sig, seg_path)
-
-        except Exception as ex:
-            # Write error log
-            print(f"Error: Cannot extract segments from {afile}.", flush=True)
-            utils.writeErrorLog(ex)
-            return False
+    finally:
+        writer.executor.shutdown(wait=True)
 
     return True
 
 
+def encodeSegments(item: tuple[tuple[str, list[dict]], float, dict[str]]):
+    """Encodes each segment for an archive.
+
+    Args:
+        item: A tuple that contains ((audio file path, segments), segment length, config)
+
+    Returns:
+        A tuple of (audio file path, [(archive name, encoded clip), ...]), the list is None if the extraction failed.
+    """
+    # Paths and config
+    afile = item[0][0]
+    segments = item[0][1]
+    seg_length = item[1]
+    cfg.setConfig(item[2])
+
+    # Status
+    print(f"Extracting segments from {afile}")
+
+    try:
+        return afile, [
+            (species + "/" + seg_name, audio.encodeSignal(seg_sig, cfg.SEGMENT_FORMAT))
+            for species, seg_name, seg_sig in getClips(afile, segments, seg_length)
+        ]
+
+    except Exception as ex:
+        # Write error log
+        print(f"Error: Cannot extract segments from {afile}.", flush=True)
+        utils.writeErrorLog(ex)
+        return afile, None
+
+
+def writeArchive(path: str, flist: list, threads: int):
+    """Extracts the segments into a single tar or zip archive.
+
+    Workers encode the clips, the archive is only written by this process.
+
+    Args:
+        path: Path to the archive, a .zip extension writes a zip file, otherwise a tar file.
+        flist: List of ((audio file path, segments), segment length, config).
+        threads: Number of worker processes.
+
+    Returns:
+        A dictionary with {audio file path: `True` if the segments were extracted successfully}.
+    """
+    import io
+    import tarfile
+    import time
+    import zipfile
+
+    status = {}
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if path.lower().endswith(".zip"):
+        # Audio does not compress well, store clips as they are
+        archive = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+        append = lambda name, data: archive.writestr(name, data)
+    else:
+        archive = tarfile.open(path, "w")
+
+        def append(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+
+    pool = Pool(threads) if threads >= 2 else None
+
+    try:
+        with archive:
+            results = map(encodeSegments, flist) if pool == None else pool.imap_unordered(encodeSegments, flist)
+
+            for afile, clips in results:
+                status[afile] = clips != None
+
+                for name, data in clips or []:
+                    append(name, data)
+
+    finally:
+        # Stop the workers, also if writing the archive failed
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    return status
+
+
 if __name__ == "__main__":
     # Parse arguments
     parser = argparse.ArgumentParser(description="Extract segments from audio files based on BirdNET detections.")
@@ -270,6 +443,20 @@ if __name__ == "__main__":
         "--seg_length", type=float, default=3.0, help="Length of extracted segments in seconds. Defaults to 3.0."
     )
     parser.add_argument("--threads", type=int, default=min(8, max(1, multiprocessing.cpu_count() // 2)), help="Number of CPU threads.")
+    parser.add_argument(
+        "--format", default=cfg.SEGMENT_FORMAT, help=f"Audio format of the segments, wav or flac. Defaults to '{cfg.SEGMENT_FORMAT}'."
+    )
+    parser.add_argument(
+        "--writer_threads",
+        type=int,
+        default=cfg.SEGMENT_WRITER_THREADS,
+        help=f"Number of threads per process that encode and write segments. Defaults to {cfg.SEGMENT_WRITER_THREADS}.",
+    )
+    parser.add_argument(
+        "--archive",
+        default=None,
+        help="Write all segments into this single .tar or .zip file instead of separate files. Defaults to None.",
+    )
 
     args = parser.parse_args()
 
@@ -285,6 +472,10 @@ if __name__ == "__main__":
     # Set confidence threshold
     cfg.MIN_CONFIDENCE = max(0.01, min(0.99, float(args.min_conf)))
 
+    # Set segment output
+    cfg.SEGMENT_FORMAT = args.format.lower() if args.format.lower() in ["wav", "flac"] else "wav"
+    cfg.SEGMENT_WRITER_THREADS = max(1, int(args.writer_threads))
+
     # Parse file list and make list of segments
     cfg.FILE_LIST = parseFiles(cfg.FILE_LIST, max(1, int(args.max_segments)))
 
@@ -295,7 +486,9 @@ if __name__ == "__main__":
     flist = [(entry, max(cfg.SIG_LENGTH, float(args.seg_length)), cfg.getConfig()) for entry in cfg.FILE_LIST]
 
     # Extract segments
-    if cfg.CPU_THREADS < 2:
+    if args.archive:
+        writeArchive(args.archive, flist, cfg.CPU_THREADS)
+    elif cfg.CPU_THREADS < 2:
         for entry in flist:
             extractSegments(entry)
     else:
@@ -305,3 +498,4 @@ if __name__ == "__main__":
     # A few examples to test
     # python3 segments.py --audio example/ --results example/ --o example/segments/
     # python3 segments.py --audio example/ --results example/ --o example/segments/ --seg_length 5.0 --min_conf 0.1 --max_segments 100 --threads 4
+    # python3 segments.py --audio example/ --results example/ --archive example/segments.tar --format flac --threads 4
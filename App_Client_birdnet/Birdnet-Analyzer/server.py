@@ -5,23 +5,30 @@ Can be used to start up a server and feed it classification requests.
 import argparse
 import json
 import os
+import queue
 import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import date, datetime
 from multiprocessing import freeze_support
 
 import bottle
+import numpy as np
 
 import analyze
+import audio
 import config as cfg
+import model
 import species
 import utils
 
 
-def resultPooling(lines: list[str], num_results=5, pmode="avg"):
-    """Parses the results into list of (species, score).
+def resultPooling(detections: list[tuple[str, float]], num_results=5, pmode="avg"):
+    """Pools the detections into a list of (species, score).
 
     Args:
-        lines: List of result scores.
+        detections: List of (species, score) for every detection.
         num_results: The number of entries to be returned.
         pmode: Decides how the score for each species is computed.
                If "max" used the maximum score for the species,
@@ -30,25 +37,21 @@ def resultPooling(lines: list[str], num_results=5, pmode="avg"):
     Returns:
         A List of (species, score).
     """
-    # Parse results
+    # Group scores by species
     results = {}
 
-    for line in lines:
-        d = line.split("\t")
-        species = d[2].replace(", ", "_")
-        score = float(d[-1])
+    for label, score in detections:
+        if not label in results:
+            results[label] = []
 
-        if not species in results:
-            results[species] = []
-
-        results[species].append(score)
+        results[label].append(score)
 
     # Compute score for each species
-    for species in results:
+    for label in results:
         if pmode == "max":
-            results[species] = max(results[species])
+            results[label] = max(results[label])
         else:
-            results[species] = sum(results[species]) / len(results[species])
+            results[label] = sum(results[label]) / len(results[label])
 
     # Sort results
     results = sorted(results.items(), key=lambda x: x[1], reverse=True)
@@ -56,6 +59,413 @@ def resultPooling(lines: list[str], num_results=5, pmode="avg"):
     return results[:num_results]
 
 
+def getRequestConfig(mdata: dict):
+    """Builds the config of a request from its metadata.
+
+    Args:
+        mdata: The metadata of the request.
+
+    Returns:
+        A config dictionary, the global config is not changed.
+    """
+    config = cfg.getConfig()
+
+    # Set config based on mdata
+    if "lat" in mdata and "lon" in mdata:
+        config["LATITUDE"] = float(mdata["lat"])
+        config["LONGITUDE"] = float(mdata["lon"])
+    else:
+        config["LATITUDE"] = -1
+        config["LONGITUDE"] = -1
+
+    config["WEEK"] = int(mdata.get("week", -1))
+    config["SIG_OVERLAP"] = max(0.0, min(2.9, float(mdata.get("overlap", 0.0))))
+    config["SIGMOID_SENSITIVITY"] = max(0.5, min(1.0 - (float(mdata.get("sensitivity", 1.0)) - 1.0), 1.5))
+    config["LOCATION_FILTER_THRESHOLD"] = max(0.01, min(0.99, float(mdata.get("sf_thresh", 0.03))))
+    config["SPECIES_LIST_FILE"] = None
+    config["SPECIES_LIST"] = []
+
+    return config
+
+
+def analyzeRequest(item):
+    """Analyzes an uploaded file in a worker process.
+
+    Args:
+        item: Tuple containing (file path, request config)
+
+    Returns:
+        A list of (species, score) for every detection, in the order of the segments.
+    """
+    # Get file path and restore cfg
+    file_path: str = item[0]
+    cfg.setConfig(item[1])
+
+    results = analyze.getResults(file_path)
+    table = analyze.getLabelTable()
+    species_mask = getSpeciesMask(item[1])
+
+    # Scores are rounded like in result files
+    return [
+        (table.translated[c[0]], round(c[1], 4))
+        for t in analyze.getSortedTimestamps(results)
+        for c in results[t]
+        if species_mask[c[0]]
+    ]
+
+
+class MicroBatcher:
+    """Gathers the frames of concurrent requests into shared model batches.
+
+    Request threads submit their frames and wait for the raw scores. A single
+    inference thread collects frames until the batch is full or the oldest frames
+    waited too long, predicts them at once and hands the scores back to each request.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        """Starts the inference thread.
+
+        Args:
+            max_batch_size: Maximum number of frames per batch.
+            max_wait: Maximum number of seconds frames wait for more frames.
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict(self, frames, predict_fn=None):
+        """Predicts the raw scores of frames.
+
+        Args:
+            frames: Frame matrix of a request.
+            predict_fn: Model function that is applied to the batch, defaults to analyze.predictLogits.
+                        Only jobs with the same function share a batch.
+
+        Returns:
+            The raw scores of each frame.
+        """
+        predict_fn = predict_fn or analyze.predictLogits
+
+        # Larger requests are split, so that every job fits into a batch
+        jobs = []
+
+        for i in range(0, len(frames), self.max_batch_size):
+            job = (frames[i : i + self.max_batch_size], Future(), predict_fn)
+            self.queue.put(job)
+            jobs.append(job[1])
+
+        if not jobs:
+            return np.zeros((0, len(cfg.LABELS)), dtype="float32")
+
+        return np.concatenate([job.result() for job in jobs])
+
+    def run(self):
+        """Collects and predicts batches until the server stops."""
+        held = None
+
+        while True:
+            # Wait for the first job of the batch
+            jobs = [held if held else self.queue.get()]
+            count = len(jobs[0][0])
+            deadline = time.monotonic() + self.max_wait
+            held = None
+
+            # Add jobs until the batch is full or the time is up
+            while count < self.max_batch_size:
+                try:
+                    job = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+
+                except queue.Empty:
+                    break
+
+                if count + len(job[0]) > self.max_batch_size or job[2] != jobs[0][2]:
+                    held = job
+                    break
+
+                jobs.append(job)
+                count += len(job[0])
+
+            self.predictJobs(jobs, count)
+
+    def predictJobs(self, jobs: list, count: int):
+        """Predicts the jobs of a batch and resolves their futures.
+
+        Args:
+            jobs: List of (frames, future, predict function).
+            count: Total number of frames.
+        """
+        # Pad to a power of two, so only a few interpreter sizes are allocated
+        size = min(self.max_batch_size, 1 << (count - 1).bit_length())
+        batch = np.zeros((size, *jobs[0][0].shape[1:]), dtype="float32")
+        start = 0
+
+        for frames, _, _ in jobs:
+            batch[start : start + len(frames)] = frames
+            start += len(frames)
+
+        try:
+            logits = jobs[0][2](batch)[:count]
+
+        except Exception as ex:
+            for _, future, _ in jobs:
+                future.set_exception(ex)
+
+            return
+
+        start = 0
+
+        for frames, future, _ in jobs:
+            future.set_result(logits[start : start + len(frames)])
+            start += len(frames)
+
+
+def getSpeciesMask(config: dict):
+    """Returns the species mask of a request.
+
+    Args:
+        config: The config of the request.
+
+    Returns:
+        Boolean array, True for labels on the species list of the location.
+    """
+    if config["LATITUDE"] == -1 or config["LONGITUDE"] == -1:
+        return analyze.getLabelTable().species_mask
+
+    # Cached by location, the meta model is shared by all request threads
+    return species.getSpeciesMask(config["LATITUDE"], config["LONGITUDE"], config["WEEK"], config["LOCATION_FILTER_THRESHOLD"])
+
+
+def analyzeBatched(file_path: str, config: dict):
+    """Analyzes an uploaded file in the request thread with shared batches.
+
+    The file is decoded and split with the settings of the request, the frames
+    are predicted by the micro-batcher.
+
+    Args:
+        file_path: Path to the uploaded file.
+        config: The config of the request.
+
+    Returns:
+        A list of (species, score) for every detection, in the order of the segments.
+    """
+    frames = readFrames(file_path, config["SIG_OVERLAP"], cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX)
+
+    return [c for d in getFrameDetections(frames, config, getSpeciesMask(config)) for c in d]
+
+
+def readFrames(file_path: str, overlap: float, fmin: int, fmax: int):
+    """Reads a file and splits it into frames.
+
+    Args:
+        file_path: Path to the audio file.
+        overlap: The overlapping seconds of the frames.
+        fmin: Lower cutoff of the bandpass filter in Hz.
+        fmax: Upper cutoff of the bandpass filter in Hz.
+
+    Returns:
+        The frame matrix of the file.
+    """
+    frames = []
+    offset = 0
+    end = audio.getAudioFileLength(file_path, cfg.SAMPLE_RATE)
+
+    # Read the file in windows, like analyze.getRawAudioChunks
+    while offset < end:
+        sig, rate = audio.openAudioFile(
+            file_path, cfg.SAMPLE_RATE, offset, cfg.FILE_SPLITTING_DURATION, fmin, fmax
+        )
+        frames.append(audio.frameSignal(sig, rate, cfg.SIG_LENGTH, overlap, cfg.SIG_MINLEN))
+        offset += cfg.FILE_SPLITTING_DURATION
+
+    return np.concatenate(frames) if frames else np.zeros((0, int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE)), dtype="float32")
+
+
+def initWorker(config: dict):
+    """Sets the config of a worker process once when it starts.
+
+    Raw scores and embeddings do not depend on the request, so blocks of frames are sent without a config.
+
+    Args:
+        config: The config of the server.
+    """
+    cfg.setConfig(config)
+
+
+def getFrameEmbeddings(frames):
+    """Extracts the embeddings of frames with the micro-batcher or a worker process.
+
+    Args:
+        frames: Frame matrix of a request.
+
+    Returns:
+        The embeddings of each frame.
+    """
+    if BATCHER:
+        return BATCHER.predict(frames, model.embeddings)
+
+    return EXECUTOR.submit(model.embeddings, np.asarray(frames, dtype="float32")).result()
+
+
+def getFrameDetections(frames, config: dict, species_mask):
+    """Predicts frames with the micro-batcher or a worker process.
+
+    Args:
+        frames: Frame matrix of a request.
+        config: The config of the request.
+        species_mask: Boolean array of labels that can be detected.
+
+    Returns:
+        A list with the (species, score) pairs of each frame, sorted by score.
+    """
+    if len(frames) == 0:
+        return []
+
+    if BATCHER:
+        p = BATCHER.predict(frames)
+    else:
+        p = EXECUTOR.submit(analyze.predictLogits, np.asarray(frames, dtype="float32")).result()
+
+    if cfg.APPLY_SIGMOID:
+        p = model.flat_sigmoid(p, sensitivity=-config["SIGMOID_SENSITIVITY"])
+
+    table = analyze.getLabelTable()
+    detections = analyze.getDetections(p, cfg.MIN_CONFIDENCE, cfg.TOP_K, species_mask)
+
+    # Scores are rounded like in result files
+    return [[(table.translated[c[0]], round(c[1], 4)) for c in d] for d in detections]
+
+
+def getPoolingOptions(mdata: dict):
+    """Reads the pooling options of a request.
+
+    Args:
+        mdata: The metadata of the request.
+
+    Returns:
+        A tuple of (number of results, pooling mode).
+    """
+    pmode = mdata.get("pmode", "avg").lower()
+
+    if pmode not in ["avg", "max"]:
+        pmode = "avg"
+
+    num_results = min(99, max(1, int(mdata.get("num_results", 5))))
+
+    return num_results, pmode
+
+
+def readRequestBody(environ: dict, block_size=65536):
+    """Reads the request body as it arrives.
+
+    Args:
+        environ: The WSGI environment of the request.
+        block_size: Maximum number of bytes per block.
+
+    Yields:
+        The blocks of the body, chunked transfer encoding is removed.
+    """
+    stream = environ["wsgi.input"]
+
+    if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+        while True:
+            # Chunk size in hex, optionally followed by extensions
+            size = int(stream.readline().split(b";")[0].strip() or b"0", 16)
+
+            if size == 0:
+                # Skip trailers
+                while stream.readline() not in [b"\r\n", b"\n", b""]:
+                    pass
+
+                return
+
+            while size > 0:
+                data = stream.read(min(size, block_size))
+
+                if not data:
+                    raise ValueError("Incomplete chunked request body.")
+
+                size -= len(data)
+
+                yield data
+
+            # CRLF after chunk data
+            stream.readline()
+    else:
+        remaining = int(environ.get("CONTENT_LENGTH") or 0)
+
+        while remaining > 0:
+            data = stream.read(min(remaining, block_size))
+
+            if not data:
+                break
+
+            remaining -= len(data)
+
+            yield data
+
+
+def analyzeStream(body, decoder: audio.StreamDecoder, config: dict):
+    """Analyzes an audio stream while it arrives.
+
+    Args:
+        body: Iterable of the bytes of the stream.
+        decoder: Decoder for the stream.
+        config: The config of the request.
+
+    Yields:
+        Tuples of (start, end, detections) for every frame as soon as it is predicted.
+    """
+    framer = audio.Framer(cfg.SAMPLE_RATE, cfg.SIG_LENGTH, config["SIG_OVERLAP"], cfg.SIG_MINLEN)
+    species_mask = getSpeciesMask(config)
+    step = cfg.SIG_LENGTH - config["SIG_OVERLAP"]
+    count = 0
+
+    def predict(frames):
+        nonlocal count
+
+        for d in getFrameDetections(frames, config, species_mask):
+            start = round(count * step, 3)
+            count += 1
+
+            yield start, start + cfg.SIG_LENGTH, d
+
+    for data in body:
+        yield from predict(framer.push(decoder.push(data)))
+
+    # Last frames
+    yield from predict(framer.push(decoder.push(b"", final=True)))
+    yield from predict(framer.flush())
+
+
+class ThreadedWSGIRefServer(bottle.ServerAdapter):
+    """Bottle server adapter that handles every request in its own thread."""
+
+    def run(self, app):
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+        class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(*args, **kwargs):
+                pass
+
+        handler = QuietHandler if self.quiet else WSGIRequestHandler
+        server = make_server(self.host, self.port, app, ThreadingWSGIServer, handler)
+        server.serve_forever()
+
+
+# Process pool or micro-batcher for the analysis, set when the server starts
+EXECUTOR = None
+BATCHER = None
+
+# Similarity search index, set when the server starts with a store
+SEARCH_INDEX = None
+
+
 @bottle.route("/healthcheck", method="GET")
 def healthcheck():
     """Checks the health of the running server.
@@ -125,68 +535,174 @@ def handleRequest():
 
     # Analyze file
     try:
-        # Set config based on mdata
-        if "lat" in mdata and "lon" in mdata:
-            cfg.LATITUDE = float(mdata["lat"])
-            cfg.LONGITUDE = float(mdata["lon"])
+        config = getRequestConfig(mdata)
+
+        if BATCHER:
+            detections = analyzeBatched(file_path, config)
         else:
-            cfg.LATITUDE = -1
-            cfg.LONGITUDE = -1
-
-        cfg.WEEK = int(mdata.get("week", -1))
-        cfg.SIG_OVERLAP = max(0.0, min(2.9, float(mdata.get("overlap", 0.0))))
-        cfg.SIGMOID_SENSITIVITY = max(0.5, min(1.0 - (float(mdata.get("sensitivity", 1.0)) - 1.0), 1.5))
-        cfg.LOCATION_FILTER_THRESHOLD = max(0.01, min(0.99, float(mdata.get("sf_thresh", 0.03))))
-
-        # Set species list
-        if not cfg.LATITUDE == -1 and not cfg.LONGITUDE == -1:
-            cfg.SPECIES_LIST_FILE = None
-            cfg.SPECIES_LIST = species.getSpeciesList(cfg.LATITUDE, cfg.LONGITUDE, cfg.WEEK, cfg.LOCATION_FILTER_THRESHOLD)
+            detections = EXECUTOR.submit(analyzeRequest, (file_path, config)).result()
+
+        # Pool results
+        num_results, pmode = getPoolingOptions(mdata)
+        results = resultPooling(detections, num_results, pmode)
+
+        # Prepare response
+        data = {"msg": "success", "results": results, "meta": mdata}
+
+        # Save response as metadata file
+        if mdata.get("save", False):
+            with open(file_path.rsplit(".", 1)[0] + ".json", "w") as f:
+                json.dump(data, f, indent=2)
+
+        # Return response
+        del data["meta"]
+
+        return json.dumps(data)
+
+    except Exception as e:
+        # Write error log
+        print(f"Error: Cannot analyze file {file_path}.", flush=True)
+        utils.writeErrorLog(e)
+
+        data = {"msg": f"Error during analysis: {e}"}
+
+        return json.dumps(data)
+    finally:
+        if file_path_tmp:
+            os.unlink(file_path_tmp.name)
+
+
+@bottle.route("/analyze/stream", method="POST")
+def handleStreamRequest():
+    """Handles a classification request with the audio as request body.
+
+    The body is a WAV file or raw PCM, which can be sent with chunked transfer encoding.
+    Frames are predicted as they arrive, the upload is never written to disk.
+    The metadata is passed as query parameters, raw PCM is described by the parameters
+    `rate`, `channels` and `sample_format` (int16, int32 or float32).
+
+    With `format=ndjson`, the detections of every frame are sent as a JSON line while
+    the upload is still going, followed by a line with the pooled results.
+
+    Returns:
+        A json response with the result or NDJSON lines.
+    """
+    # Print divider
+    print(f"{'#' * 20}  {datetime.now()}  {'#' * 20}")
+
+    mdata = dict(bottle.request.query)
+
+    print(mdata)
+
+    try:
+        config = getRequestConfig(mdata)
+        num_results, pmode = getPoolingOptions(mdata)
+
+        if "rate" in mdata:
+            dtype = {"int16": "<i2", "int32": "<i4", "float32": "<f4"}[mdata.get("sample_format", "int16")]
+            decoder = audio.StreamDecoder(
+                cfg.SAMPLE_RATE,
+                cfg.BANDPASS_FMIN,
+                cfg.BANDPASS_FMAX,
+                int(mdata["rate"]),
+                int(mdata.get("channels", 1)),
+                dtype,
+            )
         else:
-            cfg.SPECIES_LIST_FILE = None
-            cfg.SPECIES_LIST = []
+            decoder = audio.StreamDecoder(cfg.SAMPLE_RATE, cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX)
 
-        # Analyze file
-        success = analyze.analyzeFile((file_path, cfg.getConfig()))
+        frames = analyzeStream(readRequestBody(bottle.request.environ), decoder, config)
 
-        # Parse results
-        if success:
-            # Open result file
-            lines = utils.readLines(cfg.OUTPUT_PATH)
-            pmode = mdata.get("pmode", "avg").lower()
+    except Exception as ex:
+        return json.dumps({"msg": f"Invalid request: {ex}"})
 
-            # Pool results
-            if pmode not in ["avg", "max"]:
-                pmode = "avg"
+    def ndjson():
+        detections = []
 
-            num_results = min(99, max(1, int(mdata.get("num_results", 5))))
+        try:
+            for start, end, d in frames:
+                detections.extend(d)
 
-            results = resultPooling(lines, num_results, pmode)
+                yield json.dumps({"start": start, "end": end, "results": d[:num_results]}) + "\n"
 
-            # Prepare response
-            data = {"msg": "success", "results": results, "meta": mdata}
+            yield json.dumps({"msg": "success", "results": resultPooling(detections, num_results, pmode)}) + "\n"
+
+        except Exception as ex:
+            # Write error log
+            print("Error: Cannot analyze stream.", flush=True)
+            utils.writeErrorLog(ex)
+
+            yield json.dumps({"msg": f"Error during analysis: {ex}"}) + "\n"
+
+    if mdata.get("format") == "ndjson":
+        bottle.response.content_type = "application/x-ndjson"
+
+        return ndjson()
+
+    try:
+        detections = [c for _, _, d in frames for c in d]
+
+        return json.dumps({"msg": "success", "results": resultPooling(detections, num_results, pmode)})
+
+    except Exception as ex:
+        # Write error log
+        print("Error: Cannot analyze stream.", flush=True)
+        utils.writeErrorLog(ex)
+
+        return json.dumps({"msg": f"Error during analysis: {ex}"})
 
-            # Save response as metadata file
-            if mdata.get("save", False):
-                with open(file_path.rsplit(".", 1)[0] + ".json", "w") as f:
-                    json.dump(data, f, indent=2)
 
-            # Return response
-            del data["meta"]
+@bottle.route("/search", method="POST")
+def handleSearchRequest():
+    """Handles a similarity search request.
 
-            return json.dumps(data)
+    Searches for the segments of the embeddings store that sound most like an
+    uploaded audio clip, or like a segment of the store given by its id.
+    The metadata can contain `id`, `k` and `nprobe`.
 
+    Returns:
+        A json response with the matches or an error message.
+    """
+    if SEARCH_INDEX == None:
+        return json.dumps({"msg": "No search index loaded."})
+
+    upload = bottle.request.files.get("audio")
+    mdata = json.loads(bottle.request.forms.get("meta", "{}"))
+    k = min(1000, max(1, int(mdata.get("k", 10))))
+    nprobe = max(1, int(mdata.get("nprobe", 8)))
+    file_path_tmp = None
+
+    try:
+        start_time = time.perf_counter()
+
+        if "id" in mdata:
+            results = SEARCH_INDEX.searchSegment(int(mdata["id"]), k, nprobe)
+        elif upload:
+            # Decoding needs a file
+            file_path_tmp = tempfile.NamedTemporaryFile(suffix=os.path.splitext(upload.filename.lower())[1], delete=False)
+            file_path_tmp.close()
+            upload.save(file_path_tmp.name, overwrite=True)
+
+            # Clips are framed and filtered like the segments of the store
+            params = SEARCH_INDEX.params
+            frames = readFrames(file_path_tmp.name, params["overlap"], params["fmin"], params["fmax"])
+
+            if len(frames) == 0:
+                return json.dumps({"msg": "Audio clip is empty."})
+
+            results = SEARCH_INDEX.searchEmbeddings(getFrameEmbeddings(frames), k, nprobe)
         else:
-            return json.dumps({"msg": "Error during analysis."})
+            return json.dumps({"msg": "No audio file or segment id."})
 
-    except Exception as e:
+        return json.dumps({"msg": "success", "results": results, "time": time.perf_counter() - start_time})
+
+    except Exception as ex:
         # Write error log
-        print(f"Error: Cannot analyze file {file_path}.", flush=True)
-        utils.writeErrorLog(e)
+        print("Error: Cannot search.", flush=True)
+        utils.writeErrorLog(ex)
 
-        data = {"msg": f"Error during analysis: {e}"}
+        return json.dumps({"msg": f"Error during search: {ex}"})
 
-        return json.dumps(data)
     finally:
         if file_path_tmp:
             os.unlink(file_path_tmp.name)
@@ -206,6 +722,28 @@ if __name__ == "__main__":
         "--spath", default="uploads/", help="Path to folder where uploaded files should be stored. Defaults to '/uploads'."
     )
     parser.add_argument("--threads", type=int, default=4, help="Number of CPU threads for analysis. Defaults to 4.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, each analyzes one request at a time. Threads are split between them. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=0,
+        help="Maximum number of 3s frames in a batch shared by concurrent requests. Values > 0 analyze all requests in the server process with one shared batch queue instead of worker processes. Defaults to 0.",
+    )
+    parser.add_argument(
+        "--max_wait",
+        type=float,
+        default=10,
+        help="Maximum time in milliseconds frames wait for other requests to fill the batch. Defaults to 10.",
+    )
+    parser.add_argument(
+        "--search_store",
+        help="Output folder or manifest of 'embeddings.py --format npy' with a search index built by search.py. Enables the /search endpoint.",
+    )
     parser.add_argument(
         "--locale",
         default="en",
@@ -234,22 +772,29 @@ if __name__ == "__main__":
     # Set min_conf to 0.0, because we want all results
     cfg.MIN_CONFIDENCE = 0.0
 
-    output_file = tempfile.NamedTemporaryFile(suffix=".txt", delete=False)
-    output_file.close()
+    if args.max_batch_size > 0:
+        # All threads are used by the shared batches
+        cfg.TFLITE_THREADS = max(1, int(args.threads))
+        BATCHER = MicroBatcher(args.max_batch_size, max(0.0, args.max_wait) / 1000)
+    else:
+        # Share the threads between the worker processes
+        workers = max(1, int(args.workers))
+        cfg.TFLITE_THREADS = max(1, int(args.threads) // workers)
 
-    # Set path for temporary result file
-    cfg.OUTPUT_PATH = output_file.name
+        # Every worker analyzes one request at a time, uploaded files are sent along with the config of their request
+        EXECUTOR = ProcessPoolExecutor(workers, initializer=initWorker, initargs=(cfg.getConfig(),))
 
-    # Set result type
-    cfg.RESULT_TYPE = "audacity"
+    # Load search index
+    if args.search_store:
+        import search
 
-    # Set number of TFLite threads
-    cfg.TFLITE_THREADS = max(1, int(args.threads))
+        SEARCH_INDEX = search.SearchIndex(args.search_store)
 
     # Run server
     print(f"UP AND RUNNING! LISTENING ON {args.host}:{args.port}", flush=True)
 
     try:
-        bottle.run(host=args.host, port=args.port, quiet=True)
+        bottle.run(server=ThreadedWSGIRefServer, host=args.host, port=args.port, quiet=True)
     finally:
-        os.unlink(output_file.name)
+        if EXECUTOR:
+            EXECUTOR.shutdown(cancel_futures=True)
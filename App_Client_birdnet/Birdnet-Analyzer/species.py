@@ -3,13 +3,125 @@
 Can be used to predict a species list using coordinates and weeks.
 """
 import argparse
+import collections
 import os
 import sys
+import threading
+
+import numpy as np
 
 import config as cfg
 import model
 import utils
 
+# Number of decimals of the coordinates, locations within ~1 km share their species list
+LOCATION_PRECISION = 2
+
+# Maximum number of locations in the cache
+LOCATION_CACHE_SIZE = 4096
+
+# Location filter scores by (model path, lat, lon, week), least recently used first
+LOCATION_CACHE = collections.OrderedDict()
+LOCATION_CACHE_LOCK = threading.Lock()
+
+
+def getLocationKey(lat: float, lon: float, week: int):
+    """Returns the cache key of a location.
+
+    Args:
+        lat: The latitude.
+        lon: The longitude.
+        week: The week of the year [1-48]. Use -1 for year-round.
+
+    Returns:
+        A tuple of (model path, lat, lon, week) with the coordinates rounded to LOCATION_PRECISION.
+    """
+    return cfg.MDATA_MODEL_PATH, round(float(lat), LOCATION_PRECISION), round(float(lon), LOCATION_PRECISION), int(week)
+
+
+def getLocationScores(locations: list[tuple[float, float, int]]):
+    """Returns the location filter scores of many locations.
+
+    Scores are cached by the rounded location, all locations that are not
+    in the cache are predicted in one batch.
+
+    Args:
+        locations: List of (lat, lon, week).
+
+    Returns:
+        A list with the read-only scores of all species at each location.
+    """
+    keys = [getLocationKey(*location) for location in locations]
+
+    # The meta model interpreter and the cache are shared by all threads
+    with LOCATION_CACHE_LOCK:
+        missing = list(dict.fromkeys(k for k in keys if k not in LOCATION_CACHE))
+
+        if missing:
+            for key, scores in zip(missing, model.predictFilterBatch([k[1:] for k in missing])):
+                scores.setflags(write=False)
+                LOCATION_CACHE[key] = scores
+
+        results = []
+
+        for key in keys:
+            LOCATION_CACHE.move_to_end(key)
+            results.append(LOCATION_CACHE[key])
+
+        while len(LOCATION_CACHE) > LOCATION_CACHE_SIZE:
+            LOCATION_CACHE.popitem(last=False)
+
+    return results
+
+
+def getScoreMask(scores, threshold: float):
+    """Converts location filter scores into a species mask.
+
+    Args:
+        scores: The location filter scores.
+        threshold: Only values above or equal to threshold are on the list.
+
+    Returns:
+        Boolean array over cfg.LABELS, True for species on the list.
+    """
+    # Scores below LOCATION_FILTER_THRESHOLD count as 0, same as model.explore
+    scores = np.where(scores >= cfg.LOCATION_FILTER_THRESHOLD, scores, 0)
+    mask = np.zeros(len(cfg.LABELS), dtype=bool)
+    n = min(len(mask), len(scores))
+    mask[:n] = scores[:n] >= threshold
+
+    return mask
+
+
+def getSpeciesMask(lat: float, lon: float, week: int, threshold=0.05):
+    """Predict a species list as a mask over the labels.
+
+    The mask can be used as `label_mask` of analyze.getDetections.
+
+    Args:
+        lat: The latitude.
+        lon: The longitude.
+        week: The week of the year [1-48]. Use -1 for year-round.
+        threshold: Only values above or equal to threshold will be on the list.
+
+    Returns:
+        Boolean array over cfg.LABELS, True for species on the list.
+    """
+    return getScoreMask(getLocationScores([(lat, lon, week)])[0], threshold)
+
+
+def getSpeciesMasks(locations: list[tuple[float, float, int]], threshold=0.05):
+    """Predict the species lists of many locations as masks over the labels.
+
+    Args:
+        locations: List of (lat, lon, week).
+        threshold: Only values above or equal to threshold will be on the list.
+
+    Returns:
+        A list with a boolean array over cfg.LABELS for each location.
+    """
+    return [getScoreMask(scores, threshold) for scores in getLocationScores(locations)]
+
 
 def getSpeciesList(lat: float, lon: float, week: int, threshold=0.05, sort=False) -> list[str]:
     """Predict a species list.
@@ -27,10 +139,12 @@ def getSpeciesList(lat: float, lon: float, week: int, threshold=0.05, sort=False
         A list of all eligible species.
     """
     # Extract species from model
-    pred = model.explore(lat, lon, week)
+    scores = getLocationScores([(lat, lon, week)])[0]
+    scores = np.where(scores >= cfg.LOCATION_FILTER_THRESHOLD, scores, 0)[: len(cfg.LABELS)]
 
-    # Make species list
-    slist = [p[1] for p in pred if p[0] >= threshold]
+    # Make species list, sorted by score like model.explore
+    order = np.argsort(-scores, kind="stable")
+    slist = [cfg.LABELS[i] for i in order[scores[order] >= threshold]]
 
     return sorted(slist) if sort else slist
 
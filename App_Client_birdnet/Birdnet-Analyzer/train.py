@@ -5,64 +5,150 @@ Can be used to train a custom classifier with new training data.
 import argparse
 import multiprocessing
 import os
-from functools import partial
 from multiprocessing.pool import Pool
 
 import numpy as np
 import tqdm
 
+import analyze
 import audio
 import config as cfg
 import model
 import utils
 
+# Maximum number of files per task of the loader pool
+FILES_PER_TASK = 32
+
+
+def _getTrainingSamples(f):
+    """Loads an audio file and crops its training samples.
 
-def _loadAudioFile(f, label_vector, config):
-    """Load an audio file and extract features.
     Args:
         f: Path to the audio file.
-        label_vector: The label vector for the file.
+
     Returns:
-        A tuple of (x_train, y_train).
-    """    
+        A list of training samples.
+    """
+    sig, rate = audio.openAudioFile(f, duration=cfg.SIG_LENGTH if cfg.SAMPLE_CROP_MODE == "first" else None, fmin=cfg.BANDPASS_FMIN, fmax=cfg.BANDPASS_FMAX)
+
+    # Crop training samples
+    if cfg.SAMPLE_CROP_MODE == "center":
+        return [audio.cropCenter(sig, rate, cfg.SIG_LENGTH)]
+    elif cfg.SAMPLE_CROP_MODE == "first":
+        return [audio.splitSignal(sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)[0]]
+    else:
+        return audio.splitSignal(sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
+
+
+def _loadCachedEmbeddings(f):
+    """Returns the embeddings of the training samples of a file from the embedding cache.
+
+    With crop mode 'segments', files that analyze.py and embeddings.py read as a single shard
+    have the same frames as the training samples, so their entries are used if they exist.
+    Longer files are framed per shard there, so only the entries of train.py are used for them.
+
+    Args:
+        f: Path to the audio file.
+
+    Returns:
+        The embeddings of the training samples, or None if they are not cached.
+    """
+    if cfg.SAMPLE_CROP_MODE == "segments":
+        shards = analyze.getFileShards(f)
+        cached = analyze.loadCachedEmbeddings(f, *shards[0]) if len(shards) == 1 else None
+
+        if cached != None:
+            return cached[0]
+
+    entry = utils.loadCacheEntry(cfg.EMBEDDING_CACHE_DIR, analyze.getEmbeddingCacheKey(f, cfg.SAMPLE_CROP_MODE))
+
+    if entry == None:
+        return None
+
+    return entry["embeddings"].astype("float32")
+
+
+def _saveCachedEmbeddings(f, embeddings):
+    """Stores the embeddings of the training samples of a file in the embedding cache.
+
+    Args:
+        f: Path to the audio file.
+        embeddings: The embeddings of the training samples.
+
+    Returns:
+        The embeddings with the stored precision, so the first run and re-runs agree.
+    """
+    e = np.asarray(embeddings, dtype="float16")
+    utils.saveCacheEntry(cfg.EMBEDDING_CACHE_DIR, analyze.getEmbeddingCacheKey(f, cfg.SAMPLE_CROP_MODE), embeddings=e)
+
+    return e.astype("float32")
 
-    x_train = []
-    y_train = []
+
+def _loadAudioFiles(item):
+    """Loads a group of audio files and extracts features.
+
+    The training samples of all files go through the model in batches of TRAIN_EMBEDDING_BATCH_SIZE,
+    so batches are filled across file boundaries. Only one file and one batch of samples are held in memory.
+
+    Args:
+        item: Tuple containing (list of (path to the audio file, label vector), config)
+
+    Returns:
+        A list with a tuple of (x_train, y_train) for each file.
+    """
+    files = item[0]
 
     # restore config in case we're on Windows to be thread save
-    cfg.setConfig(config)
+    cfg.setConfig(item[1])
 
-    # Try to load the audio file
-    try:
-        # Load audio
-        sig, rate = audio.openAudioFile(f, duration=cfg.SIG_LENGTH if cfg.SAMPLE_CROP_MODE == "first" else None, fmin=cfg.BANDPASS_FMIN, fmax=cfg.BANDPASS_FMAX)
+    batch_size = max(1, cfg.TRAIN_EMBEDDING_BATCH_SIZE)
+    embeddings = [[] for _ in files]
+    samples = []
+    owners = []
+    computed = []
 
-    # if anything happens print the error and ignore the file
-    except Exception as e:
-        # Print Error
-        print(f"\t Error when loading file {f}", flush=True)
-        return np.array([]), np.array([])
+    def predictBatch(batch, batch_owners):
+        for i, e in zip(batch_owners, model.embeddings(np.array(batch, dtype="float32"))):
+            embeddings[i].append(e)
 
-    # Crop training samples
-    if cfg.SAMPLE_CROP_MODE == "center":
-        sig_splits = [audio.cropCenter(sig, rate, cfg.SIG_LENGTH)]
-    elif cfg.SAMPLE_CROP_MODE == "first":
-        sig_splits = [audio.splitSignal(sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)[0]]
-    else:
-        sig_splits = audio.splitSignal(sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
+    for i, (f, _) in enumerate(files):
+        try:
+            # Embeddings from the shared cache
+            cached = _loadCachedEmbeddings(f) if cfg.EMBEDDING_CACHE_DIR else None
+
+            if cached is not None:
+                embeddings[i] = list(cached)
+                continue
+
+            sig_splits = _getTrainingSamples(f)
+
+        # if anything happens print the error and ignore the file
+        except Exception as e:
+            # Print Error
+            print(f"\t Error when loading file {f}", flush=True)
+            continue
 
-    # Get feature embeddings
-    batch_size = 1 # turns out that batch size 1 is the fastest, probably because of having to resize the model input when the number of samples in a batch changes
-    for i in range(0, len(sig_splits), batch_size):
-        batch_sig = sig_splits[i:i+batch_size]
-        batch_label = [label_vector] * len(batch_sig)
-        embeddings = model.embeddings(batch_sig)
+        samples.extend(sig_splits)
+        owners.extend([i] * len(sig_splits))
+        computed.append(i)
 
-        # Add to training data
-        x_train.extend(embeddings)
-        y_train.extend(batch_label)
+        # Get feature embeddings of all full batches
+        while len(samples) >= batch_size:
+            predictBatch(samples[:batch_size], owners[:batch_size])
+            del samples[:batch_size], owners[:batch_size]
+
+    # Last batch
+    if samples:
+        predictBatch(samples, owners)
+
+    # Store new embeddings in the cache
+    if cfg.EMBEDDING_CACHE_DIR:
+        for i in computed:
+            if embeddings[i]:
+                embeddings[i] = list(_saveCachedEmbeddings(files[i][0], embeddings[i]))
+
+    return [(e, [label_vector] * len(e)) for e, (_, label_vector) in zip(embeddings, files)]
 
-    return x_train, y_train
 
 def _loadTrainingData(cache_mode="none", cache_file="", progress_callback=None):
     """Loads the data for training.
@@ -129,9 +215,8 @@ def _loadTrainingData(cache_mode="none", cache_file="", progress_callback=None):
     if cfg.MULTI_LABEL and cfg.UPSAMPLING_RATIO > 0 and cfg.UPSAMPLING_MODE != 'repeat':
         raise Exception("Only repeat-upsampling ist available for multi-label")
 
-    # Load training data
-    x_train = []
-    y_train = []
+    # Collect the files of all folders
+    files = []
 
     for folder in folders:
 
@@ -148,34 +233,37 @@ def _loadTrainingData(cache_mode="none", cache_file="", progress_callback=None):
 
         # Get list of files
         # Filter files that start with '.' because macOS seems to them for temp files.
-        files = filter(
-            os.path.isfile,
-            (
-                os.path.join(cfg.TRAIN_DATA_PATH, folder, f)
-                for f in sorted(os.listdir(os.path.join(cfg.TRAIN_DATA_PATH, folder)))
-                if not f.startswith(".") and f.rsplit(".", 1)[-1].lower() in cfg.ALLOWED_FILETYPES
-            ),
-        )
-
-        # Load files using thread pool       
-        with Pool(cfg.CPU_THREADS) as p:
-            tasks = []
-            for f in files:
-                task = p.apply_async(partial(_loadAudioFile, f=f, label_vector=label_vector, config=cfg.getConfig()))
-                tasks.append(task)
-
-            # Wait for tasks to complete and monitor progress with tqdm
-            num_files_processed = 0
-            with tqdm.tqdm(total=len(tasks), desc=f" - loading '{folder}'", unit='f') as progress_bar:
-                for task in tasks:
-                    result = task.get()
-                    x_train += result[0]
-                    y_train += result[1]
-                    num_files_processed += 1
-                    progress_bar.update(1)
-                    if progress_callback:
-                        progress_callback(num_files_processed, len(tasks), folder)
-    
+        for f in sorted(os.listdir(os.path.join(cfg.TRAIN_DATA_PATH, folder))):
+            fpath = os.path.join(cfg.TRAIN_DATA_PATH, folder, f)
+
+            if not f.startswith(".") and f.rsplit(".", 1)[-1].lower() in cfg.ALLOWED_FILETYPES and os.path.isfile(fpath):
+                files.append((fpath, label_vector, folder))
+
+    # Groups of files for the workers, a few groups per worker keep the load balanced
+    group_size = max(1, min(FILES_PER_TASK, len(files) // (cfg.CPU_THREADS * 4)))
+    config = cfg.getConfig()
+    tasks = [([(f, v) for f, v, _ in files[i : i + group_size]], config) for i in range(0, len(files), group_size)]
+    folder_sizes = {folder: sum(1 for _, _, fl in files if fl == folder) for folder in folders}
+    folder_done = dict.fromkeys(folders, 0)
+
+    # Load training data
+    x_train = []
+    y_train = []
+    file_iter = iter(files)
+
+    # One pool for all folders, results arrive in file order
+    with Pool(cfg.CPU_THREADS) as p, tqdm.tqdm(total=len(files), desc=" - loading training data", unit='f') as progress_bar:
+        for results in p.imap(_loadAudioFiles, tasks):
+            for x, y in results:
+                folder = next(file_iter)[2]
+                x_train += x
+                y_train += y
+                folder_done[folder] += 1
+                progress_bar.update(1)
+
+                if progress_callback:
+                    progress_callback(folder_done[folder], folder_sizes[folder], folder)
+
     # Convert to numpy arrays
     x_train = np.array(x_train, dtype="float32")
     y_train = np.array(y_train, dtype="float32")
@@ -370,7 +458,9 @@ if __name__ == "__main__":
     parser.add_argument("--model_save_mode", default="replace", help="Model save mode. Can be 'replace' or 'append', where 'replace' will overwrite the original classification layer and 'append' will combine the original classification layer with the new one. Defaults to 'replace'.")
     parser.add_argument("--cache_mode", default="none", help="Cache mode. Can be 'none', 'load' or 'save'. Defaults to 'none'.")
     parser.add_argument("--cache_file", default="train_cache.npz", help="Path to cache file. Defaults to 'train_cache.npz'.")
+    parser.add_argument("--embedding_cache_dir", default=None, help="Directory for cached feature embeddings, shared with analyze.py and embeddings.py. Defaults to None (no cache).")
     parser.add_argument("--threads", type=int, default=min(8, max(1, multiprocessing.cpu_count() // 2)), help="Number of CPU threads.")
+    parser.add_argument("--embedding_batch_size", type=int, default=cfg.TRAIN_EMBEDDING_BATCH_SIZE, help=f"Number of training samples per embedding batch, samples of several files are batched together. Defaults to {cfg.TRAIN_EMBEDDING_BATCH_SIZE}.")
 
     parser.add_argument("--fmin", type=int, default=cfg.SIG_FMIN, help="Minimum frequency for bandpass filter in Hz. Defaults to {} Hz.".format(cfg.SIG_FMIN))
     parser.add_argument("--fmax", type=int, default=cfg.SIG_FMAX, help="Maximum frequency for bandpass filter in Hz. Defaults to {} Hz.".format(cfg.SIG_FMAX))
@@ -399,8 +489,10 @@ if __name__ == "__main__":
     cfg.TRAINED_MODEL_SAVE_MODE = args.model_save_mode
     cfg.TRAIN_CACHE_MODE = args.cache_mode.lower()
     cfg.TRAIN_CACHE_FILE = args.cache_file
+    cfg.EMBEDDING_CACHE_DIR = args.embedding_cache_dir
     cfg.TFLITE_THREADS = 1
     cfg.CPU_THREADS = max(1, int(args.threads))
+    cfg.TRAIN_EMBEDDING_BATCH_SIZE = max(1, int(args.embedding_batch_size))
 
     cfg.BANDPASS_FMIN = max(0, min(cfg.SIG_FMAX, int(args.fmin)))
     cfg.BANDPASS_FMAX = max(cfg.SIG_FMIN, min(cfg.SIG_FMAX, int(args.fmax)))
@@ -1,6 +1,8 @@
 """Module containing common function.
 """
 
+import functools
+import hashlib
 import os
 import traceback
 from pathlib import Path
@@ -538,6 +540,108 @@ def loadFromCache(cache_file: str):
     return x_train, y_train, labels, binary_classification, multi_label
 
 
+# Hashes computed by another process, keyed by (path, size, modification time)
+KNOWN_FILE_HASHES: dict[tuple, str] = {}
+
+
+@functools.lru_cache(maxsize=4096)
+def _fileHash(path: str, size: int, mtime: int):
+    h = hashlib.blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def fileHash(path: str):
+    """Hashes the content of a file.
+
+    The hash is memoized by path, size and modification time,
+    so each file is only read once per process. Hashes passed in with `setFileHash` are not computed again.
+
+    Args:
+        path: Path to the file.
+
+    Returns:
+        The hex digest of the file content.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    return KNOWN_FILE_HASHES.get(key) or _fileHash(*key)
+
+
+def setFileHash(path: str, digest: str):
+    """Remembers the hash of a file that was computed by another process.
+
+    The hash is only used as long as size and modification time of the file do not change.
+
+    Args:
+        path: Path to the file.
+        digest: The hex digest of `fileHash`.
+    """
+    stat = os.stat(path)
+    KNOWN_FILE_HASHES[(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)] = digest
+
+
+def getCacheKey(*parts):
+    """Builds a cache key from the given values.
+
+    Args:
+        parts: Values that identify a cache entry, floats are rounded to 6 decimals.
+
+    Returns:
+        The hex digest of the values.
+    """
+    parts = [round(p, 6) if isinstance(p, float) else p for p in parts]
+
+    return hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def loadCacheEntry(cache_dir: str, key: str):
+    """Loads an entry from a content addressed cache.
+
+    Args:
+        cache_dir: The cache directory.
+        key: The cache key.
+
+    Returns:
+        A dictionary with the stored arrays or None if there is no entry.
+    """
+    path = os.path.join(cache_dir, key[:2], key + ".npz")
+
+    try:
+        with np.load(path) as entry:
+            return {k: entry[k] for k in entry.files}
+
+    except (OSError, ValueError):
+        return None
+
+
+def saveCacheEntry(cache_dir: str, key: str, **arrays):
+    """Saves an entry to a content addressed cache.
+
+    The entry is written to a temporary file first,
+    so concurrent readers never see a partial entry.
+
+    Args:
+        cache_dir: The cache directory.
+        key: The cache key.
+        arrays: The arrays to store.
+    """
+    path = os.path.join(cache_dir, key[:2], key + ".npz")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+
+    os.replace(tmp_path, path)
+
+
 def clearErrorLog():
     """Clears the error log file.
 